@@ -0,0 +1,169 @@
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from backend.tokenizer import cjk_bigram_tokenize, cjk_dict_tokenize
+
+# 与 langchain BM25Retriever（rank_bm25.BM25Okapi）默认参数一致
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+FORMAT_VERSION = 1
+# 构建索引时使用的分词器；查询侧以 meta.json 中记录的为准
+DEFAULT_TOKENIZER = os.getenv("BM25_TOKENIZER", "cjk_bigram")
+
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    "whitespace": str.split,  # 与 BM25Retriever 默认 preprocess_func 相同（仅供对比）
+    "cjk_bigram": cjk_bigram_tokenize,
+    "cjk_dict": cjk_dict_tokenize,  # 二元组 + data/lore 人名词典
+}
+
+
+def get_tokenizer(name: str) -> Callable[[str], List[str]]:
+    if name not in TOKENIZERS:
+        raise ValueError(f"未知分词器：{name}（可选：{', '.join(TOKENIZERS)}）")
+    return TOKENIZERS[name]
+
+
+class BM25Index:
+    """
+    倒排表形式的 BM25（Okapi）索引，可落盘到 data/indexes/<book_id>/bm25/：
+    - meta.json：参数、词表、chunk_ids（与 FAISS 向量位置一一对应）
+    - offsets.npy / postings_doc.npy / postings_tf.npy：CSR 倒排表
+    - doc_len.npy / idf.npy
+    加载时 numpy 数组按 mmap 打开，冷启动只剩读文件。
+    """
+
+    def __init__(self, vocab: Dict[str, int], offsets: np.ndarray, postings_doc: np.ndarray,
+                 postings_tf: np.ndarray, doc_len: np.ndarray, idf: np.ndarray,
+                 chunk_ids: List[str], tokenizer: str = DEFAULT_TOKENIZER,
+                 k1: float = K1, b: float = B):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.postings_doc = postings_doc
+        self.postings_tf = postings_tf
+        self.doc_len = doc_len
+        self.idf = idf
+        self.chunk_ids = chunk_ids
+        self.tokenizer_name = tokenizer
+        self.tokenize = get_tokenizer(tokenizer)
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(doc_len.mean()) if len(doc_len) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    # ---- 构建 ---- #
+    @classmethod
+    def build(cls, texts: Sequence[str], chunk_ids: Sequence[str], tokenizer: str = DEFAULT_TOKENIZER,
+              k1: float = K1, b: float = B, epsilon: float = EPSILON) -> "BM25Index":
+        assert len(texts) == len(chunk_ids), "texts 与 chunk_ids 数量不一致"
+        tokenize = get_tokenizer(tokenizer)
+        vocab: Dict[str, int] = {}
+        postings: List[List[Tuple[int, int]]] = []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            tf = Counter(tokenize(text))
+            doc_len[doc_id] = sum(tf.values())
+            for term, cnt in tf.items():
+                tid = vocab.setdefault(term, len(vocab))
+                if tid == len(postings):
+                    postings.append([])
+                postings[tid].append((doc_id, cnt))
+
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in postings])
+        postings_doc = np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=int(offsets[-1]))
+        postings_tf = np.fromiter((c for p in postings for _, c in p), dtype=np.float32, count=int(offsets[-1]))
+
+        # IDF 同 BM25Okapi：负值用 epsilon * 平均 IDF 兜底
+        n_docs = len(texts)
+        df = np.diff(offsets).astype(np.float64)
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            floor = epsilon * float(idf.mean())
+            idf[idf < 0] = floor
+        return cls(vocab, offsets, postings_doc, postings_tf, doc_len, idf.astype(np.float32),
+                   list(chunk_ids), tokenizer=tokenizer, k1=k1, b=b)
+
+    # ---- 落盘 / 加载 ---- #
+    def save(self, out_dir: Path):
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for name in ("offsets", "postings_doc", "postings_tf", "doc_len", "idf"):
+            np.save(out_dir / f"{name}.npy", np.ascontiguousarray(getattr(self, name)))
+        terms = [""] * len(self.vocab)
+        for term, tid in self.vocab.items():
+            terms[tid] = term
+        meta = {
+            "version": FORMAT_VERSION,
+            "tokenizer": self.tokenizer_name,
+            "k1": self.k1,
+            "b": self.b,
+            "n_docs": len(self.chunk_ids),
+            "chunk_ids": self.chunk_ids,
+            "terms": terms,
+        }
+        # meta 最后写且原子替换：读到 meta 即说明数组已齐
+        tmp = out_dir / "meta.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, out_dir / "meta.json")
+
+    @classmethod
+    def load(cls, in_dir: Path, mmap: bool = True) -> "BM25Index":
+        in_dir = Path(in_dir)
+        with open(in_dir / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"BM25 索引版本不兼容：{meta.get('version')}，请重建索引")
+        mode = "r" if mmap else None
+        arrays = {name: np.load(in_dir / f"{name}.npy", mmap_mode=mode)
+                  for name in ("offsets", "postings_doc", "postings_tf", "doc_len", "idf")}
+        vocab = {t: i for i, t in enumerate(meta["terms"])}
+        return cls(vocab, chunk_ids=meta["chunk_ids"], tokenizer=meta["tokenizer"],
+                   k1=meta["k1"], b=meta["b"], **arrays)
+
+    @staticmethod
+    def exists(in_dir: Path) -> bool:
+        return (Path(in_dir) / "meta.json").exists()
+
+    # ---- 查询 ---- #
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """
+        返回 [(文档行号, 分数)]，只含命中词项的文档，按分数降序。
+        只触碰查询词的倒排表：开销与倒排表总长成正比，与语料规模无关。
+        """
+        if not len(self.chunk_ids) or k <= 0:
+            return []
+        tids, qtfs = [], []
+        for term, qtf in Counter(self.tokenize(query)).items():
+            tid = self.vocab.get(term)
+            if tid is not None:
+                tids.append(tid)
+                qtfs.append(qtf)
+        if not tids:
+            return []
+        starts = self.offsets[tids]
+        lens = self.offsets[np.asarray(tids) + 1] - starts
+        # 拼接各词倒排表的下标，一次性取出 doc/tf
+        idx = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(int(lens.sum()))
+        docs = self.postings_doc[idx]
+        tf = self.postings_tf[idx]
+        weight = np.repeat(np.asarray(qtfs, dtype=np.float32) * self.idf[tids], lens)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / (self.avgdl or 1.0))
+        contrib = weight * tf * (self.k1 + 1) / (tf + norm)
+
+        uniq, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contrib)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(uniq[i]), float(scores[i])) for i in top if scores[i] > 0]
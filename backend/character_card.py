@@ -1,16 +1,21 @@
 import json
+import os
+import threading
 from pathlib import Path
+from typing import Dict, NamedTuple, Tuple
 from backend.schema import CharacterCard
 
 BASE_DIR = Path(__file__).resolve().parents[1]
+CARDS_DIR = BASE_DIR / "data" / "lore" / "characters"
 
 def load_character(card_id: str) -> CharacterCard:
-    card_path = BASE_DIR / "data" / "lore" / "characters" / f"{card_id}.json"
+    card_path = CARDS_DIR / f"{card_id}.json"
     with open(card_path, "r", encoding="utf-8") as f:
         data = json.load(f)
     return CharacterCard(**data)
 
-def render_system_prompt(card: CharacterCard, hidden_context: str) -> str:
+def render_static_prompt(card: CharacterCard) -> str:
+    """人设 + 世界观 + 对话规则：同一张卡逐字节不变，作为可被服务端前缀缓存命中的固定前缀。"""
     identity= "\n- ".join(card.identity)
     appearence = "\n- ".join(card.appearence)
     personal = "\n- ".join(card.personal)
@@ -40,12 +45,43 @@ def render_system_prompt(card: CharacterCard, hidden_context: str) -> str:
 - {world_rules}
 【安全边界】
 - {safety_rules}
-【隐式剧情证据（来自原文检索，用户不可见）】
-{hidden_context}
 【对话规则】
 1) 仅使用第一人称，不要跳出设定；
-2) 基于隐式证据作答，如证据不足，可做克制延展但不得自相矛盾；
+2) 基于每轮附带的隐式剧情证据作答，如证据不足，可做克制延展但不得自相矛盾；
 3) 语言简洁自然，必要时可有少量内心独白（括号标注）。
 4) **不得直接引用原文文本或泄露“隐式证据”的具体来源/内容，仅在回答中消化其信息。**
 5) 我的身份是小夭，我们将进行对话，你的回答可带有适当动作或神态描写，用于体现人物内心活动
-""".strip()
\ No newline at end of file
+""".strip()
+
+def render_evidence_prompt(hidden_context: str) -> str:
+    """每轮变化的部分：放在历史对话之后、本轮用户输入之前。"""
+    return f"""
+【隐式剧情证据（来自原文检索，用户不可见）】
+{hidden_context}
+""".strip()
+
+def render_system_prompt(card: CharacterCard, hidden_context: str) -> str:
+    # 兼容旧调用：固定前缀 + 本轮证据拼成一条 system prompt
+    return render_static_prompt(card) + "\n" + render_evidence_prompt(hidden_context)
+
+
+class CardBundle(NamedTuple):
+    card: CharacterCard
+    static_prompt: str
+
+
+_bundles: Dict[str, Tuple[int, CardBundle]] = {}
+_bundles_lock = threading.Lock()
+
+def load_card_bundle(card_id: str) -> CardBundle:
+    """按卡缓存解析结果与固定前缀；角色卡文件修改（mtime 变化）后自动重新渲染。"""
+    mtime = os.stat(CARDS_DIR / f"{card_id}.json").st_mtime_ns
+    with _bundles_lock:
+        hit = _bundles.get(card_id)
+        if hit is not None and hit[0] == mtime:
+            return hit[1]
+    card = load_character(card_id)
+    bundle = CardBundle(card, render_static_prompt(card))
+    with _bundles_lock:
+        _bundles[card_id] = (mtime, bundle)
+    return bundle
@@ -1,16 +1,27 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-from .character_card import load_character, render_system_prompt
-from backend.retriever import DemoRetriever
-from backend.memory import SessionStore, LTMStore, extract_facts
+from .character_card import load_card_bundle, render_evidence_prompt
+from backend.retriever import await_leg, submit_leg, wait_leg
+from backend.retriever_pool import RETRIEVER_POOL
+from backend.memory import SessionStore, LTMStore
+from backend.fact_worker import FACT_QUEUE
+from backend.prompt_budget import PromptBudgeter, PromptPlan, message_tokens
+from backend.summarizer import get_summarizer
+from backend.usage_stats import USAGE_STATS
+from backend.response_cache import RESPONSE_CACHE_HISTORY, get_response_cache, history_fingerprint
+from backend.tracing import TurnTrace, record_size, span, turn
 import os
-from typing import Generator
+import weakref
+import asyncio
+from typing import AsyncGenerator, Generator
 MAX_HISTORY_ROUNDS = 8
+REPLAY_PIECE_CHARS = 4   # 缓存命中的回复按几个字一块流出，前端表现与实时生成一致
 api_key=os.getenv("OPENAI_API_KEY")
 # 新增：后端统一控制默认值，可用环境变量覆盖
 DEFAULT_TEMPERATURE = float(os.getenv("CHAT_TEMPERATURE", "0.8"))
 DEFAULT_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+LTM_TIMEOUT = float(os.getenv("RETRIEVAL_LTM_TIMEOUT", "1.0"))
 
 def build_history_aware_query(history: List[Dict], user_text: str) -> str:
     last_users = [m["content"] for m in history if m["role"] == "user"]
@@ -20,55 +31,203 @@ def build_history_aware_query(history: List[Dict], user_text: str) -> str:
 
 class RoleChatEngine:
     def __init__(self, card_id: str, book_id:str,session_store: SessionStore, ltm_store: LTMStore,
-                 temperature: float = 0.5, top_k: int = 5):
+                 temperature: float = 0.5, top_k: int = 5, llm=None, retriever=None):
+        """llm / retriever 可注入（离线基准、替身模型）；默认 ChatOpenAI + 进程内共享的检索器。"""
         self.card_id = card_id
-        self.card = load_character(card_id)
+        # [CHANGED] 角色卡与其固定前缀按卡缓存（文件修改后自动失效），每轮不再重新渲染
+        self._bundle = None
+        self._refresh_card()
         self.book_id = book_id
-        self.retriever = DemoRetriever(book_id=book_id, k=top_k or DEFAULT_TOP_K)
-        self.llm = ChatOpenAI(
+        self.top_k = top_k or DEFAULT_TOP_K
+        # 同一本书的检索器在进程内共享；引擎被回收或 close() 时归还引用
+        if retriever is None:
+            self.retriever = RETRIEVER_POOL.acquire(book_id)
+            self._release = weakref.finalize(self, RETRIEVER_POOL.release, book_id)
+        else:
+            self.retriever = retriever
+            self._release = lambda: None
+        self.llm = llm or ChatOpenAI(
                      base_url="https://jy.ai666.net/v1",
                      api_key=api_key,
                      temperature=temperature or DEFAULT_TEMPERATURE,
                      model = "gpt-4o",
+                     stream_usage=True,          # 流式结束时返回用量（含前缀缓存命中数）
                      )
         self.sessions = session_store
         self.ltm = ltm_store
+        # [NEW] 按 token 预算组装 prompt；窗口外的旧对话由滚动摘要（前情提要）承接
+        self.budgeter = PromptBudgeter()
+        self.summarizer = get_summarizer(session_store)
+        self.last_plan_tokens: Dict[str, int] = {}
+        # [NEW] 回复缓存（RESPONSE_CACHE=exact/semantic 开启，默认关闭）
+        self.response_cache = get_response_cache(session_store.db_path)
+        # [NEW] 最近一轮的分阶段追踪（耗时/规模），汇总见 backend.tracing.METRICS
+        self.last_trace: Optional[TurnTrace] = None
+
+    def close(self):
+        self._release()
+
+    def _refresh_card(self):
+        bundle = load_card_bundle(self.card_id)
+        if bundle is not self._bundle:
+            self._bundle = bundle
+            self.card = bundle.card
+            self._fixed_tokens = (message_tokens(bundle.static_prompt)
+                                  + message_tokens(render_evidence_prompt("")))
+
     def _clip_history(self, history: List[Dict]) -> List[Dict]:
         return history[-MAX_HISTORY_ROUNDS * 2 :]
 
-    def chat(self, session_id: str, history: List[Dict], user_text: str, use_ltm: bool = True) -> str:
-        history = self._clip_history(history)
-        query_for_retrieval = build_history_aware_query(history, user_text)
-        hidden_ctx = self.retriever.fetch_hidden_context(query_for_retrieval)
+    def _gather_evidence(self, session_id: str, history: List[Dict], user_text: str,
+                         use_ltm: bool) -> Tuple[List[str], List[str]]:
+        """原文检索（向量 + BM25）与长期记忆召回并发执行，返回 (原文 chunk 列表, 记忆列表)。"""
+        with span("query.build"):
+            query_for_retrieval = build_history_aware_query(history, user_text)
+        with span("retrieval"):
+            # 只有开启时才检索长期记忆
+            ltm_f = submit_leg(self._recall_ltm, session_id, user_text) if use_ltm else None
+            chunks = self.retriever.fetch_hidden_chunks(query_for_retrieval, k=self.top_k,
+                                                         role=self.card.display_name)
+            ltm_snippets = wait_leg(ltm_f, LTM_TIMEOUT, "长期记忆召回") if ltm_f is not None else []
+        record_size("ltm.facts", len(ltm_snippets or []))
+        return chunks, ltm_snippets or []
 
-        # 只有开启时才检索长期记忆
+    async def _agather_evidence(self, session_id: str, history: List[Dict], user_text: str,
+                                use_ltm: bool) -> Tuple[List[str], List[str]]:
+        with span("query.build"):
+            query_for_retrieval = build_history_aware_query(history, user_text)
+        with span("retrieval"):
+            ltm_t = asyncio.create_task(await_leg(
+                asyncio.to_thread(self._recall_ltm, session_id, user_text),
+                LTM_TIMEOUT, "长期记忆召回")) if use_ltm else None
+            chunks = await self.retriever.afetch_hidden_chunks(query_for_retrieval, k=self.top_k,
+                                                                role=self.card.display_name)
+            ltm_snippets = (await ltm_t) if ltm_t is not None else []
+        record_size("ltm.facts", len(ltm_snippets or []))
+        return chunks, ltm_snippets or []
+
+    def _recall_ltm(self, session_id: str, user_text: str) -> List[str]:
+        with span("ltm.retrieve"):
+            return self.ltm.retrieve(session_id=session_id, role_id=self.card_id, query=user_text, top_k=3)
+
+    def _plan(self, session_id: str, history: List[Dict], user_text: str, chunks: List[str],
+              ltm_snippets: List[str]) -> PromptPlan:
+        with span("prompt.plan"):
+            self._refresh_card()
+            summarized, summary = self.summarizer.covered(session_id, len(history))
+            fixed = self._fixed_tokens + message_tokens(user_text)
+            plan = self.budgeter.plan(fixed, history, chunks, ltm_snippets, summary, summarized)
+        self.last_plan_tokens = plan.tokens
+        record_size("prompt.tokens", plan.tokens["total"])
+        record_size("prompt.evidence_tokens", plan.tokens.get("evidence", 0))
+        record_size("prompt.evidence_chunks", len(plan.evidence))
+        record_size("prompt.history_messages", len(plan.history))
+        return plan
+
+    def _enqueue_facts(self, session_id: str, user_text: str, reply: str) -> bool:
+        return FACT_QUEUE.submit(self.llm, self.ltm, session_id=session_id, role_id=self.card_id,
+                                 role_name=self.card.display_name, user_text=user_text, reply=reply)
+
+    def _after_turn(self, session_id: str, kept: int, user_text: str, reply: str, use_ltm: bool):
+        # 入库后：前情提要按需后台更新（本轮两条 + 近期对话上限内的 kept 条历史仍在窗口内）；长期记忆入队抽取
+        self.summarizer.schedule(self.llm, self.card.display_name, session_id, kept_tail=kept + 2)
+        # 只有开启时才写入长期记忆（后台队列抽取，不占用回复时间）
         if use_ltm:
-            ltm_snippets = self.ltm.retrieve(session_id=session_id, role_id=self.card_id, query=user_text, top_k=3)
-            if ltm_snippets:
-                hidden_ctx += "\n\n【长期记忆】\n" + "\n".join(ltm_snippets)
+            with span("facts.enqueue"):
+                self._enqueue_facts(session_id, user_text, reply)
+
+    def _cache_fingerprint(self, session_id: str, history: List[Dict], use_ltm: bool) -> Optional[str]:
+        """回复缓存的历史指纹；返回 None 表示本轮必须绕过缓存（会话记忆可能改变回答）。"""
+        if self.response_cache is None:
+            return None
+        if use_ltm and self.ltm.has_facts(session_id, self.card_id):
+            return None
+        if history:
+            return history_fingerprint(history) if RESPONSE_CACHE_HISTORY else None
+        return ""
 
-        sys_prompt = render_system_prompt(self.card, hidden_ctx)
-        messages = [SystemMessage(content=sys_prompt)]
-        for m in history:
+    def _lookup_cached(self, session_id: str, history: List[Dict], user_text: str,
+                       use_ltm: bool) -> Tuple[Optional[str], Optional[str]]:
+        fp = self._cache_fingerprint(session_id, history, use_ltm)
+        if fp is None:
+            return None, None
+        with span("cache.lookup"):
+            return fp, self.response_cache.lookup(self.card_id, user_text, fp)
+
+    @staticmethod
+    def _replay(reply: str):
+        for i in range(0, len(reply), REPLAY_PIECE_CHARS):
+            yield reply[i:i + REPLAY_PIECE_CHARS]
+
+    def _build_messages(self, plan: PromptPlan, user_text: str) -> List:
+        """
+        [CHANGED] 稳定前缀布局：[固定人设 system][历史对话][本轮证据 system][用户输入]。
+        人设逐字节不变、历史只在末尾追加，服务端前缀缓存可以一直命中到本轮证据之前。
+        """
+        with span("prompt.render"):
+            return self._render_messages(plan, user_text)
+
+    def _render_messages(self, plan: PromptPlan, user_text: str) -> List:
+        hidden_ctx = "\n\n".join(plan.evidence)
+        if plan.memory:
+            hidden_ctx += "\n\n【长期记忆】\n" + "\n".join(plan.memory)
+        if plan.summary:
+            hidden_ctx += "\n\n【前情提要】\n" + plan.summary
+        messages = [SystemMessage(content=self._bundle.static_prompt)]
+        for m in plan.history:
             if m["role"] == "user":
                 messages.append(HumanMessage(content=m["content"]))
             elif m["role"] == "assistant":
                 messages.append(AIMessage(content=m["content"]))
+        messages.append(SystemMessage(content=render_evidence_prompt(hidden_ctx.strip())))
         messages.append(HumanMessage(content=user_text))
+        return messages
 
-        resp = self.llm.invoke(messages)
-        reply = resp.content
-        # 入库
-        self.sessions.append_message(session_id, role="user", content=user_text)
-        self.sessions.append_message(session_id, role="assistant", content=reply)
+    def _prepare(self, session_id: str, history: List[Dict], user_text: str, use_ltm: bool):
+        history = self._clip_history(history)
+        chunks, ltm_snippets = self._gather_evidence(session_id, history, user_text, use_ltm)
+        plan = self._plan(session_id, history, user_text, chunks, ltm_snippets)
+        return plan, self._build_messages(plan, user_text)
 
-        # 只有开启时才写入长期记忆
-        if use_ltm:
-            facts = extract_facts(self.llm, self.card.display_name, history, user_text, reply)
-            for f in facts:
-                self.ltm.insert(session_id=session_id, role_id=self.card_id, fact=f)
+    def _begin_turn(self, kind: str, session_id: str):
+        t = turn(kind, role=self.card_id, book=self.book_id, session=session_id)
+        self.last_trace = t.trace
+        return t
 
-        return reply
+    @staticmethod
+    def _record_usage(trace: TurnTrace, message):
+        usage = USAGE_STATS.record(message)
+        if usage and usage.get("input_tokens") is not None:
+            trace.size("llm.input_tokens", usage["input_tokens"])
+            if usage.get("cached_tokens") is not None:
+                trace.size("llm.cached_tokens", usage["cached_tokens"])
+
+    def _persist_turn(self, trace: TurnTrace, session_id: str, kept: int, user_text: str, reply: str,
+                      use_ltm: bool):
+        trace.size("reply.chars", len(reply))
+        with trace.active(), trace.stage("persist"):
+            self.sessions.append_turn(session_id, user_text, reply)
+            self._after_turn(session_id, kept, user_text, reply, use_ltm)
+
+    def chat(self, session_id: str, history: List[Dict], user_text: str, use_ltm: bool = True) -> str:
+        with self._begin_turn("chat", session_id) as trace:
+            history = self._clip_history(history)
+            with trace.active():
+                fp, reply = self._lookup_cached(session_id, history, user_text, use_ltm)
+            kept = len(history)
+            if reply is None:
+                with trace.active():
+                    plan, messages = self._prepare(session_id, history, user_text, use_ltm)
+                with trace.stage("llm.generate"):
+                    resp = self.llm.invoke(messages)
+                self._record_usage(trace, resp)
+                reply = resp.content
+                kept = plan.window
+                if fp is not None:
+                    self.response_cache.put_later(self.card_id, user_text, reply, fp)
+            # 入库（一轮一个事务）
+            self._persist_turn(trace, session_id, kept, user_text, reply, use_ltm)
+            return reply
 
     # —— [NEW] 流式输出：逐块产出，结束后入库 + 抽取 —— #
     def chat_stream(
@@ -78,36 +237,103 @@ class RoleChatEngine:
             user_text: str,
             use_ltm: bool = True,
     ) -> Generator[str, None, str]:
-        history_clipped = self._clip_history(history)
-        query_for_retrieval = build_history_aware_query(history_clipped, user_text)
-        hidden_ctx = self.retriever.fetch_hidden_context(query_for_retrieval)
-        if use_ltm:
-            ltm_snippets = self.ltm.retrieve(session_id=session_id, role_id=self.card_id, query=user_text, top_k=3)
-            if ltm_snippets:
-                hidden_ctx += "\n\n【长期记忆】\n" + "\n".join(ltm_snippets)
-        sys_prompt = render_system_prompt(self.card, hidden_ctx)
-        messages = [SystemMessage(content=sys_prompt)]
-        for m in history_clipped:
-            if m["role"] == "user":
-                messages.append(HumanMessage(content=m["content"]))
-            elif m["role"] == "assistant":
-                messages.append(AIMessage(content=m["content"]))
-        messages.append(HumanMessage(content=user_text))
+        with self._begin_turn("chat_stream", session_id) as trace:
+            history_clipped = self._clip_history(history)
+            with trace.active():
+                fp, cached = self._lookup_cached(session_id, history_clipped, user_text, use_ltm)
+            if cached is not None:
+                # 缓存命中：跳过检索与生成，照常分块流出并入库
+                trace.mark("llm.ttft")
+                yield from self._replay(cached)
+                self._persist_turn(trace, session_id, len(history_clipped), user_text, cached, use_ltm)
+                return cached
 
-        chunks = []
-        for delta in self.llm.stream(messages):  # [NEW] 使用流式接口
-            piece = getattr(delta, "content", None)
-            if piece:
-                chunks.append(piece)
-                yield piece
-        full = "".join(chunks)
-
-        # 入库
-        self.sessions.append_message(session_id, role="user", content=user_text)
-        self.sessions.append_message(session_id, role="assistant", content=full)
-        # 长期记忆抽取
-        if use_ltm:
-            facts = extract_facts(self.llm, self.card.display_name, history_clipped, user_text, full)
-            for f in facts:
-                self.ltm.insert(session_id=session_id, role_id=self.card_id, fact=f)
-        return full
+            with trace.active():
+                plan, messages = self._prepare(session_id, history_clipped, user_text, use_ltm)
+            chunks = []
+            # 生成耗时包含消费方处理每块的时间（流式背压也算在回复延迟里）
+            with trace.stage("llm.generate"):
+                for delta in self.llm.stream(messages):  # [NEW] 使用流式接口
+                    piece = getattr(delta, "content", None)
+                    if piece:
+                        if not chunks:
+                            trace.mark("llm.ttft")
+                        chunks.append(piece)
+                        yield piece
+                    if getattr(delta, "usage_metadata", None):
+                        self._record_usage(trace, delta)
+            full = "".join(chunks)
+
+            # 入库；长期记忆抽取入队即返回，生成器立刻结束
+            self._persist_turn(trace, session_id, plan.window, user_text, full, use_ltm)
+            if fp is not None:
+                self.response_cache.put_later(self.card_id, user_text, full, fp)
+            return full
+
+    # —— 异步版本：与 chat / chat_stream 行为一致，供高并发服务使用 —— #
+    async def _aprepare(self, session_id: str, history: List[Dict], user_text: str, use_ltm: bool):
+        history = self._clip_history(history)
+        chunks, ltm_snippets = await self._agather_evidence(session_id, history, user_text, use_ltm)
+        plan = await asyncio.to_thread(self._plan, session_id, history, user_text, chunks, ltm_snippets)
+        return plan, self._build_messages(plan, user_text)
+
+    async def _apersist_turn(self, trace: TurnTrace, session_id: str, kept: int, user_text: str, reply: str,
+                             use_ltm: bool):
+        # block 策略下入队可能等待，整段放到线程里
+        await asyncio.to_thread(self._persist_turn, trace, session_id, kept, user_text, reply, use_ltm)
+
+    async def achat(self, session_id: str, history: List[Dict], user_text: str, use_ltm: bool = True) -> str:
+        with self._begin_turn("chat", session_id) as trace:
+            history = self._clip_history(history)
+            with trace.active():
+                fp, reply = await asyncio.to_thread(self._lookup_cached, session_id, history, user_text, use_ltm)
+            kept = len(history)
+            if reply is None:
+                with trace.active():
+                    plan, messages = await self._aprepare(session_id, history, user_text, use_ltm)
+                with trace.stage("llm.generate"):
+                    resp = await self.llm.ainvoke(messages)
+                self._record_usage(trace, resp)
+                reply = resp.content
+                kept = plan.window
+                if fp is not None:
+                    self.response_cache.put_later(self.card_id, user_text, reply, fp)
+            await self._apersist_turn(trace, session_id, kept, user_text, reply, use_ltm)
+            return reply
+
+    async def achat_stream(
+            self,
+            session_id: str,
+            history: List[Dict],
+            user_text: str,
+            use_ltm: bool = True,
+    ) -> AsyncGenerator[str, None]:
+        with self._begin_turn("chat_stream", session_id) as trace:
+            history_clipped = self._clip_history(history)
+            with trace.active():
+                fp, cached = await asyncio.to_thread(self._lookup_cached, session_id, history_clipped,
+                                                     user_text, use_ltm)
+            if cached is not None:
+                trace.mark("llm.ttft")
+                for piece in self._replay(cached):
+                    yield piece
+                await self._apersist_turn(trace, session_id, len(history_clipped), user_text, cached, use_ltm)
+                return
+
+            with trace.active():
+                plan, messages = await self._aprepare(session_id, history_clipped, user_text, use_ltm)
+            chunks = []
+            with trace.stage("llm.generate"):
+                async for delta in self.llm.astream(messages):
+                    piece = getattr(delta, "content", None)
+                    if piece:
+                        if not chunks:
+                            trace.mark("llm.ttft")
+                        chunks.append(piece)
+                        yield piece
+                    if getattr(delta, "usage_metadata", None):
+                        self._record_usage(trace, delta)
+            full = "".join(chunks)
+            await self._apersist_turn(trace, session_id, plan.window, user_text, full, use_ltm)
+            if fp is not None:
+                self.response_cache.put_later(self.card_id, user_text, full, fp)
@@ -0,0 +1,96 @@
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+FORMAT_VERSION = 1
+META_NAME = "chunks.json"
+BLOB_NAME = "chunks.bin"
+OFFSETS_NAME = "chunks_offsets.npy"
+
+
+def write_chunk_store(out_dir: Path, ids: Sequence[str], docs: Sequence[Document]):
+    """
+    写出 chunk 库：
+    - chunks.bin：逐条拼接的 UTF-8 正文 + JSON 元数据
+    - chunks_offsets.npy：(n, 4) uint64，每行 [正文起点, 正文长度, 元数据起点, 元数据长度]
+    - chunks.json：版本、条数、chunk id（行号 = 向量索引位置 = BM25 文档号）
+    """
+    assert len(ids) == len(docs), "ids 与 docs 数量不一致"
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    offsets = np.zeros((len(docs), 4), dtype=np.uint64)
+    pos = 0
+    with open(out_dir / (BLOB_NAME + ".tmp"), "wb") as f:
+        for i, d in enumerate(docs):
+            text = d.page_content.encode("utf-8")
+            meta = json.dumps(d.metadata or {}, ensure_ascii=False).encode("utf-8")
+            offsets[i] = (pos, len(text), pos + len(text), len(meta))
+            f.write(text)
+            f.write(meta)
+            pos += len(text) + len(meta)
+    np.save(out_dir / (OFFSETS_NAME + ".tmp.npy"), offsets)
+    os.replace(out_dir / (BLOB_NAME + ".tmp"), out_dir / BLOB_NAME)
+    os.replace(out_dir / (OFFSETS_NAME + ".tmp.npy"), out_dir / OFFSETS_NAME)
+    # meta 最后写：读到 meta 即说明 blob/offsets 已齐
+    tmp = out_dir / (META_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": FORMAT_VERSION, "n": len(ids), "ids": list(ids)}, f, ensure_ascii=False)
+    os.replace(tmp, out_dir / META_NAME)
+
+
+class ChunkStore:
+    """只读 chunk 库：mmap 打开，按行号惰性解码正文与元数据，不经过 pickle。"""
+
+    def __init__(self, ids: List[str], offsets: np.ndarray, blob: Optional[mmap.mmap], fh=None):
+        self.ids = ids
+        self._offsets = offsets
+        self._blob = blob
+        self._fh = fh
+
+    @classmethod
+    def open(cls, in_dir: Path) -> "ChunkStore":
+        in_dir = Path(in_dir)
+        with open(in_dir / META_NAME, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"chunk 库版本不兼容：{meta.get('version')}，请重建索引")
+        offsets = np.load(in_dir / OFFSETS_NAME, mmap_mode="r")
+        fh = open(in_dir / BLOB_NAME, "rb")
+        size = os.fstat(fh.fileno()).st_size
+        blob = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        return cls(meta["ids"], offsets, blob, fh)
+
+    @staticmethod
+    def exists(in_dir: Path) -> bool:
+        return (Path(in_dir) / META_NAME).exists()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _slice(self, off, length) -> bytes:
+        off, length = int(off), int(length)
+        return self._blob[off:off + length] if length else b""
+
+    def text(self, i: int) -> str:
+        off, n, _, _ = self._offsets[i]
+        return self._slice(off, n).decode("utf-8")
+
+    def metadata(self, i: int) -> Dict:
+        _, _, off, n = self._offsets[i]
+        return json.loads(self._slice(off, n).decode("utf-8") or "{}")
+
+    def get(self, i: int) -> Document:
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+    def close(self):
+        if self._blob is not None:
+            self._blob.close()
+            self._blob = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from backend.tracing import span
+
+# 每个连接打开时都要执行的 PRAGMA（journal_mode 持久化在库文件里，其余都是连接级的）
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))};",
+    f"PRAGMA cache_size=-{int(os.getenv('SQLITE_CACHE_KB', '16384'))};",
+)
+STATEMENT_CACHE = 256
+
+
+class _PooledConnection(sqlite3.Connection):
+    """sqlite3.Connection 本身不支持弱引用，子类才可以放进 WeakSet。"""
+
+
+class ConnectionPool:
+    """
+    每线程一条长连接：PRAGMA 只在打开时执行一次，语句缓存（cached_statements）随连接长期有效。
+    - connection()：当前线程的连接（autocommit，读直接用）；
+    - write()：BEGIN IMMEDIATE 的写事务，正常退出提交、异常回滚。
+    连接只由所属线程的 threading.local 强引用，_all 是弱引用集合：线程退出（如空闲回收的
+    worker 线程）后连接随之释放关闭，不会在进程生命期内累积。
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: "weakref.WeakSet[_PooledConnection]" = weakref.WeakSet()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=STATEMENT_CACHE,
+                                   factory=_PooledConnection)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._all.add(conn)
+        return conn
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        conn = self.connection()
+        # IMMEDIATE：一开始就拿写锁，避免读锁升级写锁时的 SQLITE_BUSY
+        with span("sql.lock_wait"):   # 写锁等待时间：并发写入时的争用
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            conns, self._all = list(self._all), weakref.WeakSet()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass  # 其它线程创建的连接在部分 Python 版本下不允许跨线程关闭
+        self._local = threading.local()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """同一数据库文件在进程内共用一个连接池。"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path)
+        return pool
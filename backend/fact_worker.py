@@ -0,0 +1,228 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from backend.memory import LTMStore, extract_facts_batch
+from backend.tracing import METRICS, record_size, span
+
+# 长期记忆抽取队列：回复流结束后只入队，由后台线程合并抽取、批量写库
+DEFAULT_QUEUE_SIZE = int(os.getenv("LTM_QUEUE_SIZE", "256"))        # 最多积压多少轮对话
+DEFAULT_WORKERS = int(os.getenv("LTM_WORKERS", "2"))                # 0 = 在调用线程内同步抽取（旧行为）
+DEFAULT_POLICY = os.getenv("LTM_DROP_POLICY", "drop_oldest")        # block / drop_oldest / drop_new
+DEFAULT_BLOCK_TIMEOUT = float(os.getenv("LTM_BLOCK_TIMEOUT", "1.0"))
+DEFAULT_BATCH_TURNS = int(os.getenv("LTM_BATCH_TURNS", "4"))        # 一次抽取最多合并几轮
+DEFAULT_COALESCE_WINDOW = float(os.getenv("LTM_COALESCE_WINDOW", "2.0"))  # 等待同会话后续轮次的时间（秒）
+DEFAULT_DRAIN_TIMEOUT = float(os.getenv("LTM_DRAIN_TIMEOUT", "30"))
+POLICIES = ("block", "drop_oldest", "drop_new")
+
+
+class _Job:
+    __slots__ = ("llm", "ltm", "role_name", "turns")
+
+    def __init__(self, llm, ltm: LTMStore, role_name: str):
+        self.llm = llm
+        self.ltm = ltm
+        self.role_name = role_name
+        self.turns: List[Tuple[str, str, float]] = []  # (user_text, reply, 入队时间)
+
+
+class FactExtractionQueue:
+    """
+    有界的长期记忆抽取队列：
+    - 按 (session_id, role_id) 合并：同一会话积压的多轮合成一次抽取，结果一次性批量写入；
+    - 满载策略：block（最多等 block_timeout 秒，仍满则丢弃新任务）/ drop_oldest / drop_new；
+    - coalesce_window：最早一轮入队不足该时长时先等一等，让后续轮次并进来（关闭时不等）；
+    - drain：停止接收新任务并等积压处理完，进程退出时自动调用；
+    - stats：积压轮数、最老任务延迟、处理/丢弃/失败计数。
+    """
+
+    def __init__(self, max_size: int = DEFAULT_QUEUE_SIZE, workers: int = DEFAULT_WORKERS,
+                 policy: str = DEFAULT_POLICY, block_timeout: float = DEFAULT_BLOCK_TIMEOUT,
+                 batch_turns: int = DEFAULT_BATCH_TURNS, coalesce_window: float = DEFAULT_COALESCE_WINDOW):
+        if policy not in POLICIES:
+            raise ValueError(f"未知丢弃策略：{policy}（可选：{', '.join(POLICIES)}）")
+        self.max_size = max(1, max_size)
+        self.workers = max(0, workers)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_turns = max(1, batch_turns)
+        self.coalesce_window = max(0.0, coalesce_window)
+        self._cond = threading.Condition()
+        self._jobs: "OrderedDict[Tuple[str, str], _Job]" = OrderedDict()
+        self._busy: set = set()   # 正在抽取的会话，避免同一会话被两个线程并发处理
+        self._depth = 0
+        self._threads: List[threading.Thread] = []
+        self._closing = False
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.facts = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    # —— 生产端 —— #
+    def submit(self, llm, ltm: LTMStore, session_id: str, role_id: str, role_name: str,
+               user_text: str, reply: str) -> bool:
+        """入队一轮对话；返回 False 表示被丢弃。"""
+        if self.workers == 0:
+            self._run(llm, ltm, session_id, role_id, role_name, [(user_text, reply, time.time())])
+            return True
+        key = (session_id, role_id)
+        with self._cond:
+            if self._closing:
+                self.dropped += 1
+                return False
+            self._ensure_started()
+            if self._depth >= self.max_size:
+                if self.policy == "block":
+                    deadline = time.time() + self.block_timeout
+                    while self._depth >= self.max_size and not self._closing:
+                        left = deadline - time.time()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    if self._depth >= self.max_size or self._closing:
+                        self.dropped += 1
+                        return False
+                elif self.policy == "drop_new":
+                    self.dropped += 1
+                    return False
+                else:
+                    self._drop_oldest_locked()
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = _Job(llm, ltm, role_name)
+            job.llm, job.ltm, job.role_name = llm, ltm, role_name
+            job.turns.append((user_text, reply, time.time()))
+            self._depth += 1
+            self.enqueued += 1
+            self._cond.notify_all()
+        return True
+
+    def _drop_oldest_locked(self):
+        # 丢掉最早入队会话的最早一轮；已被线程取走的轮次不受影响
+        for key, job in self._jobs.items():
+            job.turns.pop(0)
+            if not job.turns:
+                del self._jobs[key]
+            self._depth -= 1
+            self.dropped += 1
+            return
+
+    # —— 消费端 —— #
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"ltm-extract-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _next_locked(self) -> Optional[Tuple[Tuple[str, str], _Job, List[Tuple[str, str, float]]]]:
+        """取最早可处理的会话；返回 None 表示暂时没有（需等待）。"""
+        now = time.time()
+        for key, job in self._jobs.items():
+            if key in self._busy:
+                continue
+            if not self._closing and now - job.turns[0][2] < self.coalesce_window \
+                    and len(job.turns) < self.batch_turns:
+                continue
+            turns, job.turns = job.turns[:self.batch_turns], job.turns[self.batch_turns:]
+            if not job.turns:
+                del self._jobs[key]
+            self._depth -= len(turns)
+            self._busy.add(key)
+            return key, job, turns
+        return None
+
+    def _wait_time_locked(self) -> Optional[float]:
+        waiting = [job.turns[0][2] for key, job in self._jobs.items() if key not in self._busy]
+        if not waiting:
+            return None
+        return max(0.01, min(waiting) + self.coalesce_window - time.time())
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                item = self._next_locked()
+                while item is None:
+                    if self._closing and not self._jobs:
+                        return
+                    self._cond.wait(self._wait_time_locked())
+                    item = self._next_locked()
+                self._cond.notify_all()  # 腾出了容量，唤醒阻塞中的生产者
+            key, job, turns = item
+            try:
+                self._run(job.llm, job.ltm, key[0], key[1], job.role_name, turns)
+            finally:
+                with self._cond:
+                    self._busy.discard(key)
+                    self._cond.notify_all()
+
+    def _run(self, llm, ltm: LTMStore, session_id: str, role_id: str, role_name: str,
+             turns: List[Tuple[str, str, float]]):
+        lag = time.time() - turns[0][2]
+        try:
+            with span("facts.extract"):
+                facts = extract_facts_batch(llm, role_name, [(u, r) for u, r, _ in turns])
+            with span("ltm.insert"):
+                ltm.insert_many(session_id=session_id, role_id=role_id, facts=facts)
+        except Exception as e:
+            print(f"⚠️ 长期记忆抽取失败（{session_id}，{len(turns)} 轮）：{e}")
+            with self._cond:
+                self.failed += len(turns)
+            return
+        record_size("facts.batch_turns", len(turns))
+        record_size("facts.extracted", len(facts))
+        METRICS.timing("facts.lag", lag * 1000)
+        with self._cond:
+            self.processed += len(turns)
+            self.batches += 1
+            self.facts += len(facts)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    # —— 管理 —— #
+    def drain(self, timeout: Optional[float] = DEFAULT_DRAIN_TIMEOUT) -> bool:
+        """停止接收新任务，等待积压与进行中的抽取完成；返回是否在超时前清空。"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        deadline = None if timeout is None else time.time() + timeout
+        for t in threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.time()))
+        with self._cond:
+            left = self._depth + len(self._busy)
+        if left:
+            print(f"⚠️ 长期记忆队列未清空即退出：剩余 {left} 项")
+        return left == 0
+
+    def stats(self) -> Dict:
+        with self._cond:
+            now = time.time()
+            oldest = min((job.turns[0][2] for job in self._jobs.values()), default=None)
+            return {
+                "depth": self._depth,
+                "sessions": len(self._jobs),
+                "in_flight": len(self._busy),
+                "lag": round(now - oldest, 3) if oldest is not None else 0.0,
+                "last_lag": round(self.last_lag, 3),
+                "max_lag": round(self.max_lag, 3),
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "batches": self.batches,
+                "facts": self.facts,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "policy": self.policy,
+            }
+
+
+FACT_QUEUE = FactExtractionQueue()
+atexit.register(FACT_QUEUE.drain)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+import asyncio, hashlib, json, random, re, threading, time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from backend.prompt_budget import count_tokens
+
+# 离线替身：行为近似 ChatOpenAI(stream_usage=True)，供基准与无 key 联调使用
+# 用法：RoleChatEngine(..., llm=FakeChatModel(ttft=0.3, tokens_per_sec=40, error_rate=0.01))
+
+_LINES = [
+    "（他垂眸看了你一眼）", "你又来做什么？", "这世间的事，本就没有两全。", "我记得。",
+    "（指尖拂过衣袖上的血迹）", "别多问。", "九命相柳，从不欠人情。", "海上的风大，回去吧。",
+    "你若想活，就听我的。", "（沉默片刻，转过身去）", "那一日的事，不必再提。", "我自有分寸。",
+]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    ttft：首 token 前的等待（秒），另加 [0, jitter) 随机抖动；tokens_per_sec：之后的输出速率（0 = 不限速）；
+    reply_tokens：每次回复的 token 数（按中文 1 字 1 token）；error_rate：每次请求按概率在首 token 前抛错。
+    回复由 prompt 哈希决定（同输入同输出）；长期记忆抽取类 prompt（要求输出 JSON 数组）返回可解析的事实列表。
+    calls / errors：统计计数。
+    """
+
+    ttft: float = 0.0
+    tokens_per_sec: float = 0.0
+    reply_tokens: int = 60
+    error_rate: float = 0.0
+    jitter: float = 0.0
+    seed: int = 0
+
+    _rnd: random.Random = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _counts: Dict[str, int] = PrivateAttr(default_factory=lambda: {"calls": 0, "errors": 0})
+
+    def model_post_init(self, __context: Any) -> None:
+        self._rnd = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "papersoul-fake-chat"
+
+    @property
+    def calls(self) -> int:
+        return self._counts["calls"]
+
+    @property
+    def errors(self) -> int:
+        return self._counts["errors"]
+
+    # —— 内容 —— #
+    def _reply(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = str(messages[-1].content) if messages else ""
+        rnd = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        if "JSON数组" in prompt:
+            asked = re.findall(r"\[用户提问\](.+)", prompt)
+            facts = [f"用户曾问起：{q.strip()[:30]}" for q in asked[:rnd.randint(0, 2)]]
+            return [json.dumps(facts, ensure_ascii=False)]
+        text = ""
+        while len(text) < self.reply_tokens:
+            text += rnd.choice(_LINES)
+        return list(text[:self.reply_tokens])
+
+    def _usage(self, messages: List[BaseMessage], pieces: List[str]) -> Dict[str, int]:
+        n_in = sum(count_tokens(str(m.content)) for m in messages)
+        n_out = sum(count_tokens(p) for p in pieces)
+        return {"input_tokens": n_in, "output_tokens": n_out, "total_tokens": n_in + n_out}
+
+    def _begin(self) -> float:
+        """计数并决定本次是否失败，返回首 token 前应等待的秒数。"""
+        with self._lock:
+            self._counts["calls"] += 1
+            fail = self._rnd.random() < self.error_rate
+            jitter = self._rnd.uniform(0, self.jitter) if self.jitter else 0.0
+            if fail:
+                self._counts["errors"] += 1
+        if fail:
+            raise RuntimeError("fake chat: injected error")
+        return self.ttft + jitter
+
+    @property
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+    # —— LangChain 接口 —— #
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        wait = self._begin()
+        pieces = self._reply(messages)
+        time.sleep(wait + self._token_delay * len(pieces))
+        msg = AIMessage(content="".join(pieces), usage_metadata=self._usage(messages, pieces))
+        return ChatResult(generations=[ChatGeneration(message=msg)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        wait = self._begin()
+        pieces = self._reply(messages)
+        await asyncio.sleep(wait + self._token_delay * len(pieces))
+        msg = AIMessage(content="".join(pieces), usage_metadata=self._usage(messages, pieces))
+        return ChatResult(generations=[ChatGeneration(message=msg)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._begin())
+        pieces = self._reply(messages)
+        for i, piece in enumerate(pieces):
+            if i and self._token_delay:
+                time.sleep(self._token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+        # 与 stream_usage=True 一致：最后一个空块携带用量
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, pieces)))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._begin())
+        pieces = self._reply(messages)
+        for i, piece in enumerate(pieces):
+            if i and self._token_delay:
+                await asyncio.sleep(self._token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, pieces)))
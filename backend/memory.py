@@ -1,10 +1,15 @@
 import os
 import json
+import asyncio
 import sqlite3
 import time
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from pathlib import Path
 
+from backend.db import get_pool
+from backend.tracing import span
+from backend.tokenizer import cjk_bigram_tokenize
+
 BASE_DIR = Path(__file__).resolve().parents[1]
 
 SCHEMA = {
@@ -26,17 +31,89 @@ SCHEMA = {
             created_at INTEGER
         );
     """,
+    # [NEW] 每个会话的下一个消息序号，写入时直接取用，不再 MAX(idx) 扫描
+    "msg_seq": """
+        CREATE TABLE IF NOT EXISTS msg_seq(
+            session_id TEXT PRIMARY KEY,
+            next_idx INTEGER NOT NULL
+        );
+    """,
+    # [NEW] 滚动摘要：idx < upto_idx 的旧消息已压缩进 summary
+    "summaries": """
+        CREATE TABLE IF NOT EXISTS summaries(
+            session_id TEXT PRIMARY KEY,
+            upto_idx INTEGER NOT NULL,
+            summary TEXT,
+            updated_at INTEGER
+        );
+    """,
     "ltm": """
         CREATE TABLE IF NOT EXISTS ltm(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             session_id TEXT,
             role_id TEXT,
             fact TEXT,
-            created_at INTEGER
+            created_at INTEGER,
+            terms TEXT
         );
     """,
 }
 
+# [NEW] 长期记忆全文索引：ltm.terms 存事实的二元组分词（空格分隔），FTS5 以外部内容表方式镜像，触发器保持同步。
+# 不直接用 trigram 分词器：它匹配不到“相柳”这类两字专名。
+LTM_FTS = {
+    "ltm_fts": """
+        CREATE VIRTUAL TABLE IF NOT EXISTS ltm_fts USING fts5(
+            terms, content='ltm', content_rowid='id', tokenize='unicode61'
+        );
+    """,
+    "ltm_fts_ai": """
+        CREATE TRIGGER IF NOT EXISTS ltm_fts_ai AFTER INSERT ON ltm BEGIN
+            INSERT INTO ltm_fts(rowid, terms) VALUES (new.id, new.terms);
+        END;
+    """,
+    "ltm_fts_ad": """
+        CREATE TRIGGER IF NOT EXISTS ltm_fts_ad AFTER DELETE ON ltm BEGIN
+            INSERT INTO ltm_fts(ltm_fts, rowid, terms) VALUES ('delete', old.id, old.terms);
+        END;
+    """,
+    "ltm_fts_au": """
+        CREATE TRIGGER IF NOT EXISTS ltm_fts_au AFTER UPDATE ON ltm BEGIN
+            INSERT INTO ltm_fts(ltm_fts, rowid, terms) VALUES ('delete', old.id, old.terms);
+            INSERT INTO ltm_fts(rowid, terms) VALUES (new.id, new.terms);
+        END;
+    """,
+}
+
+# 召回排序 = bm25 / (1 + 事实年龄 / LTM_RECENCY_HALFLIFE)：越新的事实相关度折损越少
+LTM_RECENCY_HALFLIFE = float(os.getenv("LTM_RECENCY_HALFLIFE", str(7 * 86400)))
+LTM_MAX_QUERY_TERMS = 32
+
+def fact_terms(text: str) -> str:
+    return " ".join(cjk_bigram_tokenize(text))
+
+def _fts_query(text: str) -> str:
+    terms = list(dict.fromkeys(cjk_bigram_tokenize(text)))[:LTM_MAX_QUERY_TERMS]
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def _migrate_ltm(conn: sqlite3.Connection):
+    """旧库迁移：补 terms 列并回填，建 FTS 表与触发器，首次建表时全量重建索引。"""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(ltm)")}
+    if "terms" not in cols:
+        conn.execute("ALTER TABLE ltm ADD COLUMN terms TEXT")
+    rows = conn.execute("SELECT id,fact FROM ltm WHERE terms IS NULL").fetchall()
+    if rows:
+        conn.executemany("UPDATE ltm SET terms=? WHERE id=?", [(fact_terms(f or ""), i) for i, f in rows])
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name='ltm_fts'").fetchone()
+    try:
+        for ddl in LTM_FTS.values():
+            conn.execute(ddl)
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ 当前 SQLite 不支持 FTS5，长期记忆回退为逐条扫描：{e}")
+        return
+    if not existed:
+        conn.execute("INSERT INTO ltm_fts(ltm_fts) VALUES ('rebuild')")
+
 def ensure_db(db_path: str):
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     with sqlite3.connect(db_path) as conn:
@@ -46,89 +123,212 @@ def ensure_db(db_path: str):
         cur.execute("PRAGMA journal_mode=WAL;")
         cur.execute("PRAGMA synchronous=NORMAL;")
         cur.execute("PRAGMA temp_store=MEMORY;")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_sid ON messages(session_id, idx);")
+        try:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_msg_sid_idx ON messages(session_id, idx);")
+            cur.execute("DROP INDEX IF EXISTS idx_msg_sid;")
+        except sqlite3.IntegrityError:
+            # 旧库里并发写出过重复序号：保留普通索引，新写入仍由 msg_seq 保证递增
+            print("⚠️ messages 存在重复 (session_id, idx)，未能建立唯一索引")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_sid ON messages(session_id, idx);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_ltm_sid ON ltm(session_id, role_id, created_at);")
+        _migrate_ltm(conn)
         conn.commit()
 
 class SessionStore:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._db = get_pool(db_path)
     def create_session(self, name: str, role_id: str,book_id: str) -> str:
         sid = str(int(time.time()*1000))
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("INSERT INTO sessions(id,name,role_id,created_at) VALUES(?,?,?,?)",
-                         (sid, name, role_id, int(time.time())))
-            conn.commit()
+        with self._db.write() as conn:
+            conn.execute("INSERT INTO sessions(id,name,role_id,book_id,created_at) VALUES(?,?,?,?,?)",
+                         (sid, name, role_id, book_id, int(time.time())))
         return sid
     def list_sessions(self) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT id,name,role_id,created_at FROM sessions ORDER BY created_at DESC")
-            rows = cur.fetchall()
-            return [ {"id": r[0], "name": r[1], "role_id": r[2], "created_at": r[3]}
-                     for r in rows
-                ]
+        cur = self._db.connection().execute("SELECT id,name,role_id,created_at FROM sessions ORDER BY created_at DESC")
+        rows = cur.fetchall()
+        return [ {"id": r[0], "name": r[1], "role_id": r[2], "created_at": r[3]}
+                 for r in rows
+            ]
 
     def load_history(self, session_id: str) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT role,content FROM messages WHERE session_id=? ORDER BY idx ASC", (session_id,))
-            return [ {"role": r[0], "content": r[1]} for r in cur.fetchall() ]
+        cur = self._db.connection().execute(
+            "SELECT role,content FROM messages WHERE session_id=? ORDER BY idx ASC", (session_id,))
+        return [ {"role": r[0], "content": r[1]} for r in cur.fetchall() ]
+
+    def load_recent(self, session_id: str, limit: int) -> List[Dict]:
+        """最近 limit 条消息（按时间正序），走 (session_id, idx) 索引倒序扫描。"""
+        with span("sql.load_recent"):
+            cur = self._db.connection().execute(
+                "SELECT role,content FROM messages WHERE session_id=? ORDER BY idx DESC LIMIT ?", (session_id, limit))
+            return [ {"role": r[0], "content": r[1]} for r in reversed(cur.fetchall()) ]
+
+    def load_range(self, session_id: str, start: int, end: int) -> List[Dict]:
+        """idx ∈ [start, end) 的消息。"""
+        cur = self._db.connection().execute(
+            "SELECT role,content FROM messages WHERE session_id=? AND idx>=? AND idx<? ORDER BY idx ASC",
+            (session_id, start, end))
+        return [ {"role": r[0], "content": r[1]} for r in cur.fetchall() ]
+
+    def next_idx(self, session_id: str) -> int:
+        conn = self._db.connection()
+        row = conn.execute("SELECT next_idx FROM msg_seq WHERE session_id=?", (session_id,)).fetchone()
+        if row:
+            return row[0]
+        return conn.execute("SELECT COALESCE(MAX(idx), -1) + 1 FROM messages WHERE session_id=?",
+                            (session_id,)).fetchone()[0]
+
+    def load_summary(self, session_id: str) -> Tuple[int, str]:
+        with span("sql.load_summary"):
+            row = self._db.connection().execute(
+                "SELECT upto_idx,summary FROM summaries WHERE session_id=?", (session_id,)).fetchone()
+        return (row[0], row[1] or "") if row else (0, "")
+
+    def save_summary(self, session_id: str, upto_idx: int, summary: str):
+        with self._db.write() as conn:
+            conn.execute("INSERT OR REPLACE INTO summaries(session_id,upto_idx,summary,updated_at) VALUES(?,?,?,?)",
+                         (session_id, upto_idx, summary, int(time.time())))
+
+    @staticmethod
+    def _reserve_idx(conn: sqlite3.Connection, session_id: str, n: int) -> int:
+        """在写事务内预留 n 个连续序号，返回第一个；旧会话首次写入时由已有消息推出起点。"""
+        conn.execute("INSERT OR IGNORE INTO msg_seq(session_id,next_idx) "
+                     "SELECT ?, COALESCE(MAX(idx), -1) + 1 FROM messages WHERE session_id=?",
+                     (session_id, session_id))
+        start = conn.execute("SELECT next_idx FROM msg_seq WHERE session_id=?", (session_id,)).fetchone()[0]
+        conn.execute("UPDATE msg_seq SET next_idx=? WHERE session_id=?", (start + n, session_id))
+        return start
+
+    def append_messages(self, session_id: str, messages: List[Tuple[str, str]]):
+        """[(role, content), ...] 在同一个事务里按顺序写入。"""
+        if not messages:
+            return
+        now = int(time.time())
+        with span("sql.append_messages"), self._db.write() as conn:
+            start = self._reserve_idx(conn, session_id, len(messages))
+            conn.executemany("INSERT INTO messages(session_id,idx,role,content,created_at) VALUES(?,?,?,?,?)",
+                             [(session_id, start + i, role, content, now)
+                              for i, (role, content) in enumerate(messages)])
     def append_message(self, session_id: str, role: str, content: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT COALESCE(MAX(idx), -1) FROM messages WHERE session_id=?", (session_id,))
-            max_idx = cur.fetchone()[0]
-            conn.execute("INSERT INTO messages(session_id,idx,role,content,created_at) VALUES(?,?,?,?,?)",
-                         (session_id, max_idx+1, role, content, int(time.time())))
-            conn.commit()
+        self.append_messages(session_id, [(role, content)])
+    def append_turn(self, session_id: str, user_text: str, reply: str):
+        """一轮对话（用户 + 角色）一次提交。"""
+        self.append_messages(session_id, [("user", user_text), ("assistant", reply)])
     def clear_history(self, session_id: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._db.write() as conn:
             conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
-            conn.commit()
+            conn.execute("DELETE FROM msg_seq WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM summaries WHERE session_id=?", (session_id,))
     def delete_session(self, session_id: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._db.write() as conn:
             conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM msg_seq WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM summaries WHERE session_id=?", (session_id,))
             conn.execute("DELETE FROM ltm WHERE session_id=?", (session_id,))
             conn.execute("DELETE FROM sessions WHERE id=?", (session_id,))
-            conn.commit()
     def export_json(self, session_id: str) -> str:
         data = {"session": None, "messages": self.load_history(session_id), "ltm": []}
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT id,name,role_id,created_at FROM sessions WHERE id=?", (session_id,))
-            row = cur.fetchone()
-            if row:
-                data["session"] = {"id": row[0], "name": row[1], "role_id": row[2], "book_id": row[3],"created_at": row[4]}
-            cur = conn.execute("SELECT fact,created_at FROM ltm WHERE session_id=? ORDER BY created_at DESC", (session_id,))
-            data["ltm"] = [ {"fact": r[0], "created_at": r[1]} for r in cur.fetchall() ]
+        conn = self._db.connection()
+        cur = conn.execute("SELECT id,name,role_id,book_id,created_at FROM sessions WHERE id=?", (session_id,))
+        row = cur.fetchone()
+        if row:
+            data["session"] = {"id": row[0], "name": row[1], "role_id": row[2], "book_id": row[3],"created_at": row[4]}
+        cur = conn.execute("SELECT fact,created_at FROM ltm WHERE session_id=? ORDER BY created_at DESC", (session_id,))
+        data["ltm"] = [ {"fact": r[0], "created_at": r[1]} for r in cur.fetchall() ]
         path = os.path.join("data", "sessions", f"session_{session_id}.json")
         with open(path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
         return path
 
+    # —— 异步版本：SQLite 调用放到线程里，不阻塞事件循环 —— #
+    async def aload_history(self, session_id: str) -> List[Dict]:
+        return await asyncio.to_thread(self.load_history, session_id)
+
+    async def aappend_message(self, session_id: str, role: str, content: str):
+        return await asyncio.to_thread(self.append_message, session_id, role, content)
+
+    async def aappend_turn(self, session_id: str, user_text: str, reply: str):
+        return await asyncio.to_thread(self.append_turn, session_id, user_text, reply)
+
 class LTMStore:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._db = get_pool(db_path)
+        self._fts = None
+
+    def _has_fts(self, conn: sqlite3.Connection) -> bool:
+        if self._fts is None:
+            self._fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='ltm_fts'").fetchone() is not None
+        return self._fts
+
     def insert(self, session_id: str, role_id: str, fact: str):
         if not fact.strip():
             return
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("INSERT INTO ltm(session_id,role_id,fact,created_at) VALUES(?,?,?,?)",
-                         (session_id, role_id, fact.strip(), int(time.time())))
-            conn.commit()
+        self.insert_many(session_id, role_id, [fact])
+
+    def insert_many(self, session_id: str, role_id: str, facts: List[str]):
+        """批量写入：一次事务。"""
+        now = int(time.time())
+        rows = [(session_id, role_id, f.strip(), now, fact_terms(f)) for f in facts if f and f.strip()]
+        if not rows:
+            return
+        with self._db.write() as conn:
+            conn.executemany("INSERT INTO ltm(session_id,role_id,fact,created_at,terms) VALUES(?,?,?,?,?)", rows)
+
+    def has_facts(self, session_id: str, role_id: str) -> bool:
+        return self._db.connection().execute(
+            "SELECT 1 FROM ltm WHERE session_id=? AND role_id=? LIMIT 1", (session_id, role_id)).fetchone() is not None
 
     def retrieve(self, session_id: str, role_id: str, query: str, top_k: int = 3) -> List[str]:
-        terms = [t for t in query.split() if len(t) >= 2][:5]
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute("SELECT fact,created_at FROM ltm WHERE session_id=? AND role_id=? ORDER BY created_at DESC",
-                               (session_id, role_id))
-            rows = cur.fetchall()
+        """FTS5 bm25 + 时间衰减排序；命中不足 top_k 时用最新事实补齐（与旧行为一致）。"""
+        match = _fts_query(query)
+        conn = self._db.connection()
+        if not self._has_fts(conn):
+            return self._retrieve_scan(conn, session_id, role_id, query, top_k)
+        hits: List[str] = []
+        if match:
+            cur = conn.execute("""
+                SELECT l.fact FROM ltm_fts JOIN ltm l ON l.id = ltm_fts.rowid
+                WHERE ltm_fts MATCH ? AND l.session_id=? AND l.role_id=?
+                ORDER BY bm25(ltm_fts) / (1.0 + (? - l.created_at) / ?) ASC, l.id DESC
+                LIMIT ?
+            """, (match, session_id, role_id, int(time.time()), LTM_RECENCY_HALFLIFE, top_k))
+            hits = [r[0] for r in cur.fetchall()]
+        if len(hits) < top_k:
+            cur = conn.execute("SELECT fact FROM ltm WHERE session_id=? AND role_id=? "
+                               "ORDER BY created_at DESC, id DESC LIMIT ?",
+                               (session_id, role_id, top_k + len(hits)))
+            hits += [f for (f,) in cur.fetchall() if f not in hits][:top_k - len(hits)]
+        return hits
+
+    def _retrieve_scan(self, conn: sqlite3.Connection, session_id: str, role_id: str, query: str,
+                       top_k: int) -> List[str]:
+        # 无 FTS5 时的回退：逐条按二元组命中数打分
+        terms = set(cjk_bigram_tokenize(query))
+        cur = conn.execute("SELECT fact,created_at,terms FROM ltm WHERE session_id=? AND role_id=? "
+                           "ORDER BY created_at DESC", (session_id, role_id))
         scored = []
-        for fact, ts in rows:
-            score = sum(1 for t in terms if t in fact)
+        for fact, ts, fterms in cur.fetchall():
+            score = len(terms & set((fterms or fact_terms(fact)).split()))
             scored.append((score, ts, fact))
         scored.sort(key=lambda x: (x[0], x[1]), reverse=True)
         return [f for _,__,f in scored[:top_k]]
 
-def extract_facts(llm, role_name: str, history: List[Dict], user_text: str, reply: str) -> List[str]:
-    prompt = f"""
+    async def ainsert(self, session_id: str, role_id: str, fact: str):
+        return await asyncio.to_thread(self.insert, session_id, role_id, fact)
+
+    async def aretrieve(self, session_id: str, role_id: str, query: str, top_k: int = 3) -> List[str]:
+        return await asyncio.to_thread(self.retrieve, session_id, role_id, query, top_k)
+
+def create_ltm_store(db_path: str) -> LTMStore:
+    """LTM_MODE=semantic 时使用向量版长期记忆（需要 Ark embeddings），默认 FTS 版。"""
+    if os.getenv("LTM_MODE", "fts").lower() == "semantic":
+        from backend.semantic_memory import SemanticLTMStore
+        return SemanticLTMStore(db_path)
+    return LTMStore(db_path)
+
+def _facts_prompt(role_name: str, user_text: str, reply: str) -> str:
+    return f"""
 请基于以下对话，提取1-3条**简短、稳定**的事实（用于长期记忆）。
 要求：
 - 不包含具体对话措辞；
@@ -141,11 +341,55 @@ def extract_facts(llm, role_name: str, history: List[Dict], user_text: str, repl
 [角色回复]{reply}
 输出JSON数组，如：["事实1","事实2"]
 """.strip()
+
+def _batch_facts_prompt(role_name: str, turns: List[Tuple[str, str]]) -> str:
+    dialog = "\n".join(f"[用户提问]{u}\n[角色回复]{r}" for u, r in turns)
+    return f"""
+请基于以下{len(turns)}轮对话，提取1-{3 * len(turns)}条**简短、稳定**的事实（用于长期记忆）。
+要求：
+- 不包含具体对话措辞；
+- 只保留与关系/身份/目标/承诺/立场相关的陈述句；
+- 多轮中重复或被后文推翻的内容只保留最新的一条；
+- 15~50字/条；
+- 若无可用事实则返回空。
+
+[角色]{role_name}
+{dialog}
+输出JSON数组，如：["事实1","事实2"]
+""".strip()
+
+def _parse_facts(content: str, limit: int = 3) -> List[str]:
     try:
-        content = llm.invoke([{"role": "user", "content": prompt}]).content
         data = json.loads(content)
         if isinstance(data, list):
-            return [str(x) for x in data][:3]
+            return [str(x) for x in data][:limit]
     except Exception:
         pass
     return []
+
+def extract_facts(llm, role_name: str, history: List[Dict], user_text: str, reply: str) -> List[str]:
+    prompt = _facts_prompt(role_name, user_text, reply)
+    try:
+        content = llm.invoke([{"role": "user", "content": prompt}]).content
+    except Exception:
+        return []
+    return _parse_facts(content)
+
+def extract_facts_batch(llm, role_name: str, turns: List[Tuple[str, str]]) -> List[str]:
+    """同一会话的多轮 (user_text, reply) 合并成一次抽取调用；LLM 调用失败直接抛出，由调用方计入失败。"""
+    if not turns:
+        return []
+    if len(turns) == 1:
+        prompt = _facts_prompt(role_name, turns[0][0], turns[0][1])
+    else:
+        prompt = _batch_facts_prompt(role_name, turns)
+    content = llm.invoke([{"role": "user", "content": prompt}]).content
+    return _parse_facts(content, limit=3 * len(turns))
+
+async def aextract_facts(llm, role_name: str, history: List[Dict], user_text: str, reply: str) -> List[str]:
+    prompt = _facts_prompt(role_name, user_text, reply)
+    try:
+        content = (await llm.ainvoke([{"role": "user", "content": prompt}])).content
+    except Exception:
+        return []
+    return _parse_facts(content)
@@ -0,0 +1,130 @@
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Tuple
+
+# Prompt token 预算：按优先级（角色卡 > 近期对话 > 原文证据 > 长期记忆）在总预算内装填
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2500"))
+EVIDENCE_TOKEN_BUDGET = int(os.getenv("EVIDENCE_TOKEN_BUDGET", "2000"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "400"))
+TOKENIZER_MODEL = os.getenv("PROMPT_TOKENIZER_MODEL", "gpt-4o")
+MESSAGE_OVERHEAD = 4   # 每条 chat 消息的角色/分隔符开销（OpenAI 计费口径的近似）
+
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿　-〿＀-￯]")
+
+
+@lru_cache(maxsize=1)
+def _encoder():
+    try:
+        import tiktoken
+    except ImportError:
+        print("⚠️ 未安装 tiktoken，token 数按字符估算")
+        return None
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception as e:  # 离线环境下拿不到词表
+            print(f"⚠️ tiktoken 词表不可用，token 数按字符估算：{type(e).__name__}")
+            return None
+
+
+def count_tokens(text: str) -> int:
+    """本地计数：优先 tiktoken；不可用时中文按 1 字 1 token、其余按 4 字符 1 token 估算（偏保守）。"""
+    if not text:
+        return 0
+    enc = _encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+
+class PromptPlan(NamedTuple):
+    history: List[Dict]        # 保留的近期对话（时间正序）
+    evidence: List[str]        # 保留的原文证据（按检索排名）
+    memory: List[str]          # 保留的长期记忆
+    summary: str               # 前情提要（窗口外旧对话的滚动摘要）
+    dropped_history: int       # 因预算被挤出窗口的历史消息条数
+    tokens: Dict[str, int]     # 各部分 token 数，便于观测
+    overflow: int = 0          # 超出近期对话上限、因尚未摘要而额外保留的消息条数
+
+    @property
+    def window(self) -> int:
+        """近期对话上限内的消息条数：前情提要据此决定并入到哪里。"""
+        return len(self.history) - self.overflow
+
+
+class PromptBudgeter:
+    """
+    固定部分（角色卡、本轮用户输入）先扣除，其余按优先级装填：
+    - 近期对话：从最新往前按“轮”整体保留，放不下即停（保持连续）；前情提要与之共享额度，
+      已并入前情提要的消息（开头 summarized 条）不再原样放入；尚未摘要的消息优先于原文证据，
+      超出近期对话上限时占用后面各部分的额度，只有总额度也放不下才被挤出窗口；
+    - 原文证据 / 长期记忆：按排名依次放入，单条放不下则跳过、继续尝试后面更短的；
+    每部分不超过各自上限，前面没用完的额度顺延给后面。
+    """
+
+    def __init__(self, total: int = PROMPT_TOKEN_BUDGET, history: int = HISTORY_TOKEN_BUDGET,
+                 evidence: int = EVIDENCE_TOKEN_BUDGET, memory: int = MEMORY_TOKEN_BUDGET):
+        self.total = total
+        self.history_cap = history
+        self.evidence_cap = evidence
+        self.memory_cap = memory
+
+    @staticmethod
+    def _fill(items: List[str], budget: int) -> Tuple[List[str], int]:
+        kept, used = [], 0
+        for text in items:
+            n = count_tokens(text) + 2  # 段落分隔
+            if used + n <= budget:
+                kept.append(text)
+                used += n
+        return kept, used
+
+    def plan(self, fixed_tokens: int, history: List[Dict], evidence: List[str], memory: List[str],
+             summary: str = "", summarized: int = 0) -> PromptPlan:
+        left = max(0, self.total - fixed_tokens)
+        tokens = {"fixed": fixed_tokens}
+
+        # 1) 近期对话（含前情提要）
+        cap = min(left, self.history_cap)
+        summary_tokens = count_tokens(summary)
+        hard = left  # 未摘要的消息可用到的额度上限
+        if summary_tokens > cap // 2:
+            # 提要放不下：它覆盖的消息也就不算“已摘要”，照常按上限取舍
+            summary, summary_tokens, summarized, hard = "", 0, 0, cap
+        summarized = min(max(0, summarized), len(history))
+        used = summary_tokens
+        start = soft = len(history)
+        i = len(history)
+        while i > summarized:
+            # 以“用户 + 回复”为一轮整体取舍；开头落单的消息单独算
+            j = i - 2 if i >= 2 and history[i - 2]["role"] == "user" else i - 1
+            j = max(j, summarized)
+            n = sum(message_tokens(m["content"]) for m in history[j:i])
+            if used + n > hard:
+                break
+            used += n
+            start = i = j
+            if used <= cap:
+                soft = j
+        tokens["history"] = used
+        left -= used
+
+        # 2) 原文证据
+        ev, used = self._fill(evidence, min(left, self.evidence_cap))
+        tokens["evidence"] = used
+        left -= used
+
+        # 3) 长期记忆
+        mem, used = self._fill(memory, min(left, self.memory_cap))
+        tokens["memory"] = used
+        tokens["total"] = sum(tokens.values())
+        return PromptPlan(history[start:], ev, mem, summary, start, tokens, soft - start)
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.db import get_pool
+from ingest.embedding_cache import normalize_text
+
+# 回复缓存（默认关闭）：RESPONSE_CACHE=exact 只做精确匹配，=semantic 另加向量相似匹配
+RESPONSE_CACHE_MODE = os.getenv("RESPONSE_CACHE", "off").lower()
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 86400)))
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", "5000"))
+RESPONSE_CACHE_SIM = float(os.getenv("RESPONSE_CACHE_SIM", "0.95"))
+# 1 = 有历史的会话也可命中：键里带上最近一轮对话的指纹（命中率低，但不会答非所问）
+RESPONSE_CACHE_HISTORY = os.getenv("RESPONSE_CACHE_HISTORY", "0") == "1"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS response_cache(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE,
+        card_id TEXT,
+        fingerprint TEXT,
+        text TEXT,
+        reply TEXT,
+        vec BLOB,
+        created_at INTEGER,
+        last_hit INTEGER,
+        hits INTEGER DEFAULT 0
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_resp_card ON response_cache(card_id, fingerprint);",
+    "CREATE INDEX IF NOT EXISTS idx_resp_lru ON response_cache(last_hit);",
+]
+
+_TRAILING_PUNCT = re.compile(r"[\s。．.！!？?～~…,，、]+$")
+
+
+def normalize_query(text: str) -> str:
+    """NFKC + 折叠空白 + 小写 + 去掉句末标点：“你是谁？”与“你是谁”视为同一句。"""
+    return _TRAILING_PUNCT.sub("", normalize_text(text).lower())
+
+
+def history_fingerprint(history: List[Dict]) -> str:
+    if not history:
+        return ""
+    h = hashlib.sha1()
+    for m in history[-2:]:
+        h.update(m["role"].encode("utf-8"))
+        h.update(b"\x00")
+        h.update(normalize_text(m["content"]).encode("utf-8"))
+        h.update(b"\x01")
+    return h.hexdigest()
+
+
+def _key(card_id: str, text: str, fingerprint: str) -> str:
+    return hashlib.sha1(f"{card_id}\x00{fingerprint}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    键为 (card_id, 归一化用户输入, 历史指纹)，存 SQLite：
+    - lookup：先精确匹配；semantic 模式下再与同角色同指纹的缓存问题做余弦相似度比对；
+    - put：写入后按 last_hit 做 LRU，超过 max_entries 的最旧条目删除；过期（ttl）条目查询时忽略、写入时清理；
+    - 相似匹配用的向量按 (card_id, fingerprint) 在内存里常驻，写入/淘汰后失效重建。
+    """
+
+    def __init__(self, db_path: str, mode: str = RESPONSE_CACHE_MODE, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX, sim_threshold: float = RESPONSE_CACHE_SIM,
+                 embeddings=None):
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.sim_threshold = sim_threshold
+        self._embeddings = embeddings
+        self._db = get_pool(db_path)
+        self._lock = threading.Lock()
+        self._vectors: Dict[Tuple[str, str], Tuple[List[int], np.ndarray, Optional[np.ndarray]]] = {}
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        with self._db.write() as conn:
+            for ddl in SCHEMA:
+                conn.execute(ddl)
+
+    @property
+    def semantic(self) -> bool:
+        return self.mode == "semantic"
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            from ingest.ark_embeddings import ArkEmbeddings
+            model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")
+            self._embeddings = ArkEmbeddings(model=model, batch_size=32)
+        return self._embeddings
+
+    def _embed(self, text: str) -> np.ndarray:
+        v = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        return v / max(float(np.linalg.norm(v)), 1e-12)
+
+    def _group_vectors(self, card_id: str, fingerprint: str) -> Tuple[List[int], np.ndarray, Optional[np.ndarray]]:
+        """返回 (ids, created_at, mat)；created_at 随向量常驻，查询时按 ttl 过滤。"""
+        with self._lock:
+            hit = self._vectors.get((card_id, fingerprint))
+        if hit is not None:
+            return hit
+        rows = self._db.connection().execute(
+            "SELECT id,created_at,vec FROM response_cache WHERE card_id=? AND fingerprint=? AND vec IS NOT NULL",
+            (card_id, fingerprint)).fetchall()
+        ids = [r[0] for r in rows]
+        created = np.asarray([r[1] for r in rows], dtype=np.int64)
+        mat = np.stack([np.frombuffer(r[2], dtype=np.float16) for r in rows]).astype(np.float32) if rows else None
+        with self._lock:
+            self._vectors[(card_id, fingerprint)] = (ids, created, mat)
+        return ids, created, mat
+
+    def _invalidate_vectors(self, card_id: Optional[str] = None):
+        with self._lock:
+            if card_id is None:
+                self._vectors.clear()
+            else:
+                for k in [k for k in self._vectors if k[0] == card_id]:
+                    del self._vectors[k]
+
+    def lookup(self, card_id: str, user_text: str, fingerprint: str = "") -> Optional[str]:
+        text = normalize_query(user_text)
+        if not text:
+            return None
+        conn = self._db.connection()
+        fresh_after = int(time.time() - self.ttl)
+        row = conn.execute("SELECT id,reply FROM response_cache WHERE key=? AND created_at>=?",
+                           (_key(card_id, text, fingerprint), fresh_after)).fetchone()
+        semantic = False
+        ids, created, mat = [], None, None
+        if row is None and self.semantic:
+            ids, created, mat = self._group_vectors(card_id, fingerprint)
+        # 先按 ttl 过滤再取最相似：过期条目不能挡住稍差但仍新鲜的匹配；没有新鲜条目时不必向量化
+        fresh = created >= fresh_after if mat is not None else None
+        if fresh is not None and fresh.any():
+            try:
+                qv = self._embed(text)
+            except Exception as e:
+                print(f"⚠️ 回复缓存向量化失败，跳过相似匹配：{e}")
+                qv = None
+            if qv is not None and mat.shape[1] == qv.shape[0]:
+                sims = np.where(fresh, mat @ qv, -np.inf)
+                j = int(np.argmax(sims))
+                if sims[j] >= self.sim_threshold:
+                    row = conn.execute("SELECT id,reply FROM response_cache WHERE id=? AND created_at>=?",
+                                       (ids[j], fresh_after)).fetchone()
+                    semantic = row is not None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._db.write() as wconn:
+            wconn.execute("UPDATE response_cache SET hits=hits+1,last_hit=? WHERE id=?", (int(time.time()), row[0]))
+        with self._lock:
+            self.hits += 1
+            self.semantic_hits += int(semantic)
+        return row[1]
+
+    def put(self, card_id: str, user_text: str, reply: str, fingerprint: str = ""):
+        text = normalize_query(user_text)
+        if not text or not (reply or "").strip():
+            return
+        vec = None
+        if self.semantic:
+            try:
+                vec = self._embed(text).astype(np.float16).tobytes()
+            except Exception as e:
+                print(f"⚠️ 回复缓存向量化失败，仅精确匹配：{e}")
+        now = int(time.time())
+        with self._db.write() as conn:
+            conn.execute("INSERT OR REPLACE INTO response_cache(key,card_id,fingerprint,text,reply,vec,"
+                         "created_at,last_hit,hits) VALUES(?,?,?,?,?,?,?,?,0)",
+                         (_key(card_id, text, fingerprint), card_id, fingerprint, text, reply, vec, now, now))
+            evicted = conn.execute("DELETE FROM response_cache WHERE created_at<?", (int(now - self.ttl),)).rowcount
+            evicted += conn.execute("""
+                DELETE FROM response_cache WHERE id IN (
+                    SELECT id FROM response_cache ORDER BY last_hit DESC, id DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,)).rowcount
+        # 有淘汰时其它角色的向量也可能失效，全部重建；否则只重建本角色
+        self._invalidate_vectors(None if evicted else card_id)
+
+    def put_later(self, card_id: str, user_text: str, reply: str, fingerprint: str = ""):
+        """后台写入（semantic 模式要向量化），不拖慢回复结束。"""
+        self._writer.submit(self._put_quietly, card_id, user_text, reply, fingerprint)
+
+    def _put_quietly(self, *args):
+        try:
+            self.put(*args)
+        except Exception as e:
+            print(f"⚠️ 回复缓存写入失败：{e}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses}
+
+
+_caches: Dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(db_path: str) -> Optional[ResponseCache]:
+    """RESPONSE_CACHE=off（默认）时返回 None；同一数据库共用一个实例。"""
+    if RESPONSE_CACHE_MODE not in ("exact", "semantic"):
+        return None
+    key = os.path.abspath(db_path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResponseCache(db_path)
+        return cache
@@ -1,14 +1,75 @@
 from pathlib import Path
-from langchain_community.vectorstores import FAISS
-from langchain_community.retrievers import BM25Retriever
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import asyncio
+import contextvars
+import itertools
+import math
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from backend.bm25 import BM25Index
+from backend.chunk_store import ChunkStore
+from backend.tracing import record_size, span
+from backend.vector_index import TruncatedEmbeddings, load_index_meta, read_variant
 from ingest.ark_embeddings import ArkEmbeddings
 BASE = Path(__file__).resolve().parents[1]
 NOVELS_DIR = BASE / "data" / "novels"
 INDEXES_DIR = BASE / "data" / "indexes"
 
+# 向量检索（含远程 embedding）与 BM25 并发执行；超时的一路降级为空结果
+VECTOR_TIMEOUT = float(os.getenv("RETRIEVAL_VECTOR_TIMEOUT", "3.0"))
+BM25_TIMEOUT = float(os.getenv("RETRIEVAL_BM25_TIMEOUT", "1.0"))
+# [NEW] 检索来源（逗号分隔，按顺序优先）：chapters = 章节原文 chunk；role = 角色语料索引（python -m ingest.build_role_index）
+RETRIEVAL_SOURCES = os.getenv("RETRIEVAL_SOURCES", "chapters")
+# 角色语料过滤：speaker 白名单（逗号分隔，{role} 代表当前角色，空 = 不限）与最低置信度（0.5 = 排除判为“其他”的条目）
+ROLE_SPEAKERS = os.getenv("ROLE_SPEAKERS", "")
+ROLE_MIN_CONF = float(os.getenv("ROLE_MIN_CONF", "0.5"))
+# 有过滤时先多取若干倍候选再筛（再按可用比例放大）
+FILTER_OVERFETCH = int(os.getenv("RETRIEVAL_FILTER_OVERFETCH", "4"))
+SOURCES = ("chapters", "role")
+ROLE_INDEX_SUBDIR = "roles"
+ROLE_CORPUS_NAME = "ctx_with_speaker.jsonl"
+
+def role_index_dir(book_index_dir: Path, role: str) -> Path:
+    """角色索引放在章节索引目录下：data/indexes/<book>/roles/<role>/。"""
+    return Path(book_index_dir) / ROLE_INDEX_SUBDIR / role
+
+def _split_csv(value) -> Tuple[str, ...]:
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(x.strip() for x in value or () if x and x.strip())
+
+_LEG_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")),
+                               thread_name_prefix="retrieval-leg")
+
+def submit_leg(fn, *args, **kwargs) -> Future:
+    # 带上调用方的上下文，各路的 span 能记入当前回合的追踪
+    return _LEG_POOL.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def wait_leg(fut: Future, timeout: float, name: str, default=None):
+    """等待一路检索结果；超时或出错时返回 default，不阻塞整轮回复。"""
+    try:
+        return fut.result(timeout=timeout)
+    except FutureTimeout:
+        print(f"⚠️ {name} 超时（>{timeout:.2f}s），本轮降级")
+    except Exception as e:
+        print(f"⚠️ {name} 失败，本轮降级：{e}")
+    return [] if default is None else default
+
+async def await_leg(aw, timeout: float, name: str, default=None):
+    """wait_leg 的异步版本。"""
+    try:
+        return await asyncio.wait_for(aw, timeout=timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ {name} 超时（>{timeout:.2f}s），本轮降级")
+    except Exception as e:
+        print(f"⚠️ {name} 失败，本轮降级：{e}")
+    return [] if default is None else default
+
 # 合并两个检索结果列表，打分
 def rrf_merge(vec_docs, bm_docs, k=5):
     scores = {}
@@ -23,33 +84,239 @@ def rrf_merge(vec_docs, bm_docs, k=5):
     ranked = sorted(unique.values(), key=lambda d: scores[d.page_content], reverse=True)
     return ranked[:k]
 
+class _LoadedIndex(NamedTuple):
+    index: "faiss.Index"
+    chunks: ChunkStore
+    bm25: BM25Index
+    embeddings: object
+    allow: Optional[np.ndarray] = None  # 元数据过滤后的可用行（None = 全部可用）
+    overfetch: int = 1                  # 候选放大倍数：过滤越严取得越多，至多取全部
+
+def _fetch_k(loaded: _LoadedIndex, k: int) -> int:
+    return min(len(loaded.chunks), k * loaded.overfetch)
+
+def _allowed(loaded: _LoadedIndex, rows, k: int) -> List[int]:
+    return [int(i) for i in rows if i >= 0 and (loaded.allow is None or loaded.allow[i])][:k]
+
 class DemoRetriever:
-    def __init__(self, book_id:str,k: int = 5):
+    def __init__(self, book_id:str,k: int = 5, embeddings=None, index_dir: Optional[Path] = None,
+                 sources: Optional[Sequence[str]] = None, speakers: Optional[Sequence[str]] = None,
+                 min_conf: Optional[float] = None):
+        """
+        embeddings / index_dir 可注入（离线基准用假 embedding + 临时目录里的索引），默认 Ark + data/indexes/<book>。
+        sources：检索来源，默认 RETRIEVAL_SOURCES；含 role 时按查询传入的 role 加载角色索引，缺失则退回章节索引。
+        speakers / min_conf：角色索引的元数据过滤，默认 ROLE_SPEAKERS / ROLE_MIN_CONF。
+        """
         self.book_id = book_id
         self.k = k
-        ark_model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")  # [ADDED]
-        embeddings = ArkEmbeddings(model=ark_model, batch_size=32)
+        self.ark_model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")  # [ADDED]
+        self._embeddings = embeddings
+        self.index_dir = Path(index_dir) if index_dir else INDEXES_DIR / book_id
+        self.sources = _split_csv(RETRIEVAL_SOURCES if sources is None else sources)
+        unknown = [s for s in self.sources if s not in SOURCES]
+        if unknown or not self.sources:
+            raise ValueError(f"未知检索来源：{unknown or self.sources}（可选：{', '.join(SOURCES)}）")
+        self.speakers = _split_csv(ROLE_SPEAKERS if speakers is None else speakers)
+        self.min_conf = ROLE_MIN_CONF if min_conf is None else min_conf
+        self._roles: Dict[str, Optional[_LoadedIndex]] = {}
+        self._roles_lock = threading.Lock()
+        self._loaded = self._load()
+
+    def _load(self) -> _LoadedIndex:
+        return self._load_dir(self.index_dir, f"python -m ingest.build_index --book {self.book_id}",
+                              "（增量构建，已向量化的章节不会重复请求）")
+
+    def _load_dir(self, out_dir: Path, build_cmd: str, rebuild_note: str = "",
+                  role: Optional[str] = None) -> _LoadedIndex:
+        if self._embeddings is None:
+            self._embeddings = ArkEmbeddings(model=self.ark_model, batch_size=32)
+        embeddings = self._embeddings
         # [ADDED] 友好检查：索引是否存在（避免路径/模型不一致时的隐晦报错）
-        out_dir = INDEXES_DIR / book_id  # [ADDED]
         faiss_path = out_dir / "index.faiss"  # [ADDED]
-        pkl_path = out_dir / "index.pkl"  # [ADDED]
-        if not faiss_path.exists() or not pkl_path.exists():  # [ADDED]
+        if not faiss_path.exists():  # [ADDED]
+            raise FileNotFoundError(
+                f"未找到向量索引：{faiss_path}\n"
+                f"请先构建：{build_cmd}"
+            )
+        # [CHANGED] 不再反序列化 index.pkl：正文/元数据来自 mmap 的 chunk 库，仅命中时解码
+        if not ChunkStore.exists(out_dir):
             raise FileNotFoundError(
-                f"未找到向量索引：{faiss_path} / {pkl_path}\n"
-                f"请先构建：python -m ingest.build_index --book {book_id} "
-                f"--ark_model {ark_model}"
+                f"未找到 chunk 库：{out_dir / 'chunks.json'}（旧版索引只有 index.pkl）\n"
+                f"请重新运行：{build_cmd}{rebuild_note}"
             )
+        chunks = ChunkStore.open(out_dir)
+
+        meta = load_index_meta(out_dir)
+        if meta:
+            # [NEW] 压缩/截断索引：只加载线上索引文件，nprobe/efSearch 按 index_meta.json 设置
+            index = read_variant(out_dir, meta)
+            if meta.get("truncated"):
+                embeddings = TruncatedEmbeddings(embeddings, meta["dim"])
+        else:
+            index = faiss.read_index(str(faiss_path))
+        if index.ntotal != len(chunks):
+            raise RuntimeError(f"{out_dir} 向量数({index.ntotal})与 chunk 数({len(chunks)})不一致，请重新构建索引")
+
+        bm25 = None
+        if BM25Index.exists(out_dir / "bm25"):
+            bm25 = BM25Index.load(out_dir / "bm25")
+            if bm25.chunk_ids != chunks.ids:
+                print(f"⚠️ {out_dir / 'bm25'} 与向量索引不一致，临时重建 BM25（请重新构建索引）")
+                bm25 = None
+        if bm25 is None:
+            # 没有 BM25 产物：用 chunk 库里的同一批 chunk 在内存中构建，无需重新切分
+            bm25 = BM25Index.build([chunks.text(i) for i in range(len(chunks))], chunks.ids)
+        allow = self._role_filter(chunks, role) if role else None
+        overfetch = 1
+        if allow is not None:
+            kept = int(allow.sum())
+            overfetch = max(1, len(chunks)) if not kept else math.ceil(FILTER_OVERFETCH * len(chunks) / kept)
+        return _LoadedIndex(index, chunks, bm25, embeddings, allow, overfetch)
+
+    def _role_filter(self, chunks: ChunkStore, role: str) -> Optional[np.ndarray]:
+        """按 speaker / speaker_conf 元数据算出可用行；加载时算一次，查询时只查表。"""
+        speakers = {s.replace("{role}", role) for s in self.speakers}
+        if not speakers and self.min_conf <= 0:
+            return None
+        allow = np.zeros(len(chunks), dtype=bool)
+        for i in range(len(chunks)):
+            meta = chunks.metadata(i)
+            allow[i] = ((not speakers or meta.get("speaker") in speakers)
+                        and float(meta.get("speaker_conf") or 0.0) >= self.min_conf)
+        print(f"📊 角色索引 {role}：过滤后可用 {int(allow.sum())}/{len(chunks)} 条")
+        return allow
+
+    def _role_index(self, role: str) -> Optional[_LoadedIndex]:
+        """按角色惰性加载；缺失或加载失败记为 None（只提示一次），查询退回章节索引。"""
+        with self._roles_lock:
+            if role in self._roles:
+                return self._roles[role]
+            out_dir = role_index_dir(self.index_dir, role)
+            build_cmd = f"python -m ingest.build_role_index --book {self.book_id} --role {role}"
+            loaded = None
+            if not (out_dir / "index.faiss").exists():
+                print(f"⚠️ 未找到角色索引：{out_dir}，改用章节索引（构建：{build_cmd}）")
+            else:
+                try:
+                    loaded = self._load_dir(out_dir, build_cmd, role=role)
+                except Exception as e:
+                    print(f"⚠️ 角色索引加载失败，改用章节索引：{e}")
+            self._roles[role] = loaded
+            return loaded
+
+    def _targets(self, role: Optional[str]) -> List[Tuple[str, _LoadedIndex]]:
+        """本次查询要检索的索引：[(追踪阶段名, 索引)]，按 sources 顺序。"""
+        targets = []
+        for source in self.sources:
+            if source == "chapters":
+                targets.append(("retrieve", self._loaded))
+            elif role:
+                loaded = self._role_index(role)
+                if loaded is not None:
+                    targets.append(("retrieve.role", loaded))
+        return targets or [("retrieve", self._loaded)]
+
+    def reload(self):
+        """索引重建后原地刷新：先完整加载新索引，再整体替换，查询侧不会看到半成品。"""
+        self._loaded = self._load()
+        # 角色索引下次查询时重新加载
+        with self._roles_lock:
+            self._roles = {}
+
+    @staticmethod
+    def _search_vectors(loaded: _LoadedIndex, qv: np.ndarray, k: int, stage: str) -> List[Document]:
+        with span(f"{stage}.faiss"):
+            _, rows = loaded.index.search(qv, _fetch_k(loaded, k))
+        return [loaded.chunks.get(i) for i in _allowed(loaded, rows[0], k)]
+
+    @staticmethod
+    def _vector_docs(targets: List[Tuple[str, _LoadedIndex]], query: str, k: int) -> List[List[Document]]:
+        # 共用同一个 embeddings 的索引只向量化一次查询
+        out, qvs = [], {}
+        with span("retrieve.vector"):
+            for stage, loaded in targets:
+                key = id(loaded.embeddings)
+                if key not in qvs:
+                    with span("retrieve.embed_query"):
+                        qvs[key] = np.asarray([loaded.embeddings.embed_query(query)], dtype=np.float32)
+                out.append(DemoRetriever._search_vectors(loaded, qvs[key], k, stage))
+        return out
+
+    @staticmethod
+    async def _avector_docs(targets: List[Tuple[str, _LoadedIndex]], query: str, k: int) -> List[List[Document]]:
+        out, qvs = [], {}
+        with span("retrieve.vector"):
+            for stage, loaded in targets:
+                key = id(loaded.embeddings)
+                if key not in qvs:
+                    with span("retrieve.embed_query"):
+                        qvs[key] = np.asarray([await loaded.embeddings.aembed_query(query)], dtype=np.float32)
+                out.append(await asyncio.to_thread(DemoRetriever._search_vectors, loaded, qvs[key], k, stage))
+        return out
+
+    @staticmethod
+    def _bm25_docs(targets: List[Tuple[str, _LoadedIndex]], query: str, k: int) -> List[List[Document]]:
+        out = []
+        for stage, loaded in targets:
+            with span(f"{stage}.bm25"):
+                rows = [row for row, _ in loaded.bm25.search(query, _fetch_k(loaded, k))]
+                out.append([loaded.chunks.get(row) for row in _allowed(loaded, rows, k)])
+        return out
+
+    @staticmethod
+    def _merge(targets: List[Tuple[str, _LoadedIndex]], vec_lists: List[List[Document]],
+               bm_lists: List[List[Document]], k: int) -> List[str]:
+        """各索引内部 RRF 融合，再按 sources 顺序轮流取、去重，截到 k 条。某一路降级时对应列表为空。"""
+        ranked = []
+        for n, (stage, _) in enumerate(targets):
+            vec_docs = vec_lists[n] if n < len(vec_lists) else []
+            bm_docs = bm_lists[n] if n < len(bm_lists) else []
+            with span(f"{stage}.rrf"):
+                ranked.append([d.page_content.strip() for d in rrf_merge(vec_docs, bm_docs, k=k)])
+            record_size(f"{stage}.vector_hits", len(vec_docs))
+            record_size(f"{stage}.bm25_hits", len(bm_docs))
+        merged, seen = [], set()
+        for group in itertools.zip_longest(*ranked):
+            for text in group:
+                if text is not None and text not in seen:
+                    seen.add(text)
+                    merged.append(text)
+        merged = merged[:k]
+        record_size("retrieve.chunks", len(merged))
+        return merged
+
+    def fetch_hidden_context(self, query: str, k: Optional[int] = None,
+                             vector_timeout: Optional[float] = None, role: Optional[str] = None) -> str:
+        return "\n\n".join(self.fetch_hidden_chunks(query, k, vector_timeout, role))
+
+    async def afetch_hidden_context(self, query: str, k: Optional[int] = None,
+                                    vector_timeout: Optional[float] = None, role: Optional[str] = None) -> str:
+        return "\n\n".join(await self.afetch_hidden_chunks(query, k, vector_timeout, role))
+
+    def fetch_hidden_chunks(self, query: str, k: Optional[int] = None,
+                            vector_timeout: Optional[float] = None, role: Optional[str] = None) -> List[str]:
+        """按融合排名返回 chunk 正文列表（供调用方按 token 预算取舍）；role 用于 sources 含 role 时选角色索引。"""
+        # 检索器在多个引擎间共享，k 按调用传入，不修改共享状态
+        k = k or self.k
+        targets = self._targets(role)
+        # 两路并发：远程 embedding 慢时只用 BM25 结果，不拖住整轮回复
+        deadline = time.monotonic() + (VECTOR_TIMEOUT if vector_timeout is None else vector_timeout)
+        vec_f = submit_leg(self._vector_docs, targets, query, k)
+        bm_f = submit_leg(self._bm25_docs, targets, query, max(k, 5))
+        bm_lists = wait_leg(bm_f, BM25_TIMEOUT, "BM25 检索")
+        vec_lists = wait_leg(vec_f, max(0.0, deadline - time.monotonic()), "向量检索")
+        return self._merge(targets, vec_lists, bm_lists, k)
 
-        self.vs = FAISS.load_local(str(out_dir), embeddings, allow_dangerous_deserialization=True)
-        docs = []
-        for p in (NOVELS_DIR / book_id).glob("*.txt"):
-            docs.extend(TextLoader(str(p), encoding="utf-8").load())
-        chunks = RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=120).split_documents(docs)
-        self.bm25 = BM25Retriever.from_documents(chunks)
-        self.bm25.k = max(k, 5)
-
-    def fetch_hidden_context(self, query: str) -> str:
-        vec_docs = self.vs.similarity_search(query, k=self.k)
-        bm_docs = self.bm25.invoke(query)
-        merged = rrf_merge(vec_docs, bm_docs, k=self.k)
-        return "\n\n".join(d.page_content.strip() for d in merged)
\ No newline at end of file
+    async def afetch_hidden_chunks(self, query: str, k: Optional[int] = None,
+                                   vector_timeout: Optional[float] = None, role: Optional[str] = None) -> List[str]:
+        """fetch_hidden_chunks 的异步版本：embedding 走原生异步请求，本地计算放到线程里。"""
+        k = k or self.k
+        # 首次查询某角色时要读盘加载其索引，放到线程里
+        targets = await asyncio.to_thread(self._targets, role)
+        vec_t = asyncio.create_task(await_leg(
+            self._avector_docs(targets, query, k),
+            VECTOR_TIMEOUT if vector_timeout is None else vector_timeout, "向量检索"))
+        bm_lists = await await_leg(asyncio.to_thread(self._bm25_docs, targets, query, max(k, 5)),
+                                   BM25_TIMEOUT, "BM25 检索")
+        vec_lists = await vec_t
+        return self._merge(targets, vec_lists, bm_lists, k)
@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional
+
+from backend.retriever import DemoRetriever
+
+# 进程内最多保留多少本“无人引用”的书（LRU 淘汰），可用环境变量覆盖
+DEFAULT_MAX_IDLE = int(os.getenv("RETRIEVER_POOL_MAX_IDLE", "2"))
+
+
+class _Entry:
+    __slots__ = ("retriever", "refs", "pinned")
+
+    def __init__(self, retriever: DemoRetriever):
+        self.retriever = retriever
+        self.refs = 0
+        self.pinned = False
+
+
+class RetrieverPool:
+    """
+    进程级检索器注册表：同一 book_id 只加载一次 FAISS/BM25，所有引擎/会话共享。
+    - acquire/release：引用计数；
+    - 引用归零的书进入 LRU，超过 max_idle 本时淘汰最久未用的；
+    - warmup：启动时预加载（可钉住，不参与淘汰）；
+    - reload：索引重建后原地刷新，已持有该检索器的引擎立即生效。
+    """
+
+    def __init__(self, factory: Callable[[str], DemoRetriever] = DemoRetriever,
+                 max_idle: int = DEFAULT_MAX_IDLE):
+        self._factory = factory
+        self.max_idle = max(0, max_idle)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._book_locks: Dict[str, threading.Lock] = {}
+
+    def _book_lock(self, book_id: str) -> threading.Lock:
+        with self._lock:
+            return self._book_locks.setdefault(book_id, threading.Lock())
+
+    def _get_entry(self, book_id: str, add_ref: bool) -> _Entry:
+        # 快路径：已加载
+        with self._lock:
+            entry = self._entries.get(book_id)
+            if entry is not None:
+                if add_ref:
+                    entry.refs += 1
+                self._entries.move_to_end(book_id)
+                return entry
+        # 慢路径：按书加锁加载，避免同一本书被并发加载多次，也不阻塞其它书
+        with self._book_lock(book_id):
+            with self._lock:
+                entry = self._entries.get(book_id)
+            if entry is None:
+                entry = _Entry(self._factory(book_id))
+            with self._lock:
+                self._entries[book_id] = entry
+                if add_ref:
+                    entry.refs += 1
+                self._entries.move_to_end(book_id)
+                self._evict_locked()
+            return entry
+
+    def _evict_locked(self):
+        idle = [b for b, e in self._entries.items() if e.refs <= 0 and not e.pinned]
+        # OrderedDict 头部即最久未用
+        for book_id in idle[: max(0, len(idle) - self.max_idle)]:
+            self._entries.pop(book_id, None)
+
+    def acquire(self, book_id: str) -> DemoRetriever:
+        return self._get_entry(book_id, add_ref=True).retriever
+
+    def release(self, book_id: str):
+        with self._lock:
+            entry = self._entries.get(book_id)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            self._evict_locked()
+
+    def warmup(self, book_ids: Iterable[str], pin: bool = True):
+        for book_id in book_ids:
+            entry = self._get_entry(book_id, add_ref=False)
+            if pin:
+                with self._lock:
+                    entry.pinned = True
+
+    def reload(self, book_id: str) -> bool:
+        """索引重建后调用；未加载的书无需处理，返回 False。"""
+        with self._book_lock(book_id):
+            with self._lock:
+                entry = self._entries.get(book_id)
+            if entry is None:
+                return False
+            entry.retriever.reload()
+            return True
+
+    def evict(self, book_id: str) -> bool:
+        """强制移出（仅限无人引用），下次 acquire 重新加载。"""
+        with self._lock:
+            entry = self._entries.get(book_id)
+            if entry is None or entry.refs > 0:
+                return False
+            self._entries.pop(book_id, None)
+            return True
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {b: {"refs": e.refs, "pinned": e.pinned} for b, e in self._entries.items()}
+
+    def get(self, book_id: str) -> Optional[DemoRetriever]:
+        with self._lock:
+            entry = self._entries.get(book_id)
+            return entry.retriever if entry else None
+
+
+RETRIEVER_POOL = RetrieverPool()
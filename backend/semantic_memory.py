@@ -0,0 +1,146 @@
+import os
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from backend.memory import LTMStore, fact_terms
+from backend.tracing import span
+
+# 语义长期记忆：写入时向量化并与同会话已有事实比对，近重复的直接覆盖，不再追加
+MERGE_THRESHOLD = float(os.getenv("LTM_MERGE_THRESHOLD", "0.90"))   # 余弦相似度 ≥ 该值视为同一事实
+MAX_FACTS_PER_SESSION = int(os.getenv("LTM_MAX_FACTS", "200"))      # 每个 (会话, 角色) 最多保留多少条
+MIN_SIMILARITY = float(os.getenv("LTM_MIN_SIMILARITY", "0.0"))      # 召回的最低相似度
+
+VEC_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS ltm_vec(
+        fact_id INTEGER PRIMARY KEY,
+        session_id TEXT,
+        role_id TEXT,
+        dim INTEGER,
+        vec BLOB
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_ltm_vec_sid ON ltm_vec(session_id, role_id);",
+    """
+    CREATE TRIGGER IF NOT EXISTS ltm_vec_ad AFTER DELETE ON ltm BEGIN
+        DELETE FROM ltm_vec WHERE fact_id = old.id;
+    END;
+    """,
+]
+
+
+def _pack(vec: np.ndarray) -> bytes:
+    # 归一化后以 float16 存储：体积减半，余弦排序基本不受影响
+    return vec.astype(np.float16).tobytes()
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class SemanticLTMStore(LTMStore):
+    """
+    向量版长期记忆（LTM_MODE=semantic）：
+    - insert_many：批量向量化，与同会话已有事实（及同批前面的事实）比对，
+      相似度 ≥ merge_threshold 时用新表述覆盖旧事实，否则新增；超过 max_facts 淘汰最旧的；
+    - retrieve：查询向量与该会话事实做余弦相似度排序；会话无向量或向量化失败时回退到 FTS 召回。
+    事实正文仍在 ltm 表（FTS 与导出照常可用），向量存 ltm_vec，删除随 ltm 触发器级联。
+    """
+
+    def __init__(self, db_path: str, embeddings=None, merge_threshold: float = MERGE_THRESHOLD,
+                 max_facts: int = MAX_FACTS_PER_SESSION):
+        super().__init__(db_path)
+        self._embeddings = embeddings
+        self.merge_threshold = merge_threshold
+        self.max_facts = max(1, max_facts)
+        with self._db.write() as conn:
+            for ddl in VEC_SCHEMA:
+                conn.execute(ddl)
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            from ingest.ark_embeddings import ArkEmbeddings
+            model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")
+            self._embeddings = ArkEmbeddings(model=model, batch_size=32)
+        return self._embeddings
+
+    @staticmethod
+    def _has_vectors(conn: sqlite3.Connection, session_id: str, role_id: str) -> bool:
+        return conn.execute("SELECT 1 FROM ltm_vec WHERE session_id=? AND role_id=? LIMIT 1",
+                            (session_id, role_id)).fetchone() is not None
+
+    @staticmethod
+    def _load_vectors(conn: sqlite3.Connection, session_id: str, role_id: str,
+                      dim: int) -> Tuple[List[int], Optional[np.ndarray]]:
+        # 只取与当前模型同维的向量：换过 ARK_EMBED_MODEL 后旧维度的向量跳过（不参与合并/召回），不会让 np.stack 报错
+        rows = conn.execute("SELECT fact_id,vec FROM ltm_vec WHERE session_id=? AND role_id=? AND dim=? "
+                            "ORDER BY fact_id", (session_id, role_id, dim)).fetchall()
+        if not rows:
+            return [], None
+        ids = [r[0] for r in rows]
+        mat = np.stack([np.frombuffer(r[1], dtype=np.float16) for r in rows]).astype(np.float32)
+        return ids, mat
+
+    def insert_many(self, session_id: str, role_id: str, facts: List[str]):
+        facts = list(dict.fromkeys(f.strip() for f in facts if f and f.strip()))
+        if not facts:
+            return
+        with span("ltm.embed"):
+            vecs = _normalize(self.embeddings.embed_documents(facts))
+        now = int(time.time())
+        with self._db.write() as conn:
+            ids, mat = self._load_vectors(conn, session_id, role_id, vecs.shape[1])
+            for fact, vec in zip(facts, vecs):
+                if mat is not None and len(ids):
+                    sims = mat @ vec
+                    j = int(np.argmax(sims))
+                    if sims[j] >= self.merge_threshold:
+                        # 近重复：新表述覆盖旧事实（更新时间同时刷新，淘汰时不会被当成旧事实）
+                        conn.execute("UPDATE ltm SET fact=?,terms=?,created_at=? WHERE id=?",
+                                     (fact, fact_terms(fact), now, ids[j]))
+                        conn.execute("UPDATE ltm_vec SET dim=?,vec=? WHERE fact_id=?", (len(vec), _pack(vec), ids[j]))
+                        mat[j] = vec
+                        continue
+                cur = conn.execute("INSERT INTO ltm(session_id,role_id,fact,created_at,terms) VALUES(?,?,?,?,?)",
+                                   (session_id, role_id, fact, now, fact_terms(fact)))
+                conn.execute("INSERT INTO ltm_vec(fact_id,session_id,role_id,dim,vec) VALUES(?,?,?,?,?)",
+                             (cur.lastrowid, session_id, role_id, len(vec), _pack(vec)))
+                ids.append(cur.lastrowid)
+                mat = vec[None, :] if mat is None else np.vstack([mat, vec])
+            # 容量上限：淘汰最旧的事实
+            conn.execute("""
+                DELETE FROM ltm WHERE id IN (
+                    SELECT id FROM ltm WHERE session_id=? AND role_id=?
+                    ORDER BY created_at DESC, id DESC LIMIT -1 OFFSET ?
+                )
+            """, (session_id, role_id, self.max_facts))
+
+    def retrieve(self, session_id: str, role_id: str, query: str, top_k: int = 3) -> List[str]:
+        conn = self._db.connection()
+        if not self._has_vectors(conn, session_id, role_id):
+            # 该会话没有向量（无事实，或切换到 semantic 前写入的旧事实）：不必向量化查询，直接走全文召回
+            return super().retrieve(session_id, role_id, query, top_k)
+        try:
+            with span("ltm.embed"):
+                qv = _normalize(self.embeddings.embed_query(query))
+        except Exception as e:
+            print(f"⚠️ 长期记忆向量化失败，回退全文召回：{e}")
+            return super().retrieve(session_id, role_id, query, top_k)
+        ids, mat = self._load_vectors(conn, session_id, role_id, qv.shape[0])
+        if mat is None:
+            print(f"⚠️ 长期记忆没有与查询同维({qv.shape[0]})的向量，回退全文召回")
+            return super().retrieve(session_id, role_id, query, top_k)
+        sims = mat @ qv
+        order = [int(i) for i in np.argsort(-sims, kind="stable")[:top_k] if sims[i] >= MIN_SIMILARITY]
+        picked = [ids[i] for i in order]
+        if not picked:
+            return []
+        rows = dict(conn.execute(f"SELECT id,fact FROM ltm WHERE id IN ({','.join('?' * len(picked))})",
+                                 picked).fetchall())
+        return [rows[i] for i in picked if i in rows]
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from backend.memory import SessionStore
+
+# 服务端会话缓存：历史窗口与引擎句柄按 session_id 常驻内存，gr.State 里只留 session_id 等标量
+SESSION_WINDOW = int(os.getenv("SESSION_WINDOW", "200"))          # 每个会话缓存/展示的最近消息条数
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))   # 空闲多少秒后淘汰
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "512"))    # 最多缓存多少个会话（LRU）
+SWEEP_INTERVAL = 60.0
+
+
+class CachedSession:
+    __slots__ = ("session_id", "history", "engine", "role_id", "book_id", "last_used", "inflight", "bind_lock")
+
+    def __init__(self, session_id: str, history: List[Dict]):
+        self.session_id = session_id
+        self.history = history
+        self.engine = None
+        self.role_id: Optional[str] = None
+        self.book_id: Optional[str] = None
+        self.last_used = time.monotonic()
+        self.inflight = 0
+        # 建引擎可能要加载索引，按会话加锁，不阻塞其它会话
+        self.bind_lock = threading.Lock()
+
+
+class SessionCache:
+    """
+    以 SessionStore 为底的会话缓存：
+    - get：命中直接返回，未命中从库里读最近 window 条消息；
+    - bind_engine：会话的角色/书变化时才新建引擎，旧引擎 close() 归还检索器；
+    - append_turn：引擎已入库，这里只同步内存窗口；
+    - 空闲超过 idle_ttl 或超出 max_sessions 时淘汰（进行中的会话不淘汰）。
+    """
+
+    def __init__(self, store: SessionStore, window: int = SESSION_WINDOW, idle_ttl: float = SESSION_IDLE_TTL,
+                 max_sessions: int = SESSION_CACHE_MAX):
+        self.store = store
+        self.window = max(2, window)
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max(1, max_sessions)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedSession]" = OrderedDict()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, session_id: str) -> CachedSession:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                self.hits += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(session_id)
+                self._maybe_sweep_locked()
+                return entry
+        history = self.store.load_recent(session_id, self.window)
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                entry = self._entries[session_id] = CachedSession(session_id, history)
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(session_id)
+            self._maybe_sweep_locked(force=len(self._entries) > self.max_sessions)
+            return entry
+
+    def bind_engine(self, session_id: str, role_id: str, book_id: str, factory: Callable[[str, str], object]):
+        entry = self.get(session_id)
+        # 检查与替换在同一把锁里：并发“初始化”只建一个引擎，不会泄漏检索器引用
+        with entry.bind_lock:
+            if entry.engine is None or entry.role_id != role_id or entry.book_id != book_id:
+                old = entry.engine
+                entry.engine = factory(role_id, book_id)
+                entry.role_id, entry.book_id = role_id, book_id
+                if old is not None:
+                    old.close()
+            return entry.engine
+
+    def append_turn(self, session_id: str, user_text: str, reply: str):
+        entry = self.get(session_id)
+        entry.history.append({"role": "user", "content": user_text})
+        entry.history.append({"role": "assistant", "content": reply})
+        del entry.history[:-self.window]
+
+    def reset(self, session_id: str):
+        """清空历史后调用：保留引擎，只清内存窗口。"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry.history = []
+
+    def drop(self, session_id: str):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        if entry is not None and entry.engine is not None:
+            entry.engine.close()
+
+    def begin(self, session_id: str) -> CachedSession:
+        entry = self.get(session_id)
+        with self._lock:
+            entry.inflight += 1
+        return entry
+
+    def end(self, entry: CachedSession):
+        with self._lock:
+            entry.inflight = max(0, entry.inflight - 1)
+            entry.last_used = time.monotonic()
+
+    def _maybe_sweep_locked(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        victims = [sid for sid, e in self._entries.items()
+                   if e.inflight == 0 and now - e.last_used > self.idle_ttl]
+        # LRU：OrderedDict 头部最久未用
+        over = len(self._entries) - len(victims) - self.max_sessions
+        for sid, e in self._entries.items():
+            if over <= 0:
+                break
+            if e.inflight == 0 and sid not in victims:
+                victims.append(sid)
+                over -= 1
+        for sid in victims:
+            entry = self._entries.pop(sid)
+            self.evicted += 1
+            if entry.engine is not None:
+                entry.engine.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"sessions": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evicted": self.evicted, "inflight": sum(e.inflight for e in self._entries.values())}
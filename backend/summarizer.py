@@ -0,0 +1,100 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from backend.memory import SessionStore
+from backend.tracing import span
+
+# 滚动摘要：被挤出上下文窗口的旧对话压缩成一段“前情提要”，按会话存库，后台增量更新
+SUMMARY_MIN_NEW = int(os.getenv("SUMMARY_MIN_NEW", "6"))        # 每次更新至少并入多少条（不足时提前并入窗口内较旧的消息）
+SUMMARY_MAX_BATCH = int(os.getenv("SUMMARY_MAX_BATCH", "40"))   # 单次最多并入多少条消息
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "400"))
+
+
+def _summary_prompt(role_name: str, previous: str, messages: List[Dict]) -> str:
+    dialog = "\n".join(f"[{'用户' if m['role'] == 'user' else role_name}]{m['content']}" for m in messages)
+    return f"""
+请把下面的对话并入已有的前情提要，输出更新后的前情提要。
+要求：
+- 第三人称、按时间顺序，只保留对后续对话有用的事件、约定、情绪变化与称呼；
+- 不超过{SUMMARY_MAX_CHARS}字，只输出提要正文。
+
+[角色]{role_name}
+[已有前情提要]{previous or "（无）"}
+[新增对话]
+{dialog}
+""".strip()
+
+
+class RollingSummarizer:
+    """
+    get()：读库里的当前摘要（主键查询），不触发任何模型调用；
+    covered()：传入的最近 n 条历史里，开头有多少条已并入摘要（组 prompt 时不再原样放入）；
+    schedule()：一轮结束后调用，只要有消息既不在摘要里也不在本轮窗口里，就在后台线程里增量更新；
+    每次至少并入 min_new 条（窗口外不足时提前并入窗口内较旧的消息），既不丢消息也不每轮都调模型。
+    """
+
+    def __init__(self, store: SessionStore, min_new: int = SUMMARY_MIN_NEW, max_batch: int = SUMMARY_MAX_BATCH):
+        self.store = store
+        self.min_new = max(1, min_new)
+        self.max_batch = max(self.min_new, max_batch)
+        self._lock = threading.Lock()
+        self._running: Set[str] = set()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+
+    def get(self, session_id: str) -> Tuple[int, str]:
+        return self.store.load_summary(session_id)
+
+    def covered(self, session_id: str, n_history: int) -> Tuple[int, str]:
+        """n_history：本轮入库前传入的最近消息条数（对应库里最后 n_history 条）。返回 (已摘要条数, 摘要)。"""
+        upto, summary = self.get(session_id)
+        if not summary:
+            return 0, ""
+        base = self.store.next_idx(session_id) - n_history
+        return min(n_history, max(0, upto - base)), summary
+
+    def schedule(self, llm, role_name: str, session_id: str, kept_tail: int):
+        """kept_tail：本轮入库后，上下文里仍原样保留的最近消息条数（含本轮）。"""
+        with self._lock:
+            if session_id in self._running:
+                return
+            self._running.add(session_id)
+        self._pool.submit(self._update, llm, role_name, session_id, kept_tail)
+
+    def _update(self, llm, role_name: str, session_id: str, kept_tail: int):
+        try:
+            upto, previous = self.get(session_id)
+            total = self.store.next_idx(session_id)
+            cut = total - kept_tail
+            if cut <= upto:
+                return
+            # 窗口外未摘要的消息不足 min_new 条时，顺带并入窗口内较旧的几条（最近一轮始终原样保留）
+            end = min(max(cut, upto + self.min_new), upto + self.max_batch, total - 2)
+            if end <= upto:
+                return
+            messages = self.store.load_range(session_id, upto, end)
+            if not messages:
+                return
+            with span("summary.update"):
+                content = llm.invoke([{"role": "user", "content": _summary_prompt(role_name, previous, messages)}]).content
+            summary = (content or "").strip()[:SUMMARY_MAX_CHARS * 2]
+            self.store.save_summary(session_id, end, summary)
+        except Exception as e:
+            print(f"⚠️ 前情提要更新失败（{session_id}）：{e}")
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+
+
+_summarizers: Dict[int, RollingSummarizer] = {}
+_summarizers_lock = threading.Lock()
+
+
+def get_summarizer(store: SessionStore) -> RollingSummarizer:
+    """同一个 SessionStore 共用一个摘要器（同一会话不会被并发更新）。"""
+    with _summarizers_lock:
+        s = _summarizers.get(id(store))
+        if s is None or s.store is not store:
+            s = _summarizers[id(store)] = RollingSummarizer(store)
+        return s
@@ -0,0 +1,102 @@
+import json
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Optional, Set
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+LORE_DIR = BASE_DIR / "data" / "lore"
+
+# 中日韩统一表意文字（含扩展A、兼容区），其余按字母数字词处理
+_CJK = r"㐀-䶿一-鿿豈-﫿"
+_RUN_RE = re.compile(rf"[{_CJK}]+|[A-Za-z0-9_]+")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+
+def _is_cjk(run: str) -> bool:
+    return bool(_CJK_RE.match(run))
+
+
+def cjk_bigram_tokenize(text: str) -> List[str]:
+    """中文连续段切成字二元组（单字段保留单字），字母数字按词小写。"""
+    tokens: List[str] = []
+    for run in _RUN_RE.findall(text or ""):
+        if not _is_cjk(run):
+            tokens.append(run.lower())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class DictSegmenter:
+    """
+    词典增强：在二元组之外，把词典词（人名/地名等）作为整词额外产出，
+    使“涂山璟”“相柳”这类专名在 BM25 中获得独立的高 IDF 词项。
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words: Set[str] = {w for w in (x.strip() for x in words) if len(w) >= 2}
+        self.max_len = max((len(w) for w in self.words), default=0)
+
+    def __call__(self, text: str) -> List[str]:
+        tokens: List[str] = []
+        for run in _RUN_RE.findall(text or ""):
+            if not _is_cjk(run):
+                tokens.append(run.lower())
+                continue
+            if len(run) == 1:
+                tokens.append(run)
+                continue
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            i = 0
+            while i < len(run) and self.max_len:
+                # 正向最大匹配；二元组已覆盖的 2 字词也照样产出整词
+                for L in range(min(self.max_len, len(run) - i), 1, -1):
+                    if run[i:i + L] in self.words:
+                        tokens.append(run[i:i + L])
+                        i += L
+                        break
+                else:
+                    i += 1
+        return tokens
+
+
+def _names_from(obj, keys=("display_name", "name", "aliases", "names", "characters")) -> List[str]:
+    out: List[str] = []
+    if isinstance(obj, dict):
+        for k in keys:
+            v = obj.get(k)
+            if isinstance(v, str):
+                out.append(v)
+            elif isinstance(v, list):
+                for x in v:
+                    out.extend([x] if isinstance(x, str) else _names_from(x, keys))
+    elif isinstance(obj, list):
+        for x in obj:
+            out.extend(_names_from(x, keys))
+    return out
+
+
+@lru_cache(maxsize=1)
+def load_lore_names(lore_dir: Optional[str] = None) -> frozenset:
+    """从 data/lore 下角色卡/世界观 JSON 收集人名与别名，作为分词词典种子。"""
+    root = Path(lore_dir) if lore_dir else LORE_DIR
+    names: Set[str] = set()
+    for p in sorted(root.glob("**/*.json")):
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                names.update(_names_from(json.load(f)))
+        except (OSError, ValueError):
+            continue  # 空文件/坏文件不影响分词
+    return frozenset(n.strip() for n in names if n and n.strip())
+
+
+@lru_cache(maxsize=1)
+def lore_dict_tokenizer() -> DictSegmenter:
+    return DictSegmenter(load_lore_names())
+
+
+def cjk_dict_tokenize(text: str) -> List[str]:
+    return lore_dict_tokenizer()(text)
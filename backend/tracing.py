@@ -0,0 +1,370 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# 每轮对话的分阶段追踪：span 计时/规模 -> 直方图聚合 -> 定期日志或 HTTP 指标端点
+TRACE_ENABLED = os.getenv("PAPERSOUL_TRACE", "1") != "0"
+TRACE_LOG_EVERY = float(os.getenv("TRACE_LOG_EVERY", "0"))    # 每 N 秒打印一次汇总，0 = 不打印
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))        # 单轮总耗时超过该值时打印分阶段明细，0 = 不打印
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))            # >0 时在 127.0.0.1:端口 提供 /metrics 与 /metrics.json
+# 性能剖析（默认关闭）：cprofile / pyinstrument，每轮一个文件，同一时刻只剖析一轮
+PROFILE_MODE = os.getenv("PAPERSOUL_PROFILE", "").lower()
+PROFILE_DIR = Path(os.getenv("PAPERSOUL_PROFILE_DIR",
+                             str(Path(__file__).resolve().parents[1] / "data" / "profiles")))
+
+# 对数分桶：0.01 起每桶 ×1.2，覆盖到 1e7（毫秒或条数都够用），分位数误差 < 20%
+_BUCKET_BASE = 0.01
+_BUCKET_GROWTH = 1.2
+_BUCKET_COUNT = int(math.log(1e9) / math.log(_BUCKET_GROWTH)) + 2
+
+
+class Histogram:
+    __slots__ = ("count", "total", "min", "max", "_buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self._buckets = [0] * _BUCKET_COUNT
+
+    @staticmethod
+    def _bucket(value: float) -> int:
+        if value <= _BUCKET_BASE:
+            return 0
+        return min(_BUCKET_COUNT - 1, int(math.log(value / _BUCKET_BASE) / math.log(_BUCKET_GROWTH)) + 1)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self._buckets[self._bucket(value)] += 1
+
+    def quantile(self, q: float) -> float:
+        """取所在桶的上界，并夹在 [min, max] 之间。"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self._buckets):
+            seen += n
+            if n and seen >= rank:
+                upper = _BUCKET_BASE * _BUCKET_GROWTH ** i
+                return max(self.min, min(self.max, upper))
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3),
+            "p50": round(self.quantile(0.50), 3),
+            "p95": round(self.quantile(0.95), 3),
+            "p99": round(self.quantile(0.99), 3),
+            "max": round(self.max, 3),
+        }
+
+
+class Metrics:
+    """进程内聚合：timings 为各阶段耗时（毫秒），sizes 为各阶段规模（token / chunk / 事实条数等）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.timings: Dict[str, Histogram] = {}
+        self.sizes: Dict[str, Histogram] = {}
+
+    def _observe(self, table: Dict[str, Histogram], name: str, value: float):
+        if not TRACE_ENABLED:
+            return
+        with self._lock:
+            h = table.get(name)
+            if h is None:
+                h = table[name] = Histogram()
+            h.observe(value)
+
+    def timing(self, name: str, ms: float):
+        self._observe(self.timings, name, ms)
+
+    def size(self, name: str, value: float):
+        self._observe(self.sizes, name, value)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "timings_ms": {k: h.summary() for k, h in sorted(self.timings.items())},
+                "sizes": {k: h.summary() for k, h in sorted(self.sizes.items())},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.sizes.clear()
+            self.started_at = time.time()
+
+    def render_text(self) -> str:
+        """Prometheus 文本格式（summary 类型），指标名形如 papersoul_stage_ms{stage="retrieve.bm25"}。"""
+        snap = self.snapshot()
+        lines: List[str] = []
+        for metric, table in (("papersoul_stage_ms", snap["timings_ms"]), ("papersoul_stage_size", snap["sizes"])):
+            lines.append(f"# TYPE {metric} summary")
+            for stage, s in table.items():
+                if not s["count"]:
+                    continue
+                for q in ("p50", "p95", "p99"):
+                    lines.append(f'{metric}{{stage="{stage}",quantile="0.{q[1:]}"}} {s[q]}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {round(s["mean"] * s["count"], 3)}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {s["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def format_log(self) -> str:
+        snap = self.snapshot()
+        parts = [f"{k} p50={s['p50']:.0f} p95={s['p95']:.0f} p99={s['p99']:.0f}ms (n={s['count']})"
+                 for k, s in snap["timings_ms"].items() if s["count"]]
+        return "📊 分阶段耗时：" + ("；".join(parts) if parts else "暂无数据")
+
+
+METRICS = Metrics()
+
+
+class TurnTrace:
+    """一轮对话的分阶段明细；检索各路在线程池里并发执行，所以写入加锁。"""
+
+    def __init__(self, kind: str, **attrs):
+        self.kind = kind
+        self.attrs = attrs
+        self.stages: List[Tuple[str, float]] = []
+        self.sizes: Dict[str, float] = {}
+        self.total_ms = 0.0
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, ms: float):
+        with self._lock:
+            self.stages.append((name, ms))
+
+    def add_size(self, name: str, value: float):
+        with self._lock:
+            self.sizes[name] = self.sizes.get(name, 0) + value
+
+    def mark(self, name: str) -> float:
+        """记录从本轮开始到现在的耗时（如首 token 时间），返回毫秒数。"""
+        ms = (time.perf_counter() - self._t0) * 1000
+        METRICS.timing(name, ms)
+        self.add_stage(name, ms)
+        return ms
+
+    @contextmanager
+    def stage(self, name: str):
+        """计时本轮的一个阶段（可以跨 yield，例如整段流式生成）。"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            METRICS.timing(name, ms)
+            self.add_stage(name, ms)
+
+    def size(self, name: str, value: float):
+        METRICS.size(name, value)
+        self.add_size(name, value)
+
+    @contextmanager
+    def active(self):
+        """在不跨 yield 的代码段里把本轮设为当前追踪，下游组件的 span 会记到本轮名下。"""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def finish(self) -> float:
+        if self.total_ms:
+            return self.total_ms
+        self.total_ms = (time.perf_counter() - self._t0) * 1000
+        METRICS.timing(f"turn.{self.kind}", self.total_ms)
+        if TRACE_SLOW_MS and self.total_ms >= TRACE_SLOW_MS:
+            print(f"⚠️ 慢回合 {self.total_ms:.0f}ms（{self.kind}）：{self.describe()}")
+        return self.total_ms
+
+    def describe(self) -> str:
+        with self._lock:
+            stages = "，".join(f"{n} {ms:.0f}ms" for n, ms in self.stages)
+            sizes = "，".join(f"{n}={v:g}" for n, v in self.sizes.items())
+        return stages + (f"；{sizes}" if sizes else "")
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {"kind": self.kind, **self.attrs, "total_ms": round(self.total_ms, 2),
+                    "stages": [(n, round(ms, 2)) for n, ms in self.stages], "sizes": dict(self.sizes)}
+
+
+_current: "contextvars.ContextVar[Optional[TurnTrace]]" = contextvars.ContextVar("papersoul_turn", default=None)
+
+
+def current_trace() -> Optional[TurnTrace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str):
+    """计时一个阶段：总是计入全局直方图；当前有活动的回合时也记入该回合明细。"""
+    if not TRACE_ENABLED:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        METRICS.timing(name, ms)
+        trace = _current.get()
+        if trace is not None:
+            trace.add_stage(name, ms)
+
+
+def record_size(name: str, value: float):
+    if not TRACE_ENABLED:
+        return
+    METRICS.size(name, value)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_size(name, value)
+
+
+# —— 性能剖析钩子 —— #
+_profile_lock = threading.Lock()
+
+
+class _TurnProfiler:
+    """PAPERSOUL_PROFILE=cprofile 写 .prof（snakeviz / pstats 查看），=pyinstrument 写 .html。"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self._prof = None
+        self._owned = False
+
+    def start(self):
+        if PROFILE_MODE not in ("cprofile", "pyinstrument") or not _profile_lock.acquire(blocking=False):
+            return
+        self._owned = True
+        try:
+            if PROFILE_MODE == "cprofile":
+                import cProfile
+                self._prof = cProfile.Profile()
+                self._prof.enable()
+            else:
+                from pyinstrument import Profiler
+                self._prof = Profiler(async_mode="enabled")
+                self._prof.start()
+        except Exception as e:
+            print(f"⚠️ 性能剖析未启动（{PROFILE_MODE}）：{e}")
+            self._prof = None
+            self._release()
+
+    def stop(self):
+        if self._prof is None:
+            return
+        try:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            stem = PROFILE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{self.label}"
+            if PROFILE_MODE == "cprofile":
+                self._prof.disable()
+                self._prof.dump_stats(f"{stem}.prof")
+            else:
+                self._prof.stop()
+                Path(f"{stem}.html").write_text(self._prof.output_html(), encoding="utf-8")
+        except Exception as e:
+            print(f"⚠️ 性能剖析结果写入失败：{e}")
+        finally:
+            self._prof = None
+            self._release()
+
+    def _release(self):
+        if self._owned:
+            self._owned = False
+            _profile_lock.release()
+
+
+class _Turn:
+    def __init__(self, kind: str, attrs: Dict):
+        self.trace = TurnTrace(kind, **attrs)
+        self._profiler = _TurnProfiler(kind)
+
+    def __enter__(self) -> TurnTrace:
+        self._profiler.start()
+        return self.trace
+
+    def __exit__(self, *exc):
+        self._profiler.stop()
+        self.trace.finish()
+        return False
+
+
+def turn(kind: str, **attrs) -> _Turn:
+    """
+    一轮对话的追踪范围：with turn("chat_stream") as trace: ...
+    不设置当前追踪（流式生成器跨 yield 时上下文不可靠），需要下游记入本轮时用 trace.active() 包住不跨 yield 的代码段。
+    """
+    return _Turn(kind, attrs)
+
+
+# —— 输出：定期日志 / HTTP 端点 —— #
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, ctype = json.dumps(METRICS.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+        elif self.path.startswith("/metrics"):
+            body, ctype = METRICS.render_text().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def _log_loop(every: float):
+    while True:
+        time.sleep(every)
+        print(METRICS.format_log())
+
+
+def start_exporters(port: int = METRICS_PORT, log_every: float = TRACE_LOG_EVERY) -> Optional[ThreadingHTTPServer]:
+    """按配置启动指标端点与定期日志（进程内只启动一次）；都未配置时什么也不做。"""
+    global _started
+    with _started_lock:
+        if _started:
+            return None
+        _started = True
+    server = None
+    if port > 0:
+        try:
+            server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"✅ 指标端点：http://127.0.0.1:{port}/metrics（JSON：/metrics.json）")
+        except OSError as e:
+            print(f"⚠️ 指标端点启动失败（端口 {port}）：{e}")
+            server = None
+    if log_every > 0:
+        threading.Thread(target=_log_loop, args=(log_every,), name="metrics-log", daemon=True).start()
+    return server
@@ -0,0 +1,66 @@
+import os
+import threading
+from typing import Dict, Optional
+
+# 模型用量统计：输入/输出 token 与服务端前缀缓存命中（cached tokens）占比
+USAGE_LOG_EVERY = int(os.getenv("USAGE_LOG_EVERY", "50"))   # 每 N 次调用打印一次汇总，0 = 不打印
+
+
+def _cached_tokens(message) -> Optional[int]:
+    """从 langchain 消息里取缓存命中的输入 token 数；接口没返回时为 None。"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    if "cache_read" in details:
+        return int(details["cache_read"] or 0)
+    meta = getattr(message, "response_metadata", None) or {}
+    prompt_details = (meta.get("token_usage") or {}).get("prompt_tokens_details") or {}
+    if "cached_tokens" in prompt_details:
+        return int(prompt_details["cached_tokens"] or 0)
+    return None
+
+
+class UsageStats:
+    def __init__(self, log_every: int = USAGE_LOG_EVERY):
+        self.log_every = log_every
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.reported_calls = 0      # 返回了缓存信息的调用数
+        self.reported_input = 0      # 这些调用的输入 token 总数（命中率的分母）
+
+    def record(self, message) -> Optional[Dict]:
+        """message：invoke 的返回，或流式最后一个带 usage 的 chunk。"""
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            return None
+        cached = _cached_tokens(message)
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += int(usage.get("input_tokens") or 0)
+            self.output_tokens += int(usage.get("output_tokens") or 0)
+            if cached is not None:
+                self.cached_tokens += cached
+                self.reported_calls += 1
+                self.reported_input += int(usage.get("input_tokens") or 0)
+            should_log = self.log_every and self.calls % self.log_every == 0
+        if should_log:
+            s = self.stats()
+            print(f"📊 LLM 用量：{s['calls']} 次，输入 {s['input_tokens']}，输出 {s['output_tokens']}，"
+                  f"前缀缓存命中率 {s['cached_ratio']:.1%}")
+        return {"input_tokens": usage.get("input_tokens"), "cached_tokens": cached}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cached_ratio": self.cached_tokens / self.reported_input if self.reported_input else 0.0,
+                "calls_with_cache_info": self.reported_calls,
+            }
+
+
+USAGE_STATS = UsageStats()
@@ -0,0 +1,151 @@
+import json
+import math
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+INDEX_META_NAME = "index_meta.json"
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw", "sq8", "pq")
+
+# 各类型的默认构建/查询参数；未给出的由数据规模推导
+DEFAULT_PARAMS = {
+    "nlist": None,          # IVF 聚类数，默认 ≈ 4*sqrt(n)
+    "nprobe": 8,            # IVF 查询时探查的聚类数
+    "pq_m": None,           # PQ 子空间数，默认取能整除 dim 的 ≤64 的最大值
+    "pq_nbits": 8,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+}
+
+
+def truncate_vectors(x: np.ndarray, dim: Optional[int]) -> np.ndarray:
+    """截断到前 dim 维并重新 L2 归一化（doubao 向量截断后仍可用于近邻检索）。"""
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    if dim and dim < x.shape[1]:
+        x = np.ascontiguousarray(x[:, :dim])
+        faiss.normalize_L2(x)
+    return x
+
+
+def _default_pq_m(d: int) -> int:
+    return max(m for m in range(1, min(64, d) + 1) if d % m == 0)
+
+
+def _pq_nbits(nbits: int, n: int) -> int:
+    # 每个码本中心同样需要约 39 个训练点：小书自动降低比特数
+    return max(1, min(nbits, int(math.log2(max(2, n // 39)))))
+
+
+def build_variant(vectors: np.ndarray, index_type: str, **params) -> Tuple[faiss.Index, Dict]:
+    """由原始向量构建压缩/近似索引，返回 (index, 实际使用的参数)。"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"未知索引类型：{index_type}（可选：{', '.join(INDEX_TYPES)}）")
+    p = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if v is not None}}
+    n, d = vectors.shape
+    used: Dict = {}
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif index_type in ("ivf", "ivfpq"):
+        # 每个聚类至少约 39 个训练点，否则 faiss 会告警且聚类质量差
+        nlist = p["nlist"] or max(1, min(int(4 * math.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            m = p["pq_m"] or _default_pq_m(d)
+            nbits = _pq_nbits(p["pq_nbits"], n)
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, nbits)
+            used.update(pq_m=m, pq_nbits=nbits)
+        used.update(nlist=nlist, nprobe=min(p["nprobe"], nlist))
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, p["hnsw_m"])
+        index.hnsw.efConstruction = p["ef_construction"]
+        used.update(hnsw_m=p["hnsw_m"], ef_construction=p["ef_construction"], ef_search=p["ef_search"])
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit)
+    else:  # pq
+        m = p["pq_m"] or _default_pq_m(d)
+        nbits = _pq_nbits(p["pq_nbits"], n)
+        index = faiss.IndexPQ(d, m, nbits)
+        used.update(pq_m=m, pq_nbits=nbits)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_params(index, used)
+    return index, used
+
+
+def apply_search_params(index: faiss.Index, params: Dict):
+    if "nprobe" in params:
+        faiss.extract_index_ivf(index).nprobe = int(params["nprobe"])
+    if "ef_search" in params and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = int(params["ef_search"])
+
+
+def write_variant(out_dir: Path, index: faiss.Index, index_type: str, dim: Optional[int], params: Dict) -> Dict:
+    out_dir = Path(out_dir)
+    if index_type == "flat" and not dim:
+        index_file = "index.faiss"  # 直接复用主索引
+    else:
+        index_file = f"index_{index_type}{'_d' + str(dim) if dim else ''}.faiss"
+        faiss.write_index(index, str(out_dir / index_file))
+    meta = {
+        "index_type": index_type,
+        "index_file": index_file,
+        "dim": dim or index.d,
+        "truncated": bool(dim),
+        "ntotal": int(index.ntotal),
+        "params": params,
+    }
+    tmp = out_dir / (INDEX_META_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, out_dir / INDEX_META_NAME)
+    return meta
+
+
+def load_index_meta(in_dir: Path) -> Optional[Dict]:
+    p = Path(in_dir) / INDEX_META_NAME
+    if not p.exists():
+        return None
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_variant(in_dir: Path, meta: Dict) -> faiss.Index:
+    index = faiss.read_index(str(Path(in_dir) / meta["index_file"]))
+    apply_search_params(index, meta.get("params") or {})
+    return index
+
+
+class TruncatedEmbeddings(Embeddings):
+    """查询侧与构建侧保持一致：截断维度并归一化。其余属性透传给底层 embeddings。"""
+
+    def __init__(self, base, dim: int):
+        self.base = base
+        self.dim = dim
+
+    def _cut(self, vecs: List[List[float]]) -> List[List[float]]:
+        return truncate_vectors(np.asarray(vecs, dtype=np.float32), self.dim).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._cut(self.base.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._cut([self.base.embed_query(text)])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._cut(await self.base.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self._cut([await self.base.aembed_query(text)])[0]
+
+    def __getattr__(self, name):
+        if name == "base":
+            raise AttributeError(name)
+        return getattr(self.base, name)
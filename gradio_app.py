@@ -1,19 +1,30 @@
 import os
+import time
 import uuid
 import glob
 import json
 import gradio as gr
 
 from backend.chat_engine import RoleChatEngine
-from backend.memory import SessionStore, LTMStore, ensure_db
+from backend.memory import SessionStore, create_ltm_store, ensure_db
+from backend.retriever_pool import RETRIEVER_POOL
+from backend.session_cache import SessionCache
+from backend.tracing import start_exporters
 
 APP_TITLE = "PaperSoul-纸片人永远不死"
 DB_PATH = os.path.join("data", "sessions", "chat.db")
+# 异步流式发送不占线程，可同时挂起大量对话；上限与排队长度可用环境变量调整
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "256"))
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "512"))
+# 流式推送的最高帧率：多个 token 合并成一帧，推送次数与回复长度、历史长度无关
+STREAM_FPS = float(os.getenv("STREAM_FPS", "15"))
 
 # ========== 初始化数据库 ==========
 ensure_db(DB_PATH)                        # [NEW] 内含 WAL/索引 加速
 session_store = SessionStore(DB_PATH)
-ltm_store = LTMStore(DB_PATH)
+ltm_store = create_ltm_store(DB_PATH)    # LTM_MODE=semantic 切换为向量记忆
+# [NEW] 历史窗口与引擎放在服务端缓存里，gr.State 只保存 session_id / 角色等标量
+SESSIONS = SessionCache(session_store)
 
 # ========== 角色卡自动发现 ==========
 def load_all_cards():
@@ -33,6 +44,14 @@ ROLE_LABELS = [f"{c['display_name']}（{c.get('book_title','') or c['book_id']}
 ROLE_BY_LABEL = {ROLE_LABELS[i]: CARDS[i]["id"] for i in range(len(CARDS))}
 BOOK_BY_ROLE = {c["id"]: c["book_id"] for c in CARDS}
 
+# ========== 检索器预热（按书共享，启动时加载一次） ==========
+if os.getenv("RETRIEVER_WARMUP", "1") == "1":
+    for _book_id in sorted(set(BOOK_BY_ROLE.values())):
+        try:
+            RETRIEVER_POOL.warmup([_book_id])
+        except Exception as e:
+            print(f"⚠️ 检索器预热失败（{_book_id}）：{e}")
+
 # ========== 工具函数 ==========
 def messages_to_pairs(messages):
     pairs = []
@@ -66,36 +85,41 @@ def list_session_options():
     options = [f"{s['id']} · {s['name']}" for s in existing]
     return options, existing
 
-# ========== 回调逻辑 ==========
-def init_or_switch_role(role_label, use_ltm, state):
-    role_id = ROLE_BY_LABEL[role_label]
-    book_id = BOOK_BY_ROLE[role_id]
-    engine = RoleChatEngine(                  # [NEW] 直接复用后端
+def _make_engine(role_id, book_id):
+    return RoleChatEngine(                    # [NEW] 直接复用后端
         card_id=role_id,
         book_id=book_id,                      # [NEW] 角色 → 书 自动推导
         session_store=session_store,
         ltm_store=ltm_store,
     )
-    session_id = state.get("session_id") or str(uuid.uuid4())
+
+def _bind_current(state):
+    """把当前会话绑定到 state 里的角色；未初始化角色时返回 None。"""
+    if not state.get("role_id") or not state.get("book_id"):
+        return None
+    return SESSIONS.bind_engine(state["session_id"], state["role_id"], state["book_id"], _make_engine)
+
+# ========== 回调逻辑 ==========
+def init_or_switch_role(role_label, use_ltm, state):
+    role_id = ROLE_BY_LABEL[role_label]
+    book_id = BOOK_BY_ROLE[role_id]
     state.update({
-        "session_id": session_id,
+        "session_id": state.get("session_id") or str(uuid.uuid4()),
         "role_id": role_id,
         "book_id": book_id,
-        "engine": engine,
         "use_ltm": bool(use_ltm),
-        "history": state.get("history") or [],
     })
+    _bind_current(state)
     info = f"当前角色：{role_label}｜书ID：{book_id}"
     return info, state
 
-def new_session(session_name, state, chatbot):
+def new_session(session_name, state):
     if not state.get("role_id") or not state.get("book_id"):
-        return gr.update(value="请先选择角色并初始化。"), state, chatbot
+        return gr.update(value="请先选择角色并初始化。"), state, gr.skip()
     sid = session_store.create_session(session_name or "Gradio会话", state["role_id"], state["book_id"])  # [CHANGED]
     state["session_id"] = sid
-    state["history"] = []
-    chatbot = gr.update(value=[])
-    return f"已新建会话：{sid}", state, chatbot
+    _bind_current(state)
+    return f"已新建会话：{sid}", state, gr.update(value=[])
 
 def refresh_sessions():
     options, _ = list_session_options()
@@ -103,55 +127,47 @@ def refresh_sessions():
         return gr.update(choices=[], value=None), "暂无会话"
     return gr.update(choices=options, value=options[0]), "已刷新会话列表"
 
-def load_session(select_label, state, chatbot):
+def load_session(select_label, state):
     if not select_label:
-        return "请选择一个会话", state, chatbot
+        return "请选择一个会话", state, gr.skip()
     sid = select_label.split(" · ")[0]
-    # 1) 加载历史
-    msgs = session_store.load_history(sid)
+    # 1) 加载历史（缓存未命中时从库里读最近 SESSION_WINDOW 条）
+    msgs = SESSIONS.get(sid).history
     state["session_id"] = sid
-    state["history"] = msgs[:]
-    # 2) 从会话表取元信息，同步切换引擎到该会话的角色/书
+    # 2) 从会话表取元信息，同步切换到该会话的角色/书（引擎按会话缓存，角色/书不变时复用）
     meta_list = session_store.list_sessions()
     meta = next((m for m in meta_list if m["id"] == sid), None)
     if meta and meta.get("role_id") and meta.get("book_id"):
-        role_id = meta["role_id"]
-        book_id = meta["book_id"]
-        # 若与当前不同，则重建引擎
-        if state.get("role_id") != role_id or state.get("book_id") != book_id:
-            engine = RoleChatEngine(
-                card_id=role_id,
-                book_id=book_id,
-                session_store=session_store,
-                ltm_store=ltm_store,
-            )
-            state.update({"role_id": role_id, "book_id": book_id, "engine": engine})
-        info = f"已加载会话：{sid}｜角色：{role_id}｜书：{book_id}"
+        state.update({"role_id": meta["role_id"], "book_id": meta["book_id"]})
+        info = f"已加载会话：{sid}｜角色：{meta['role_id']}｜书：{meta['book_id']}"
     else:
         info = f"已加载会话：{sid}"
+    _bind_current(state)
 
     return info, state, gr.update(value=msgs)
 
-def delete_session(select_label, state, chatbot):
+def delete_session(select_label, state):
     if not select_label:
-        return "请选择一个会话", state, chatbot
+        return "请选择一个会话", state, gr.skip(), gr.skip()
     sid = select_label.split(" · ")[0]
     session_store.delete_session(sid)
+    SESSIONS.drop(sid)
+    chatbot = gr.skip()
     if state.get("session_id") == sid:
         state["session_id"] = str(uuid.uuid4())
-        state["history"] = []
+        _bind_current(state)
         chatbot = gr.update(value=[])
     # 刷新下拉列表
     options, _ = list_session_options()
     sess_dd_update = gr.update(choices=options, value=(options[0] if options else None))
     return f"已删除会话：{sid}", state, chatbot, sess_dd_update
 
-def clear_current_session(state, chatbot):
+def clear_current_session(state):
     sid = state.get("session_id")
     if not sid:
-        return "未找到当前会话ID", state, chatbot
+        return "未找到当前会话ID", state, gr.skip()
     session_store.clear_history(sid)
-    state["history"] = []
+    SESSIONS.reset(sid)
     return "当前会话已清空", state, gr.update(value=[])
 
 def export_current_session(state):
@@ -165,42 +181,52 @@ def toggle_ltm(use_ltm, state):
     state["use_ltm"] = bool(use_ltm)
     return f"长期记忆：{'开启' if state['use_ltm'] else '关闭'}", state
 
-# —— 流式发送（逐 token 推送） —— #
-def send_message_stream(user_text, chatbot, state):
+# —— 流式发送（异步生成器，等待模型时不占用工作线程） —— #
+async def send_message_stream(user_text, state):
     user_text = (user_text or "").strip()
     if not user_text:
-        yield chatbot, state, gr.update(value="")
+        yield gr.skip(), state, gr.update(value=""), gr.skip()
         return
-    if not state.get("engine"):
-        yield chatbot, state, gr.update(value="", placeholder="请先选择角色并点击“初始化 / 切换角色”")
+    if not state.get("session_id") or _bind_current(state) is None:
+        yield gr.skip(), state, gr.update(value="", placeholder="请先选择角色并点击“初始化 / 切换角色”"), gr.skip()
         return
 
-    # 1) 先推用户消息 + 预留空的 bot 气泡
-    msgs = list(state.get("history", []))  # [{'role', 'content'}, ...]
-    msgs.append({"role": "user", "content": user_text})
-    msgs.append({"role": "assistant", "content": ""})  # 预留一个空的助手气泡
-    yield gr.update(value=msgs), state, gr.update(value="")
-
-    # 2) 调用后端流式接口，逐步更新最后一条气泡
-    acc = []
-    stream = state["engine"].chat_stream(          # [NEW] 使用流式生成
-        session_id=state["session_id"],
-        history=state["history"],
-        user_text=user_text,
-        use_ltm=state.get("use_ltm", True),
-    )
-    for piece in stream:
-        acc.append(piece)
-        msgs[-1]["content"] = "".join(acc)      # [NEW] 实时更新最后一条
-        yield gr.update(value=msgs), state, gr.update(value="")
+    entry = SESSIONS.begin(state["session_id"])
+    try:
+        # 1) 整段对话只在开头推一次：历史 + 用户消息（历史来自服务端缓存，浏览器不再回传整段对话）
+        history = list(entry.history)
+        msgs = history + [{"role": "user", "content": user_text}]
+        yield gr.update(value=msgs), state, gr.update(value=""), gr.update(value="", visible=True)
+
+        # 2) 调用后端流式接口；按 STREAM_FPS 限帧，同一帧内的 token 合并推送
+        acc = []
+        frame = 1.0 / STREAM_FPS if STREAM_FPS > 0 else 0.0
+        last = time.monotonic()
+        stream = entry.engine.achat_stream(         # [CHANGED] 异步流式生成
+            session_id=state["session_id"],
+            history=history,
+            user_text=user_text,
+            use_ltm=state.get("use_ltm", True),
+        )
+        async for piece in stream:
+            acc.append(piece)
+            now = time.monotonic()
+            if now - last >= frame:
+                last = now
+                # [CHANGED] 流式帧只推本轮回复（写进 live_md），聊天记录 skip：每帧大小与对话长度无关
+                yield gr.skip(), gr.skip(), gr.skip(), gr.update(value="".join(acc))
 
-    # 3) 收尾：更新本地历史（engine 内已入库）
-    state["history"] = msgs
-    yield gr.update(value=msgs), state, gr.update(value="")
+        # 3) 收尾：回复并入聊天记录（整段再推一次），同步服务端缓存（engine 内已入库）
+        reply = "".join(acc)
+        msgs.append({"role": "assistant", "content": reply})
+        SESSIONS.append_turn(state["session_id"], user_text, reply)
+        yield gr.update(value=msgs), state, gr.skip(), gr.update(value="", visible=False)
+    finally:
+        SESSIONS.end(entry)
 
 # ========== UI ==========
 with gr.Blocks(fill_height=True, theme="soft") as demo:
-    state = gr.State({"history": [], "use_ltm": True})
+    state = gr.State({"use_ltm": True})
 
     gr.Markdown(f"# {APP_TITLE}")
     gr.Markdown("选择你想进行对话的角色，一起搭建平行世界进行交互吧")
@@ -224,25 +250,31 @@ with gr.Blocks(fill_height=True, theme="soft") as demo:
         export_btn = gr.Button("导出JSON")
 
     chat = gr.Chatbot(type="messages",label="对话", height=520)
+    # 生成中的回复单独流式显示，结束后并入聊天记录
+    live_md = gr.Markdown(visible=False)
     with gr.Row():
         user_in = gr.Textbox(placeholder="对角色说点什么…", lines=2, scale=5)
         send_btn = gr.Button("发送", variant="primary", scale=1)
 
     # 事件绑定
     init_btn.click(init_or_switch_role, [role_dd, ltm_ck, state], [info_md, state], concurrency_limit=2)
-    new_btn.click(new_session, [name_tb, state, chat], [info_md, state, chat], concurrency_limit=2)
+    new_btn.click(new_session, [name_tb, state], [info_md, state, chat], concurrency_limit=2)
     refresh_btn.click(refresh_sessions, [], [sess_dd, info_md], concurrency_limit=2)
-    load_btn.click(load_session, [sess_dd, state, chat], [info_md, state, chat], concurrency_limit=2)
-    del_btn.click(delete_session, [sess_dd, state, chat], [info_md, state, chat, sess_dd], concurrency_limit=2)
-    clear_btn.click(clear_current_session, [state, chat], [info_md, state], concurrency_limit=2)
+    load_btn.click(load_session, [sess_dd, state], [info_md, state, chat], concurrency_limit=2)
+    del_btn.click(delete_session, [sess_dd, state], [info_md, state, chat, sess_dd], concurrency_limit=2)
+    clear_btn.click(clear_current_session, [state], [info_md, state, chat], concurrency_limit=2)
     export_btn.click(export_current_session, [state], [info_md], concurrency_limit=2)
     ltm_ck.change(toggle_ltm, [ltm_ck, state], [info_md, state], concurrency_limit=2)
 
-    # —— 流式发送（通常最耗时，并发单独设高一点）—— #
-    send_btn.click(send_message_stream, [user_in, chat, state], [chat, state, user_in], concurrency_limit=4)
-    user_in.submit(send_message_stream, [user_in, chat, state], [chat, state, user_in], concurrency_limit=4)
+    # —— 流式发送（通常最耗时，异步执行，并发单独设高）—— #
+    # 只传输入框与 state：聊天记录不再从浏览器回传
+    send_btn.click(send_message_stream, [user_in, state], [chat, state, user_in, live_md],
+                   concurrency_limit=SEND_CONCURRENCY)
+    user_in.submit(send_message_stream, [user_in, state], [chat, state, user_in, live_md],
+                   concurrency_limit=SEND_CONCURRENCY)
 if __name__ == "__main__":
-    demo.queue( max_size=32)
+    start_exporters()   # METRICS_PORT / TRACE_LOG_EVERY 配置了才会启动
+    demo.queue(max_size=QUEUE_MAX_SIZE)
     demo.launch(
         server_name="127.0.0.1",  # 或 0.0.0.0 便于手机/其它设备访问
         server_port=7860,
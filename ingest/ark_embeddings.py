@@ -1,7 +1,10 @@
 from __future__ import annotations
-import os, time, random
-from typing import List, Optional
-from volcenginesdkarkruntime import Ark
+import os, time, random, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+from volcenginesdkarkruntime import Ark, AsyncArk
+from ingest.embedding_cache import EmbeddingCache, get_default_cache
+from backend.tracing import record_size, span
 
 # 可选：与 langchain 类型保持一致（不是硬性要求）
 try:
@@ -10,11 +13,51 @@ except Exception:
     class Embeddings:  # 兜底，不强依赖
         pass
 
+# 并发/限速默认值，可用环境变量覆盖
+DEFAULT_WORKERS = int(os.getenv("ARK_EMBED_WORKERS", "4"))
+DEFAULT_RPS = float(os.getenv("ARK_EMBED_RPS", "0"))          # 0 = 不限速
+DEFAULT_BATCH_CHARS = int(os.getenv("ARK_EMBED_BATCH_CHARS", "24000"))
+
+class TokenBucket:
+    """线程安全的令牌桶：rate 个/秒，容量 capacity；rate<=0 表示不限速。"""
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float = 1.0) -> float:
+        """预占 n 个令牌，返回调用方需要等待的秒数（可为 0）；同步/异步调用方各自去等。"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, n: float = 1.0) -> None:
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, n: float = 1.0) -> None:
+        wait = self.reserve(n)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
 class ArkEmbeddings(Embeddings):
     """
     将火山 Ark SDK 封装为 LangChain 兼容的 Embeddings：
     - embed_documents(List[str]) -> List[List[float]]
     - embed_query(str) -> List[float]
+    两个接口都先查向量缓存（cache=True 用进程级默认缓存，False/None 关闭）。
+    未命中的文本按条数(batch_size)与字符数(max_batch_chars)切批，max_workers 个线程并发请求，
+    rate_limit 为每秒请求数上限（令牌桶）；每批独立重试，输出顺序与输入一致。
+    client 可注入替身（如 ingest.fake_ark.FakeArkClient）以离线测试。
+    aembed_documents/aembed_query 走 AsyncArk 原生异步请求（未提供异步客户端时退化为线程）。
     """
     def __init__(
         self,
@@ -25,23 +68,47 @@ class ArkEmbeddings(Embeddings):
         encoding_format: str = "float",
         max_retries: int = 5,
         backoff_base: float = 0.5,
+        cache: Union[EmbeddingCache, bool, None] = True,
+        max_workers: int = DEFAULT_WORKERS,
+        rate_limit: float = DEFAULT_RPS,
+        max_batch_chars: int = DEFAULT_BATCH_CHARS,
+        client: Optional[Any] = None,
+        aclient: Optional[Any] = None,
     ) -> None:
-        api_key = api_key or os.getenv("ARK_API_KEY")
-        if not api_key:
-            raise RuntimeError("缺少 ARK_API_KEY，请设置环境变量或在 ArkEmbeddings(api_key=...) 传入。")
-
-        # volcenginesdkarkruntime 的 Ark 客户端
-        self.client = Ark(api_key=api_key, timeout=timeout)
+        if client is None:
+            api_key = api_key or os.getenv("ARK_API_KEY")
+            if not api_key:
+                raise RuntimeError("缺少 ARK_API_KEY，请设置环境变量或在 ArkEmbeddings(api_key=...) 传入。")
+            # volcenginesdkarkruntime 的 Ark 客户端
+            client = Ark(api_key=api_key, timeout=timeout)
+            aclient = aclient or AsyncArk(api_key=api_key, timeout=timeout)
+        self.client = client
+        self.aclient = aclient
         self.model = model
         self.batch_size = max(1, batch_size)
         self.encoding_format = encoding_format
         self.max_retries = max_retries
         self.backoff_base = backoff_base
+        self.cache: Optional[EmbeddingCache] = get_default_cache() if cache is True else (cache or None)
+        self.max_workers = max(1, max_workers)
+        self.max_batch_chars = max(0, max_batch_chars)
+        self._bucket = TokenBucket(rate_limit)
 
     # ---- 内部统一请求，带重试 ---- #
     def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        record_size("embed.batch_texts", len(texts))
+        with span("embed.request"):
+            return self._embed_batch_retry(texts)
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        record_size("embed.batch_texts", len(texts))
+        with span("embed.request"):
+            return await self._aembed_batch_retry(texts)
+
+    def _embed_batch_retry(self, texts: List[str]) -> List[List[float]]:
         last_err: Optional[Exception] = None
         for retry in range(self.max_retries):
+            self._bucket.acquire()
             try:
                 resp = self.client.embeddings.create(
                     model=self.model,
@@ -52,19 +119,144 @@ class ArkEmbeddings(Embeddings):
                 return [item.embedding for item in resp.data]
             except Exception as e:
                 last_err = e
-                # 指数退避 + 抖动
+                if retry == self.max_retries - 1:
+                    break
+                # 指数退避 + 抖动（只阻塞本批所在的线程）
                 sleep_s = self.backoff_base * (2 ** retry) + random.uniform(0, 0.2)
                 time.sleep(sleep_s)
         # 重试仍失败
         raise RuntimeError(f"Ark embeddings 请求失败（已重试 {self.max_retries} 次）：{last_err}")
 
+    async def _aembed_batch_retry(self, texts: List[str]) -> List[List[float]]:
+        last_err: Optional[Exception] = None
+        for retry in range(self.max_retries):
+            await self._bucket.aacquire()
+            try:
+                if self.aclient is not None:
+                    resp = await self.aclient.embeddings.create(
+                        model=self.model,
+                        input=texts,
+                        encoding_format=self.encoding_format,
+                    )
+                else:
+                    resp = await asyncio.to_thread(
+                        self.client.embeddings.create,
+                        model=self.model,
+                        input=texts,
+                        encoding_format=self.encoding_format,
+                    )
+                return [item.embedding for item in resp.data]
+            except Exception as e:
+                last_err = e
+                if retry == self.max_retries - 1:
+                    break
+                await asyncio.sleep(self.backoff_base * (2 ** retry) + random.uniform(0, 0.2))
+        raise RuntimeError(f"Ark embeddings 请求失败（已重试 {self.max_retries} 次）：{last_err}")
+
+    def health_check(self) -> None:
+        """绕过缓存的小型探活请求。"""
+        self._embed_batch(["health check"])
+
+    def _make_batches(self, texts: List[str]) -> List[Tuple[int, int]]:
+        """按条数与字符数自适应切批，返回 [start, end) 区间；单条超长文本独占一批。"""
+        batches: List[Tuple[int, int]] = []
+        start, chars = 0, 0
+        for i, t in enumerate(texts):
+            n = len(t)
+            full = i - start >= self.batch_size
+            too_long = self.max_batch_chars and i > start and chars + n > self.max_batch_chars
+            if full or too_long:
+                batches.append((start, i))
+                start, chars = i, 0
+            chars += n
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        batches = self._make_batches(texts)
+        if self.max_workers == 1 or len(batches) <= 1:
+            out: List[List[float]] = []
+            for s, e in batches:
+                out.extend(self._embed_batch(texts[s:e]))
+            return out
+
+        ex = ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches)))
+        try:
+            futures = [ex.submit(self._embed_batch, texts[s:e]) for s, e in batches]
+            out = []
+            for f in futures:  # 按提交顺序取结果，保证与输入对齐
+                out.extend(f.result())
+            return out
+        finally:
+            # 某批最终失败时，尚未开始的批次直接取消
+            ex.shutdown(wait=True, cancel_futures=True)
+
+    async def _aembed_uncached(self, texts: List[str]) -> List[List[float]]:
+        sem = asyncio.Semaphore(self.max_workers)
+
+        async def run(s: int, e: int) -> List[List[float]]:
+            async with sem:
+                return await self._aembed_batch(texts[s:e])
+
+        tasks = [asyncio.ensure_future(run(s, e)) for s, e in self._make_batches(texts)]
+        try:
+            # gather 按提交顺序返回，保证与输入对齐
+            parts = await asyncio.gather(*tasks)
+        except BaseException:
+            # 与同步路径一致：某批最终失败（或调用方取消）时，其余批次立即取消，不再消耗请求与限速令牌
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [vec for part in parts for vec in part]
+
+    # ---- 缓存：查命中 / 回填 ---- #
+    def _cache_lookup(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[str, List[int]]]:
+        # 缓存里是 float32 的 array('f')，在这里（接口边界）才转成 list
+        out = [vec.tolist() if vec is not None else None for vec in self.cache.get_many(self.model, texts)]
+        # 只请求未命中的文本；同一批里的重复文本只请求一次
+        todo: Dict[str, List[int]] = {}
+        for i, vec in enumerate(out):
+            if vec is None:
+                todo.setdefault(texts[i], []).append(i)
+        return out, todo
+
+    def _cache_fill(self, out, todo: Dict[str, List[int]], vectors: List[List[float]]):
+        miss_texts = list(todo)
+        self.cache.put_many(self.model, miss_texts, vectors)
+        for t, vec in zip(miss_texts, vectors):
+            for i in todo[t]:
+                out[i] = vec
+        return out
+
     # ---- LangChain 约定接口 ---- #
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        out: List[List[float]] = []
-        for i in range(0, len(texts), self.batch_size):
-            chunk = texts[i:i + self.batch_size]
-            out.extend(self._embed_batch(chunk))
+        if self.cache is None:
+            return self._embed_uncached(texts)
+        with span("embed.cache_lookup"):
+            out, todo = self._cache_lookup(texts)
+        record_size("embed.cache_misses", len(todo))
+        if todo:
+            self._cache_fill(out, todo, self._embed_uncached(list(todo)))
         return out
 
     def embed_query(self, text: str) -> List[float]:
-        return self._embed_batch([text])[0]
\ No newline at end of file
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return await self._aembed_uncached(texts)
+        with span("embed.cache_lookup"):
+            out, todo = await asyncio.to_thread(self._cache_lookup, texts)
+        record_size("embed.cache_misses", len(todo))
+        if todo:
+            vectors = await self._aembed_uncached(list(todo))
+            await asyncio.to_thread(self._cache_fill, out, todo, vectors)
+        return out
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats() if self.cache is not None else {}
@@ -1,37 +1,210 @@
 # 新增：多书支持
+# 增量构建：manifest.json 记录每章内容哈希与 chunk id，只向量化新增/变更章节，逐章落盘可断点续建
+# [CHANGED] 构建与续建只读写 index.faiss + chunk 库，不再经过 LangChain 的 pickle docstore（index.pkl）
 import argparse
+import hashlib
+import json
 from pathlib import Path
-from langchain_community.vectorstores import FAISS
+from typing import Dict, List, Optional
+import faiss
+import numpy as np
 from langchain_community.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 import os
 from ingest.ark_embeddings import ArkEmbeddings
+from backend.bm25 import BM25Index
+from backend.chunk_store import ChunkStore, write_chunk_store
+from backend.vector_index import INDEX_TYPES, build_variant, truncate_vectors, write_variant
 
 BASE = Path(__file__).resolve().parents[1]
 NOVELS_DIR = BASE / "data" / "novels"
 INDEXES_DIR = BASE / "data" / "indexes"
 
-def build_index_for(book_id: str):
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 120
+MANIFEST_NAME = "manifest.json"
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _split_chapter(path: Path) -> List[Document]:
+    docs = TextLoader(str(path), encoding="utf-8").load()
+    return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP).split_documents(docs)
+
+def _load_manifest(out: Path) -> Dict:
+    p = out / MANIFEST_NAME
+    if not p.exists():
+        return {}
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(out: Path, manifest: Dict):
+    tmp = out / (MANIFEST_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, out / MANIFEST_NAME)
+
+class _BuildState:
+    """构建中的主索引（flat, 全维）与逐行对应的 chunk id / 文档。"""
+    def __init__(self, index: Optional[faiss.Index] = None, ids: Optional[List[str]] = None,
+                 docs: Optional[List[Document]] = None):
+        self.index = index
+        self.ids = ids or []
+        self.docs = docs or []
+
+    def add(self, docs: List[Document], ids: List[str], emb):
+        vectors = np.asarray(emb.embed_documents([d.page_content for d in docs]), dtype=np.float32)
+        if self.index is None:
+            # 与 LangChain FAISS.from_documents 默认一致：IndexFlatL2，不归一化
+            self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+        self.ids.extend(ids)
+        self.docs.extend(docs)
+
+    def delete(self, ids: List[str]):
+        drop = set(ids)
+        rows = [i for i, cid in enumerate(self.ids) if cid in drop]
+        if not rows:
+            return
+        # IndexFlat.remove_ids 会把后面的向量前移，保持与 ids/docs 同序
+        self.index.remove_ids(np.asarray(rows, dtype=np.int64))
+        keep = [i for i, cid in enumerate(self.ids) if cid not in drop]
+        self.ids = [self.ids[i] for i in keep]
+        self.docs = [self.docs[i] for i in keep]
+
+def _load_state(out: Path) -> Optional[_BuildState]:
+    """从 index.faiss + chunk 库恢复；缺失或行数对不上（旧版只有 index.pkl / 中断在两者之间）返回 None。"""
+    if not (out / "index.faiss").exists() or not ChunkStore.exists(out):
+        return None
+    index = faiss.read_index(str(out / "index.faiss"))
+    chunks = ChunkStore.open(out)
+    try:
+        if index.ntotal != len(chunks):
+            return None
+        return _BuildState(index, list(chunks.ids), [chunks.get(i) for i in range(len(chunks))])
+    finally:
+        chunks.close()
+
+def _checkpoint(state: _BuildState, out: Path, manifest: Dict):
+    # 先写索引与 chunk 库再写 manifest：中断时 manifest 只会落后，续建时清理多出来的孤儿 chunk
+    out.mkdir(parents=True, exist_ok=True)
+    if state.index is not None:
+        faiss.write_index(state.index, str(out / "index.faiss.tmp"))
+        os.replace(out / "index.faiss.tmp", out / "index.faiss")
+        write_chunk_store(out, state.ids, state.docs)
+        legacy = out / "index.pkl"  # 旧版 pickle docstore，已无人读取
+        if legacy.exists():
+            legacy.unlink()
+    _save_manifest(out, manifest)
+
+def _write_serving_index(main_index: faiss.Index, out: Path, index_type: str, dim: Optional[int],
+                         index_params: Dict):
+    """由主索引（flat, 全维）派生线上使用的索引；只读已存向量，不重新向量化。"""
+    if dim and dim >= main_index.d:
+        dim = None
+    if index_type == "flat" and not dim:
+        index, used = main_index, {}
+    else:
+        vectors = truncate_vectors(main_index.reconstruct_n(0, main_index.ntotal), dim)
+        index, used = build_variant(vectors, index_type, **index_params)
+    meta = write_variant(out, index, index_type, dim, used)
+    for p in out.glob("index_*.faiss"):
+        if p.name != meta["index_file"]:
+            p.unlink()
+    return meta
+
+def build_index_for(book_id: str, full: bool = False, checkpoint_every: int = 1,
+                    embeddings: Optional[ArkEmbeddings] = None, out_dir: Optional[Path] = None,
+                    index_type: str = "flat", dim: Optional[int] = None,
+                    index_params: Optional[Dict] = None):
     book_dir = NOVELS_DIR / book_id
     assert book_dir.exists(), f"not found: {book_dir}"
-    docs = []
-    for p in book_dir.glob("*.txt"):
-        docs.extend(TextLoader(str(p), encoding="utf-8").load())
-    splits = RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=120).split_documents(docs)
     ark_model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")
-    emb = ArkEmbeddings(model=ark_model, batch_size=32)  # [CHANGED]
+    if embeddings is None:
+        embeddings = ArkEmbeddings(model=ark_model, batch_size=32)  # [CHANGED]
+    emb = embeddings
+    ark_model = getattr(emb, "model", ark_model)
 
     # [ADDED] 小型探活，避免大批量构建时才失败
-    emb.embed_documents(["health check"])
+    emb.health_check()
 
-    vs = FAISS.from_documents(splits,emb)
-    out = INDEXES_DIR / book_id
-    out.mkdir(parents=True, exist_ok=True)
-    vs.save_local(str(out))
+    out = Path(out_dir) if out_dir else INDEXES_DIR / book_id
+    params = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "model": ark_model}
+    manifest = {} if full else _load_manifest(out)
+    state = _load_state(out) if manifest.get("params") == params else None
+    if state is None:
+        # 首次构建 / 切分参数或模型变化 / 旧版索引：全量重建（已向量化过的文本走 embedding 缓存）
+        manifest = {"params": params, "chapters": {}}
+        state = _BuildState()
+
+    chapters = {p.name: p for p in sorted(book_dir.glob("*.txt"))}
+    hashes = {name: _file_sha256(p) for name, p in chapters.items()}
+
+    # 1) 删除：章节已删除或内容变化，以及上次中断留下的孤儿 chunk
+    stale_ids: List[str] = []
+    for name in list(manifest["chapters"]):
+        if hashes.get(name) != manifest["chapters"][name]["sha256"]:
+            stale_ids.extend(manifest["chapters"].pop(name)["chunk_ids"])
+    if state.index is not None:
+        known = {cid for info in manifest["chapters"].values() for cid in info["chunk_ids"]}
+        present = set(state.ids)
+        stale_ids = [cid for cid in stale_ids if cid in present]
+        stale_ids += [cid for cid in state.ids if cid not in known and cid not in stale_ids]
+        if stale_ids:
+            state.delete(stale_ids)
+            _checkpoint(state, out, manifest)
+            print(f"🧹 removed {len(stale_ids)} stale chunks")
+
+    # 2) 新增：只向量化 manifest 中没有的章节，按 checkpoint_every 章落盘一次
+    todo = [name for name in chapters if name not in manifest["chapters"]]
+    for n, name in enumerate(todo, start=1):
+        splits = _split_chapter(chapters[name])
+        sha = hashes[name]
+        ids = [f"{Path(name).stem}:{sha[:12]}:{i}" for i in range(len(splits))]
+        if splits:
+            state.add(splits, ids, emb)
+        manifest["chapters"][name] = {"sha256": sha, "chunk_ids": ids}
+        if n % max(1, checkpoint_every) == 0 or n == len(todo):
+            _checkpoint(state, out, manifest)
+        print(f"  + {name}: {len(splits)} chunks ({n}/{len(todo)})")
+
+    if state.index is None or not state.ids:
+        raise RuntimeError(f"{book_dir} 下没有可索引的文本")
+    if not todo and not stale_ids:
+        print("✔ index is up to date")
     print(f"✅ index saved to {out}")
 
+    # [NEW] 线上读取用的 chunk 库（mmap，无 pickle）随 index.faiss 在 checkpoint 落盘；BM25 倒排表每次重建
+    #       行号与 FAISS 向量位置一一对应
+    print(f"✅ chunks saved to {out}")
+    BM25Index.build([d.page_content for d in state.docs], state.ids).save(out / "bm25")
+    print(f"✅ bm25 saved to {out / 'bm25'}")
+
+    # [NEW] 可选压缩/近似索引（IVF/HNSW/SQ/PQ，可截断维度）；查询参数写入 index_meta.json
+    meta = _write_serving_index(state.index, out, index_type, dim, index_params or {})
+    print(f"✅ serving index: {meta['index_file']} ({meta['index_type']}, dim={meta['dim']}, {meta['params']})")
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--book", required=True, help="book_id, e.g. num1_cxs")
+    ap.add_argument("--full", action="store_true", help="忽略 manifest，全量重建")
+    ap.add_argument("--checkpoint_every", type=int, default=1, help="每向量化 N 章落盘一次")
+    ap.add_argument("--index_type", choices=INDEX_TYPES, default="flat", help="线上索引类型")
+    ap.add_argument("--dim", type=int, default=None, help="截断向量维度（如 512/1024），默认不截断")
+    ap.add_argument("--nlist", type=int, default=None, help="IVF 聚类数")
+    ap.add_argument("--nprobe", type=int, default=None, help="IVF 查询探查聚类数")
+    ap.add_argument("--pq_m", type=int, default=None, help="PQ 子空间数（需整除维度）")
+    ap.add_argument("--pq_nbits", type=int, default=None, help="PQ 每子空间比特数")
+    ap.add_argument("--hnsw_m", type=int, default=None, help="HNSW 邻居数")
+    ap.add_argument("--ef_construction", type=int, default=None)
+    ap.add_argument("--ef_search", type=int, default=None)
     args = ap.parse_args()
-    build_index_for(args.book)
+    index_params = {k: getattr(args, k) for k in
+                    ("nlist", "nprobe", "pq_m", "pq_nbits", "hnsw_m", "ef_construction", "ef_search")}
+    build_index_for(args.book, full=args.full, checkpoint_every=args.checkpoint_every,
+                    index_type=args.index_type, dim=args.dim, index_params=index_params)
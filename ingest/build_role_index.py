@@ -0,0 +1,104 @@
+# 角色语料索引：data/roles_corpus/<book>/<role>/ctx_with_speaker.jsonl → data/indexes/<book>/roles/<role>/
+# 每条 doc（台词/动作 + 前后文）一个 chunk，元数据带 speaker / speaker_conf，检索时按说话人与置信度过滤
+# 产物与章节索引同构（index.faiss + chunk 库 + bm25），DemoRetriever(sources="role,chapters") 直接加载
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from backend.bm25 import BM25Index
+from backend.chunk_store import write_chunk_store
+from backend.retriever import INDEXES_DIR, ROLE_CORPUS_NAME, role_index_dir
+from backend.vector_index import INDEX_META_NAME
+from ingest.ark_embeddings import ArkEmbeddings
+from ingest.build_index import _file_sha256, _load_manifest, _save_manifest
+
+BASE = Path(__file__).resolve().parents[1]
+ROLES_CORPUS_DIR = BASE / "data" / "roles_corpus"
+
+META_KEYS = ("anchor", "type", "speaker", "speaker_conf", "source_idx")
+
+def load_role_docs(path: Path, sha: str) -> Tuple[List[str], List[Document]]:
+    """逐行读取；doc 为空的跳过，doc 完全相同的只留第一条。"""
+    ids, docs, seen = [], [], set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            doc = (r.get("doc") or "").strip()
+            if not doc:
+                continue
+            h = hashlib.blake2b(doc.encode("utf-8"), digest_size=8).digest()
+            if h in seen:
+                continue
+            seen.add(h)
+            ids.append(f"{sha[:12]}:{len(ids)}")
+            docs.append(Document(page_content=doc, metadata={k: r.get(k) for k in META_KEYS}))
+    return ids, docs
+
+def build_role_index_for(book_id: str, role: str, full: bool = False,
+                         embeddings: Optional[ArkEmbeddings] = None, out_dir: Optional[Path] = None,
+                         src_name: str = ROLE_CORPUS_NAME):
+    """out_dir：章节索引所在目录（默认 data/indexes/<book>），角色索引写到其下 roles/<role>/。"""
+    src = ROLES_CORPUS_DIR / book_id / role / src_name
+    assert src.exists(), f"not found: {src}（先运行 tools/extract_role_lines.py --speaker 或 tools/extract_context_jsonl.py）"
+    ark_model = os.getenv("ARK_EMBED_MODEL", "doubao-embedding-large-text-240915")
+    emb = embeddings or ArkEmbeddings(model=ark_model, batch_size=32)
+    ark_model = getattr(emb, "model", ark_model)
+
+    out = role_index_dir(Path(out_dir) if out_dir else INDEXES_DIR / book_id, role)
+    sha = _file_sha256(src)
+    params = {"src": src_name, "sha256": sha, "model": ark_model}
+    if not full and _load_manifest(out).get("params") == params and (out / "index.faiss").exists():
+        print(f"✔ role index is up to date: {out}")
+        return out
+
+    ids, docs = load_role_docs(src, sha)
+    if not docs:
+        raise RuntimeError(f"{src} 中没有可索引的 doc")
+    emb.health_check()
+    vectors = np.asarray(emb.embed_documents([d.page_content for d in docs]), dtype=np.float32)
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    out.mkdir(parents=True, exist_ok=True)
+    # 与章节索引一致：行号 = 向量位置 = chunk 库行号 = BM25 文档号；角色索引只用 flat，清掉旧的派生索引
+    faiss.write_index(index, str(out / "index.faiss.tmp"))
+    os.replace(out / "index.faiss.tmp", out / "index.faiss")
+    for p in [out / INDEX_META_NAME, *out.glob("index_*.faiss")]:
+        if p.exists():
+            p.unlink()
+    write_chunk_store(out, ids, docs)
+    BM25Index.build([d.page_content for d in docs], ids).save(out / "bm25")
+    _save_manifest(out, {"params": params, "n": len(ids)})
+
+    avg = sum(len(d.page_content) for d in docs) / len(docs)
+    speakers: Dict[str, int] = {}
+    for d in docs:
+        speakers[d.metadata["speaker"]] = speakers.get(d.metadata["speaker"], 0) + 1
+    print(f"✅ role index saved to {out}：{len(docs)} 条，平均 {avg:.0f} 字，speaker 分布 {speakers}")
+    return out
+
+def list_roles(book_id: str, src_name: str = ROLE_CORPUS_NAME) -> List[str]:
+    book_dir = ROLES_CORPUS_DIR / book_id
+    return sorted(p.parent.name for p in book_dir.glob(f"*/{src_name}"))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--book", required=True, help="book_id, e.g. num1_cxs")
+    ap.add_argument("--role", default="", help="角色名（roles_corpus 下的目录名），默认该书下全部角色")
+    ap.add_argument("--src", default=ROLE_CORPUS_NAME, help="角色语料文件名")
+    ap.add_argument("--full", action="store_true", help="忽略 manifest，强制重建")
+    args = ap.parse_args()
+    roles = [args.role] if args.role else list_roles(args.book, args.src)
+    if not roles:
+        ap.error(f"{ROLES_CORPUS_DIR / args.book} 下没有 {args.src}")
+    for role in roles:
+        build_role_index_for(args.book, role, full=args.full, src_name=args.src)
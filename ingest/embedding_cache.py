@@ -0,0 +1,153 @@
+from __future__ import annotations
+import os, re, sqlite3, threading, time, hashlib, unicodedata
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+BASE = Path(__file__).resolve().parents[1]
+DEFAULT_CACHE_PATH = BASE / "data" / "cache" / "embeddings.db"
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """缓存键用的归一化：NFKC + 折叠空白。仅影响键，不影响送去向量化的原文。"""
+    return _WS.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def cache_key(model: str, text: str) -> str:
+    h = hashlib.sha1()
+    h.update(model.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    两级向量缓存，键为 (model, 归一化文本哈希)：
+    - 内存 LRU（max_entries 条）；
+    - SQLite 持久层（path=None 时仅内存），跨进程重启保留。
+    两级都以 float32 存储（内存里是 array('f')，每维 4 字节），与 FAISS 精度一致；
+    get_many 返回 array('f')，由调用方在接口边界转成 list。
+    内存 LRU 与 SQLite 各用一把锁，读盘不阻塞内存命中。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 4096):
+        self.max_entries = max(0, max_entries)
+        self._mem: "OrderedDict[str, array]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(str(path)) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings(
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    dim INTEGER,
+                    vec BLOB,
+                    created_at INTEGER
+                );
+            """)
+            self._conn.commit()
+
+    def _remember(self, key: str, vec: array):
+        if not self.max_entries:
+            return
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, array]:
+        found: Dict[str, array] = {}
+        with self._disk_lock:
+            if self._conn is None:
+                return found
+            for s in range(0, len(keys), 500):  # SQLite 变量个数上限
+                part = keys[s:s + 500]
+                rows = self._conn.execute(
+                    f"SELECT key,vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for k, blob in rows:
+                    found[k] = array("f", blob)
+        return found
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[array]]:
+        keys = [cache_key(model, t) for t in texts]
+        out: List[Optional[array]] = [None] * len(keys)
+        pending: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, k in enumerate(keys):
+                vec = self._mem.get(k)
+                if vec is not None:
+                    self._mem.move_to_end(k)
+                    out[i] = vec
+                    self.hits += 1
+                else:
+                    pending.setdefault(k, []).append(i)
+        found = self._load(list(pending)) if pending else {}
+        with self._lock:
+            for k, vec in found.items():
+                self._remember(k, vec)
+                for i in pending.pop(k):
+                    out[i] = vec
+                    self.disk_hits += 1
+            self.misses += sum(len(v) for v in pending.values())
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        now = int(time.time())
+        items = [(cache_key(model, t), array("f", v)) for t, v in zip(texts, vectors)]
+        with self._lock:
+            for k, vec in items:
+                self._remember(k, vec)
+        with self._disk_lock:
+            if items and self._conn is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings(key,model,dim,vec,created_at) VALUES(?,?,?,?,?)",
+                    [(k, model, len(vec), vec.tobytes(), now) for k, vec in items]
+                )
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "mem_size": len(self._mem)}
+
+    def close(self):
+        with self._disk_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_default_cache: Optional[EmbeddingCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[EmbeddingCache]:
+    """
+    进程级共享缓存。环境变量：
+    - ARK_EMBED_CACHE：SQLite 路径；设为 off 关闭缓存，设为 memory 仅用内存 LRU
+    - ARK_EMBED_CACHE_SIZE：内存 LRU 条数
+    """
+    global _default_cache
+    setting = os.getenv("ARK_EMBED_CACHE", str(DEFAULT_CACHE_PATH))
+    if setting.lower() == "off":
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(
+                path=None if setting.lower() == "memory" else setting,
+                max_entries=int(os.getenv("ARK_EMBED_CACHE_SIZE", "4096")),
+            )
+        return _default_cache
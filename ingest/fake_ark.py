@@ -0,0 +1,72 @@
+from __future__ import annotations
+import hashlib, math, random, threading, time
+from typing import List, Sequence
+
+# 离线替身：模拟 volcenginesdkarkruntime.Ark 的 embeddings.create 接口
+# 用法：ArkEmbeddings(client=FakeArkClient(latency=0.05, error_rate=0.1), cache=False)
+
+
+class _Item:
+    __slots__ = ("embedding",)
+
+    def __init__(self, embedding: List[float]):
+        self.embedding = embedding
+
+
+class _Response:
+    def __init__(self, data: List[_Item]):
+        self.data = data
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """由文本哈希决定的单位向量：同文本同向量，便于断言与缓存测试。"""
+    rnd = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vec = [rnd.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+class _FakeEmbeddings:
+    def __init__(self, owner: "FakeArkClient"):
+        self._owner = owner
+
+    def create(self, model: str, input: Sequence[str], encoding_format: str = "float") -> _Response:
+        return self._owner._create(list(input))
+
+
+class FakeArkClient:
+    """
+    latency：每次请求的基础耗时（秒），另加 per_item_latency * 条数 与 [0, jitter) 随机抖动；
+    error_rate：每次请求按概率抛错，用于验证按批重试；
+    calls / items / errors：统计计数。
+    """
+
+    def __init__(self, dim: int = 64, latency: float = 0.0, per_item_latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.dim = dim
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.items = 0
+        self.errors = 0
+        self.embeddings = _FakeEmbeddings(self)
+
+    def _create(self, texts: List[str]) -> _Response:
+        with self._lock:
+            self.calls += 1
+            fail = self._rnd.random() < self.error_rate
+            jitter = self._rnd.uniform(0, self.jitter) if self.jitter else 0.0
+        delay = self.latency + self.per_item_latency * len(texts) + jitter
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            raise RuntimeError("fake ark: injected error")
+        with self._lock:
+            self.items += len(texts)
+        return _Response([_Item(fake_embedding(t, self.dim)) for t in texts])
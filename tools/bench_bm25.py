@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# BM25 关键词检索基准：langchain BM25Retriever（空格分词） vs 内置倒排 BM25（中文二元组/词典）
+# 查询取自语料中的随机短语，相关集合 = 含该短语的 chunk；报告延迟与 recall@k
+import argparse, random, re, statistics, sys, time
+from pathlib import Path
+
+BASE = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BASE))
+
+from langchain_community.document_loaders import TextLoader
+from langchain_community.retrievers import BM25Retriever
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from backend.bm25 import BM25Index
+
+NOVELS_DIR = BASE / "data" / "novels"
+CJK_RUN = re.compile(r"[一-鿿]{6,}")
+
+def load_chunks(book_id):
+    docs = []
+    for p in sorted((NOVELS_DIR / book_id).glob("*.txt")):
+        docs.extend(TextLoader(str(p), encoding="utf-8").load())
+    return RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=120).split_documents(docs)
+
+def make_queries(texts, n, seed, min_len=4, max_len=10):
+    rnd = random.Random(seed)
+    queries = []
+    while len(queries) < n:
+        runs = CJK_RUN.findall(rnd.choice(texts))
+        if not runs: continue
+        run = rnd.choice(runs)
+        L = rnd.randint(min_len, min(max_len, len(run)))
+        s = rnd.randint(0, len(run) - L)
+        phrase = run[s:s + L]
+        relevant = {i for i, t in enumerate(texts) if phrase in t}
+        queries.append((phrase, relevant))
+    return queries
+
+def recall_at_k(hits, relevant, k):
+    return len(set(hits[:k]) & relevant) / min(k, len(relevant))
+
+def run(name, search, queries, k):
+    lat, rec = [], []
+    for q, rel in queries:
+        t0 = time.perf_counter()
+        hits = search(q)
+        lat.append((time.perf_counter() - t0) * 1000)
+        rec.append(recall_at_k(hits, rel, k))
+    lat.sort()
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    print(f"{name:<24} p50={statistics.median(lat):8.3f}ms  p95={p95:8.3f}ms  recall@{k}={statistics.mean(rec):.3f}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--book", default="num1_cxs")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    chunks = load_chunks(args.book)
+    texts = [c.page_content for c in chunks]
+    ids = [str(i) for i in range(len(texts))]
+    row_of = {t: i for i, t in reversed(list(enumerate(texts)))}
+    queries = make_queries(texts, args.queries, args.seed)
+    print(f"book={args.book} chunks={len(texts)} queries={len(queries)}")
+
+    t0 = time.perf_counter()
+    lc = BM25Retriever.from_documents(chunks)
+    lc.k = args.k
+    print(f"{'build langchain':<24} {time.perf_counter() - t0:.2f}s")
+    run("langchain(whitespace)", lambda q: [row_of[d.page_content] for d in lc.invoke(q)], queries, args.k)
+
+    for tok in ("cjk_bigram", "cjk_dict"):
+        t0 = time.perf_counter()
+        idx = BM25Index.build(texts, ids, tokenizer=tok)
+        print(f"{'build ' + tok:<24} {time.perf_counter() - t0:.2f}s  vocab={len(idx.vocab)}")
+        run(f"inverted({tok})", lambda q: [r for r, _ in idx.search(q, args.k)], queries, args.k)
+
+if __name__ == "__main__":
+    main()
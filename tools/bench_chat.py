@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# 离线端到端基准：假 embedding（ingest.fake_ark）+ 假聊天模型（backend.fake_chat），真实语料 data/novels/<book>
+# 不需要任何 API key；索引与数据库都建在临时目录里，不触碰 data/indexes 与 data/chat.db
+#   python tools/bench_chat.py --sessions 1 8 32 --turns 6 --ttft 0.3 --tps 40
+#   python tools/bench_chat.py --mode async --sessions 64
+#   python tools/bench_chat.py --skip_e2e            # 只跑微基准：建索引 / 检索器冷启动 / 长期记忆召回
+import argparse, asyncio, contextlib, io, json, os, random, re, statistics, sys, tempfile, threading, time
+from pathlib import Path
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BASE))
+
+from backend.character_card import load_character
+from backend.chat_engine import RoleChatEngine
+from backend.fact_worker import FACT_QUEUE
+from backend.fake_chat import FakeChatModel
+from backend.memory import LTMStore, SessionStore, ensure_db
+from backend.retriever import DemoRetriever
+from backend.semantic_memory import SemanticLTMStore
+from backend.tracing import METRICS
+from ingest.ark_embeddings import ArkEmbeddings
+from ingest.build_index import build_index_for
+from ingest.build_role_index import build_role_index_for
+from ingest.fake_ark import FakeArkClient
+
+NOVELS_DIR = BASE / "data" / "novels"
+
+
+def rss_mb() -> float:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return float("nan")
+
+
+class RssSampler:
+    """后台每 interval 秒采样一次 RSS，记录峰值。"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self._t.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._t.join()
+        self.peak = max(self.peak, rss_mb())
+
+
+def pct(xs, q):
+    return float(np.percentile(xs, q)) if xs else float("nan")
+
+
+def fmt_ms(xs):
+    return f"p50={pct(xs, 50):7.1f} p95={pct(xs, 95):7.1f} p99={pct(xs, 99):7.1f} ms"
+
+
+def make_embeddings(args):
+    client = FakeArkClient(dim=args.dim, latency=args.embed_latency, jitter=args.embed_latency * 0.2,
+                           error_rate=args.embed_error, seed=args.seed)
+    # 关掉向量缓存：每次查询都走一次（假的）远程请求，与线上冷查询一致
+    return ArkEmbeddings(model="fake-embedding", client=client, cache=False, backoff_base=0.01)
+
+
+def make_llm(args, seed=0):
+    return FakeChatModel(ttft=args.ttft, tokens_per_sec=args.tps, reply_tokens=args.reply_tokens,
+                         error_rate=args.chat_error, jitter=args.ttft * 0.2, seed=args.seed + seed)
+
+
+def sample_questions(book: str, n: int, seed: int):
+    """从原文里抽句子当用户输入（对白优先），检索命中分布与真实使用接近。"""
+    sents = []
+    for p in sorted((NOVELS_DIR / book).glob("*.txt")):
+        text = p.read_text(encoding="utf-8", errors="ignore")
+        sents += [s.strip("“”\"' \n") for s in re.findall(r"“([^”]{6,40})”", text)]
+    if not sents:
+        sents = ["你是谁", "你还记得我吗", "海上的风大吗"]
+    rnd = random.Random(seed)
+    return [rnd.choice(sents) for _ in range(n)]
+
+
+# —— 微基准 —— #
+def bench_build(args, index_dir: Path) -> dict:
+    emb = make_embeddings(args)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_index_for(args.book, full=True, checkpoint_every=10 ** 6, embeddings=emb, out_dir=index_dir)
+    dt = time.perf_counter() - t0
+    chunks = emb.client.items - 1  # 去掉探活请求
+    print(f"index build      : {dt:7.2f}s  {chunks} chunks, {emb.client.calls} embedding requests")
+    out = {"seconds": dt, "chunks": chunks, "requests": emb.client.calls}
+    if "role" in args.sources:
+        # 角色语料索引（data/roles_corpus/<book>/<role>/ctx_with_speaker.jsonl）写到同一临时目录下
+        role = load_character(args.card).display_name
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_role_index_for(args.book, role, full=True, embeddings=emb, out_dir=index_dir)
+        out["role_seconds"] = time.perf_counter() - t0
+        print(f"role index build : {out['role_seconds']:7.2f}s  ({role})")
+    return out
+
+
+def bench_cold_start(args, index_dir: Path, repeat: int = 3) -> dict:
+    times = []
+    before = rss_mb()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        r = DemoRetriever(args.book, embeddings=make_embeddings(args), index_dir=index_dir)
+        times.append((time.perf_counter() - t0) * 1000)
+        del r
+    t0 = time.perf_counter()
+    r = DemoRetriever(args.book, embeddings=make_embeddings(args), index_dir=index_dir)
+    r.fetch_hidden_chunks("相柳", k=5)
+    first = (time.perf_counter() - t0) * 1000
+    print(f"retriever cold   : median {statistics.median(times):7.1f} ms (+first query {first:7.1f} ms), "
+          f"rss +{rss_mb() - before:.0f} MB")
+    return {"median_ms": statistics.median(times), "with_first_query_ms": first}
+
+
+def bench_ltm(args, db_path: str) -> dict:
+    out = {}
+    queries = sample_questions(args.book, 200, args.seed + 1)
+    for name, store in (("fts", LTMStore(db_path)),
+                        ("semantic", SemanticLTMStore(db_path, embeddings=make_embeddings(args)))):
+        sid = f"ltm-{name}"
+        facts = [f"用户第{i}次提到{q}" for i, q in enumerate(sample_questions(args.book, args.ltm_facts, args.seed + 2))]
+        for i in range(0, len(facts), 50):
+            store.insert_many(sid, "bench", facts[i:i + 50])
+        lat = []
+        for q in queries:
+            t0 = time.perf_counter()
+            store.retrieve(sid, "bench", q, 3)
+            lat.append((time.perf_counter() - t0) * 1000)
+        print(f"ltm recall {name:<8}: {fmt_ms(lat)}  ({args.ltm_facts} facts)")
+        out[name] = {"p50_ms": pct(lat, 50), "p95_ms": pct(lat, 95), "p99_ms": pct(lat, 99)}
+    return out
+
+
+# —— 端到端 —— #
+class TurnLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ttft, self.latency, self.failures = [], [], 0
+
+    def add(self, ttft, latency):
+        with self.lock:
+            if ttft is not None:
+                self.ttft.append(ttft)
+            self.latency.append(latency)
+
+    def fail(self):
+        with self.lock:
+            self.failures += 1
+
+
+def run_session_sync(engine, sid, questions, args, log: TurnLog):
+    history = []
+    for q in questions:
+        t0 = time.perf_counter()
+        first = None
+        try:
+            pieces = []
+            for piece in engine.chat_stream(sid, history, q, use_ltm=args.ltm):
+                if first is None:
+                    first = (time.perf_counter() - t0) * 1000
+                pieces.append(piece)
+        except Exception:
+            log.fail()
+            continue
+        log.add(first, (time.perf_counter() - t0) * 1000)
+        history += [{"role": "user", "content": q}, {"role": "assistant", "content": "".join(pieces)}]
+        if args.think:
+            time.sleep(args.think)
+
+
+async def run_session_async(engine, sid, questions, args, log: TurnLog):
+    history = []
+    for q in questions:
+        t0 = time.perf_counter()
+        first = None
+        try:
+            pieces = []
+            async for piece in engine.achat_stream(sid, history, q, use_ltm=args.ltm):
+                if first is None:
+                    first = (time.perf_counter() - t0) * 1000
+                pieces.append(piece)
+        except Exception:
+            log.fail()
+            continue
+        log.add(first, (time.perf_counter() - t0) * 1000)
+        history += [{"role": "user", "content": q}, {"role": "assistant", "content": "".join(pieces)}]
+        if args.think:
+            await asyncio.sleep(args.think)
+
+
+def bench_e2e(args, retriever, db_path: str, sessions: int) -> dict:
+    store, ltm = SessionStore(db_path), LTMStore(db_path)
+    llm = make_llm(args, seed=sessions)
+    engines = [RoleChatEngine(args.card, args.book, store, ltm, llm=llm, retriever=retriever)
+               for _ in range(sessions)]
+    questions = sample_questions(args.book, sessions * args.turns, args.seed + sessions)
+    plan = [(f"bench-{sessions}-{i}", questions[i * args.turns:(i + 1) * args.turns]) for i in range(sessions)]
+    log = TurnLog()
+    METRICS.reset()
+
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        if args.mode == "async":
+            async def main():
+                await asyncio.gather(*(run_session_async(e, sid, qs, args, log)
+                                       for e, (sid, qs) in zip(engines, plan)))
+            asyncio.run(main())
+        else:
+            ts = [threading.Thread(target=run_session_sync, args=(e, sid, qs, args, log))
+                  for e, (sid, qs) in zip(engines, plan)]
+            for t in ts:
+                t.start()
+            for t in ts:
+                t.join()
+        wall = time.perf_counter() - t0
+
+    full_snap = METRICS.snapshot()
+    snap = full_snap["timings_ms"]
+    sizes = full_snap["sizes"]
+    lock = snap.get("sql.lock_wait", {"count": 0})
+    done = len(log.latency)
+    res = {
+        "sessions": sessions, "mode": args.mode, "turns": done, "failures": log.failures,
+        "wall_s": wall, "turns_per_s": done / wall if wall else 0.0,
+        "ttft_ms": {q: pct(log.ttft, v) for q, v in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "latency_ms": {q: pct(log.latency, v) for q, v in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "rss_peak_mb": rss.peak,
+        "sql_lock_wait_ms": lock,
+        "stages_p95_ms": {k: v.get("p95") for k, v in snap.items() if v.get("count")},
+        "prompt_tokens_p50": {k: sizes[k].get("p50") for k in ("prompt.tokens", "prompt.evidence_tokens")
+                              if sizes.get(k, {}).get("count")},
+        "llm_calls": llm.calls,
+    }
+    print(f"\n== sessions={sessions} mode={args.mode}: {done} turns in {wall:.2f}s "
+          f"-> {res['turns_per_s']:.1f} turns/s, failures={log.failures}, rss peak {rss.peak:.0f} MB")
+    print(f"  ttft    {fmt_ms(log.ttft)}")
+    print(f"  latency {fmt_ms(log.latency)}")
+    if lock.get("count"):
+        print(f"  sqlite write-lock wait: p95={lock['p95']:.2f} p99={lock['p99']:.2f} max={lock['max']:.2f} ms "
+              f"over {lock['count']} transactions")
+    for k in ("retrieval", "retrieve.vector", "retrieve.bm25", "prompt.plan", "persist"):
+        if k in snap and snap[k].get("count"):
+            print(f"  {k:<16} p50={snap[k]['p50']:.1f} p95={snap[k]['p95']:.1f} ms")
+    for k, v in res["prompt_tokens_p50"].items():
+        print(f"  {k:<22} p50≈{v:.0f} tokens")
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--book", default="num1_cxs")
+    ap.add_argument("--card", default="xiang_liu")
+    ap.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32], help="并发会话数（可多个）")
+    ap.add_argument("--turns", type=int, default=5, help="每个会话的轮数")
+    ap.add_argument("--mode", choices=("thread", "async"), default="thread",
+                    help="thread：每会话一个线程跑 chat_stream；async：单事件循环跑 achat_stream")
+    ap.add_argument("--think", type=float, default=0.0, help="每轮之间的用户思考时间（秒）")
+    ap.add_argument("--no_ltm", dest="ltm", action="store_false", help="关闭长期记忆召回与抽取")
+    ap.add_argument("--dim", type=int, default=256, help="假 embedding 维度")
+    ap.add_argument("--embed_latency", type=float, default=0.05, help="每次 embedding 请求耗时（秒）")
+    ap.add_argument("--embed_error", type=float, default=0.0, help="embedding 请求失败率")
+    ap.add_argument("--ttft", type=float, default=0.3, help="模型首 token 时间（秒）")
+    ap.add_argument("--tps", type=float, default=40.0, help="模型输出速率（token/s，0 = 不限速）")
+    ap.add_argument("--reply_tokens", type=int, default=60)
+    ap.add_argument("--chat_error", type=float, default=0.0, help="模型请求失败率")
+    ap.add_argument("--ltm_facts", type=int, default=500, help="长期记忆召回微基准的事实条数")
+    ap.add_argument("--skip_micro", action="store_true")
+    ap.add_argument("--skip_e2e", action="store_true")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--sources", default="chapters", help="检索来源：chapters / role / role,chapters")
+    ap.add_argument("--json", default=None, help="结果另存为 JSON")
+    args = ap.parse_args()
+
+    report = {"args": vars(args)}
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = Path(tmp) / "index"
+        db_path = os.path.join(tmp, "chat.db")
+        ensure_db(db_path)
+        print(f"rss at start     : {rss_mb():.0f} MB")
+        report["build"] = bench_build(args, index_dir)
+        if not args.skip_micro:
+            report["cold_start"] = bench_cold_start(args, index_dir)
+            report["ltm"] = bench_ltm(args, db_path)
+        if not args.skip_e2e:
+            retriever = DemoRetriever(args.book, embeddings=make_embeddings(args), index_dir=index_dir,
+                                      sources=args.sources)
+            report["e2e"] = [bench_e2e(args, retriever, db_path, n) for n in args.sessions]
+        FACT_QUEUE.drain()
+        report["fact_queue"] = FACT_QUEUE.stats()
+        print(f"\nfact queue: {report['fact_queue']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=float)
+        print(f"✅ saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
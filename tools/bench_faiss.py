@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# FAISS 索引类型基准：以 flat 为基线，比较压缩/近似索引的体积、查询延迟与 recall@k
+# 默认读取 data/indexes/<book>/index.faiss 中已存的向量；无索引时可用 --synthetic 生成随机单位向量
+import argparse, statistics, sys, time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+BASE = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BASE))
+
+from backend.vector_index import INDEX_TYPES, build_variant, truncate_vectors
+
+INDEXES_DIR = BASE / "data" / "indexes"
+
+def load_vectors(args):
+    if args.synthetic:
+        n, d = args.synthetic
+        rnd = np.random.default_rng(args.seed)
+        # 带簇结构的随机向量，比纯均匀分布更接近真实 embedding
+        centers = rnd.normal(size=(max(8, n // 50), d)).astype(np.float32)
+        x = centers[rnd.integers(0, len(centers), n)] + 0.3 * rnd.normal(size=(n, d)).astype(np.float32)
+        faiss.normalize_L2(x)
+        return x
+    index = faiss.read_index(str(INDEXES_DIR / args.book / "index.faiss"))
+    return index.reconstruct_n(0, index.ntotal)
+
+def make_queries(x, nq, seed):
+    rnd = np.random.default_rng(seed)
+    q = x[rnd.integers(0, len(x), nq)] + 0.05 * rnd.normal(size=(nq, x.shape[1])).astype(np.float32)
+    faiss.normalize_L2(q)
+    return q
+
+def bench(name, index, q, gt, k):
+    lat, hits = [], []
+    for i in range(len(q)):
+        t0 = time.perf_counter()
+        _, I = index.search(q[i:i + 1], k)
+        lat.append((time.perf_counter() - t0) * 1000)
+        hits.append(len(set(I[0]) & set(gt[i])) / k)
+    lat.sort()
+    size_mb = len(faiss.serialize_index(index)) / 2**20
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    print(f"{name:<16} size={size_mb:8.2f}MB  p50={statistics.median(lat):7.3f}ms  p95={p95:7.3f}ms  "
+          f"recall@{k}={statistics.mean(hits):.3f}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--book", default="num1_cxs")
+    ap.add_argument("--synthetic", type=int, nargs=2, metavar=("N", "DIM"), help="用随机向量代替真实索引")
+    ap.add_argument("--types", default=",".join(INDEX_TYPES))
+    ap.add_argument("--dims", default="0", help="截断维度列表，逗号分隔，0 = 不截断")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    x = load_vectors(args)
+    q = make_queries(x, args.queries, args.seed)
+    print(f"vectors={x.shape[0]} dim={x.shape[1]} queries={len(q)}")
+
+    flat = faiss.IndexFlatL2(x.shape[1])
+    flat.add(x)
+    _, gt = flat.search(q, args.k)  # 全维 flat 的结果作为真值
+    bench("flat(baseline)", flat, q, gt, args.k)
+
+    for dim in (int(d) for d in args.dims.split(",")):
+        xd = truncate_vectors(x, dim or None)
+        qd = truncate_vectors(q, dim or None)
+        for t in args.types.split(","):
+            if t == "flat" and not dim:
+                continue
+            t0 = time.perf_counter()
+            index, used = build_variant(xd, t)
+            label = f"{t}{'/d' + str(dim) if dim else ''}"
+            print(f"  build {label}: {time.perf_counter() - t0:.2f}s {used}")
+            bench(label, index, qd, gt, args.k)
+
+if __name__ == "__main__":
+    main()
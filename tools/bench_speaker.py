@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# 说话人标注基准：旧写法（整文件读入 + 每条现拼正则）vs SpeakerAttributor 流式 + 分批多进程
+# 输入默认 data/roles_corpus/num1_cxs/相柳/lines.jsonl，--repeat 复制放大；输出写临时目录，不覆盖语料
+import argparse, filecmp, json, os, re, sys, tempfile, time
+from pathlib import Path
+
+BASE = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from extract_context_jsonl import ACT, CN_QUOTES, SAY, _union, attribute_file, join_ctx
+
+
+def legacy_guess(text, action, role, aliases, others, mode="strict"):
+    # 与改造前 guess_speaker 相同
+    RU = _union([role] + aliases)
+    OU = _union(others)
+    rules = []
+    def hit(name, score): rules.append((name, score))
+    if re.search(rf"^{RU}.{{0,12}}{SAY}", text or ""):       hit("xl_front_say", 1.0)
+    if re.search(rf"{RU}.{{0,12}}{SAY}\s*$", text or ""):    hit("xl_tail_say", 0.9)
+    if re.search(rf"^{RU}.{{0,16}}{ACT}", action or ""):     hit("xl_act_subject", 0.9)
+    if re.search(rf"^{OU}.{{0,12}}{SAY}", text or ""):       hit("other_front_say", -1.0)
+    if re.search(rf"{OU}.{{0,12}}{SAY}\s*$", text or ""):    hit("other_tail_say", -0.9)
+    if re.search(rf"^{OU}.{{0,16}}{ACT}", action or ""):     hit("other_act_subject", -0.8)
+    if mode in ("balanced","lenient") and re.search(rf"{CN_QUOTES}.+?{CN_QUOTES}", text or ""):
+        if re.search(rf"{RU}.{{0,12}}{SAY}", text or "") or re.search(rf"{RU}", text or ""):
+            hit("weak_quote_ctx_xl", 0.4 if mode=="balanced" else 0.5)
+    score = sum(s for _, s in rules)
+    if mode == "strict":  score *= 1.2
+    if mode == "lenient": score *= 0.9
+    conf = max(0.0, min(1.0, 0.5 + 0.4 * score))
+    speaker = role if conf >= 0.7 else ("其他" if conf <= 0.3 else "未知")
+    return speaker, round(conf, 3), "+".join(n for n,_ in rules) or "none"
+
+
+def legacy_file(in_path, out_path, role, aliases, others, mode):
+    # 与改造前 main 相同：先全部读入，再逐条判定，最后一次写出
+    rows, out_rows = [], []
+    with open(in_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            rows.append(json.loads(line))
+    for r in rows:
+        text = r.get("text","")
+        spk, conf, rule = legacy_guess(text, r.get("action",""), role, aliases, others, mode=mode)
+        out_rows.append({"doc": join_ctx(r), "anchor": r.get("line_raw") or text, "type": r.get("type","speech"),
+                         "speaker": spk, "speaker_conf": conf, "rule": rule, "source_idx": r.get("source_idx")})
+    with open(out_path, "w", encoding="utf-8") as f:
+        for it in out_rows:
+            f.write(json.dumps(it, ensure_ascii=False) + "\n")
+    return len(out_rows)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--book", default="num1_cxs")
+    ap.add_argument("--role", default="相柳")
+    ap.add_argument("--aliases", default="防风邶")
+    ap.add_argument("--others", default="小六,小夭,涂山璟,轩,颛顼")
+    ap.add_argument("--mode", choices=["strict","balanced","lenient"], default="balanced")
+    ap.add_argument("--repeat", type=int, default=50, help="输入复制倍数")
+    ap.add_argument("--workers", default="1,2,4", help="逗号分隔的进程数")
+    ap.add_argument("--batch_size", type=int, default=2000)
+    args = ap.parse_args()
+
+    src = BASE / "data" / "roles_corpus" / args.book / args.role / "lines.jsonl"
+    assert src.exists(), f"not found: {src}"
+    aliases = [x.strip() for x in args.aliases.split(",") if x.strip()]
+    others  = [x.strip() for x in args.others.split(",")  if x.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        in_path = tmp / "lines.jsonl"
+        blob = src.read_bytes()
+        with open(in_path, "wb") as f:
+            for _ in range(max(1, args.repeat)):
+                f.write(blob)
+        print(f"📊 input: {src.name} ×{args.repeat} = {in_path.stat().st_size / 1e6:.1f} MB  (cpu={os.cpu_count()})")
+
+        legacy_out = tmp / "legacy.jsonl"
+        t0 = time.perf_counter()
+        n = legacy_file(in_path, legacy_out, args.role, aliases, others, args.mode)
+        dt = time.perf_counter() - t0
+        print(f"{'legacy':<10} rows={n:<8} {dt:7.2f}s  {n / dt:10.0f} rows/s")
+
+        for w in [int(x) for x in args.workers.split(",") if x.strip()]:
+            out = tmp / f"w{w}.jsonl"
+            t0 = time.perf_counter()
+            n = attribute_file(in_path, out, args.role, aliases, others, mode=args.mode,
+                               workers=w, batch_size=args.batch_size)
+            dt = time.perf_counter() - t0
+            same = "same" if filecmp.cmp(legacy_out, out, shallow=False) else "DIFFERENT"
+            print(f"{f'workers={w}':<10} rows={n:<8} {dt:7.2f}s  {n / dt:10.0f} rows/s  output {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# SQLite 会话写入基准：旧写法（每次新建连接 + MAX(idx) + 每条消息单独提交）vs 连接池 + 单事务 append_turn
+# 在临时目录建库，不触碰 data/chat.db；--threads 模拟多个会话并发写入
+import argparse, os, sqlite3, sys, tempfile, threading, time
+from pathlib import Path
+
+BASE = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BASE))
+
+from backend.memory import LTMStore, SessionStore, ensure_db
+
+REPLY = "我是相柳。" * 40
+
+
+def legacy_append(db_path, session_id, role, content):
+    # 与改造前 SessionStore.append_message 相同
+    with sqlite3.connect(db_path) as conn:
+        cur = conn.execute("SELECT COALESCE(MAX(idx), -1) FROM messages WHERE session_id=?", (session_id,))
+        max_idx = cur.fetchone()[0]
+        conn.execute("INSERT INTO messages(session_id,idx,role,content,created_at) VALUES(?,?,?,?,?)",
+                     (session_id, max_idx + 1, role, content, int(time.time())))
+        conn.commit()
+
+
+def legacy_turn(db_path, _store, sid, i):
+    legacy_append(db_path, sid, "user", f"问题{i}")
+    legacy_append(db_path, sid, "assistant", REPLY)
+
+
+def pooled_turn(_db_path, store, sid, i):
+    store.append_turn(sid, f"问题{i}", REPLY)
+
+
+def run(name, fn, db_path, store, threads, turns, history):
+    sids = [f"{name}-{threads}-{t}" for t in range(threads)]
+    # 预置历史：让 MAX(idx) 扫描有东西可扫
+    if history:
+        seed = SessionStore(db_path)
+        for sid in sids:
+            seed.append_messages(sid, [("user", "旧问题"), ("assistant", REPLY)] * (history // 2))
+        if fn is legacy_turn:
+            # 旧写法不用 msg_seq
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("DELETE FROM msg_seq WHERE session_id LIKE 'legacy-%'")
+
+    def worker(sid):
+        for i in range(turns):
+            fn(db_path, store, sid, i)
+
+    ts = [threading.Thread(target=worker, args=(sid,)) for sid in sids]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    dt = time.perf_counter() - t0
+    total = threads * turns
+    print(f"{name:<8} threads={threads:<3} turns={total:<6} {dt:7.2f}s  {total / dt:9.1f} turns/s")
+    return total / dt
+
+
+def bench_ltm(db_path, n):
+    store = LTMStore(db_path)
+    for i in range(n):
+        store.insert_many("ltm", "r", [f"用户第{i}次提到桃子", f"相柳第{i}次出现"])
+    t0 = time.perf_counter()
+    for _ in range(200):
+        store.retrieve("ltm", "r", "你还记得相柳吗", 3)
+    print(f"ltm retrieve ({2 * n} facts): {(time.perf_counter() - t0) / 200 * 1000:.2f} ms/query")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--turns", type=int, default=300, help="每个线程写入的轮数")
+    ap.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    ap.add_argument("--history", type=int, default=400, help="每个会话预置的历史消息条数")
+    ap.add_argument("--ltm_facts", type=int, default=1000)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "chat.db")
+        ensure_db(db_path)
+        store = SessionStore(db_path)
+        for threads in args.threads:
+            before = run("legacy", legacy_turn, db_path, None, threads, args.turns, args.history)
+            after = run("pooled", pooled_turn, db_path, store, threads, args.turns, args.history)
+            print(f"  -> x{after / before:.1f}")
+        bench_ltm(db_path, args.ltm_facts // 2)
+
+
+if __name__ == "__main__":
+    main()
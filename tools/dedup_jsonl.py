@@ -1,41 +1,226 @@
 # 用于去重
-import json
+# [CHANGED] 流式读写（临时文件 + os.replace 原子替换）；已见集合只存 8 字节哈希，可落盘（--hash_db）；
+#           --near 开启 MinHash/LSH 近重复去重（上下文窗口重叠的变体）
+import argparse, hashlib, json, os, shutil, sqlite3, tempfile
+from pathlib import Path
 
-def deduplicate_jsonl(file_path, key="line_raw"):
+import numpy as np
+
+def _digest(val: str) -> int:
+    """固定 8 字节哈希；1 亿条记录的碰撞概率约万分之三。"""
+    return int.from_bytes(hashlib.blake2b(val.encode("utf-8"), digest_size=8).digest(), "little")
+
+class _MemoryHashSet:
+    def __init__(self):
+        self._seen = set()
+
+    def add(self, h: int) -> bool:
+        """新哈希返回 True。"""
+        if h in self._seen:
+            return False
+        self._seen.add(h)
+        return True
+
+    def __len__(self):
+        return len(self._seen)
+
+    def close(self):
+        self._seen.clear()
+
+class _DiskHashSet:
+    """
+    SQLite 落盘的哈希集合：内存不随语料增长；同一个 hash_db 跨文件复用即跨文件去重。
+    另记处理过的文件内容哈希（输入与输出），同一份内容再次处理时跳过，避免所有行都被判为重复。
     """
-    去重 JSONL 文件，按 key 判断重复
-    :param input_file: 输入的 jsonl 文件路径
-    :param output_file: 输出的 jsonl 文件路径
+    def __init__(self, path, commit_every=50000):
+        self._conn = sqlite3.connect(str(path))
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen(h INTEGER PRIMARY KEY)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files(sha TEXT PRIMARY KEY, path TEXT)")
+        self._pending = 0
+        self._commit_every = commit_every
+
+    def add(self, h: int) -> bool:
+        # INTEGER PRIMARY KEY 是有符号 64 位
+        cur = self._conn.execute("INSERT OR IGNORE INTO seen(h) VALUES(?)", (h - (1 << 63),))
+        self._pending += 1
+        if self._pending >= self._commit_every:
+            self._conn.commit()
+            self._pending = 0
+        return cur.rowcount == 1
+
+    def has_file(self, sha: str) -> bool:
+        return self._conn.execute("SELECT 1 FROM files WHERE sha=?", (sha,)).fetchone() is not None
+
+    def mark_file(self, sha: str, path):
+        self._conn.execute("INSERT OR REPLACE INTO files(sha,path) VALUES(?,?)", (sha, str(path)))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+def _lsh_params(threshold: float, num_perm: int):
+    """选 (bands, rows)：使 S 曲线拐点 (1/b)^(1/r) 最接近阈值。"""
+    best = None
+    for r in range(1, num_perm + 1):
+        if num_perm % r:
+            continue
+        b = num_perm // r
+        err = abs((1 / b) ** (1 / r) - threshold)
+        if best is None or err < best[0]:
+            best = (err, b, r)
+    return best[1], best[2]
+
+class MinHashLSH:
+    """
+    字符 n-gram 的 MinHash 签名 + LSH 分桶；只和同桶的已保留记录比较估计 Jaccard。
+    内存 ≈ 已保留条数 × num_perm × 4 字节（签名）+ 分桶索引。
+    """
+    def __init__(self, threshold=0.8, num_perm=64, shingle=3, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.bands, self.rows = _lsh_params(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        self._a = (rng.integers(1, 1 << 63, size=num_perm, dtype=np.uint64) | np.uint64(1))[:, None]
+        self._b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)[:, None]
+        self._pow = np.uint64(1000003) ** np.arange(shingle, dtype=np.uint64)
+        self._buckets = [dict() for _ in range(self.bands)]
+        self._sigs = []
+
+    def signature(self, text: str) -> np.ndarray:
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        k = min(self.shingle, len(codes))
+        # 滑窗多项式哈希（按 2^64 取模），再取高 32 位作为 shingle 值
+        win = np.lib.stride_tricks.sliding_window_view(codes, k)
+        x = (win * self._pow[:k]).sum(axis=1, dtype=np.uint64)
+        x = (x * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+        return ((self._a * x + self._b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def _keys(self, sig: np.ndarray):
+        for i in range(self.bands):
+            yield i, sig[i * self.rows:(i + 1) * self.rows].tobytes()
+
+    def is_duplicate(self, text: str) -> bool:
+        """与已保留记录近重复返回 True；否则登记本条并返回 False。"""
+        if not text:
+            return False
+        sig = self.signature(text)
+        keys = list(self._keys(sig))
+        checked = set()
+        for i, key in keys:
+            for j in self._buckets[i].get(key, ()):
+                if j in checked:
+                    continue
+                checked.add(j)
+                if np.count_nonzero(self._sigs[j] == sig) >= self.threshold * self.num_perm:
+                    return True
+        idx = len(self._sigs)
+        self._sigs.append(sig)
+        for i, key in keys:
+            self._buckets[i].setdefault(key, []).append(idx)
+        return False
+
+def _file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _copy_mode(src, tmp):
+    """mkstemp 建的文件是 0600：覆盖时沿用原文件权限，新文件按 umask 给默认权限（与 open(..., "w") 一致）。"""
+    if src is not None:
+        shutil.copymode(src, tmp)
+        return
+    mask = os.umask(0)
+    os.umask(mask)
+    os.chmod(tmp, 0o666 & ~mask)
+
+def deduplicate_jsonl(file_path, key="line_raw", out_path=None, near=0.0, near_key=None, num_perm=64, shingle=3,
+                      hash_db=None):
+    """
+    去重 JSONL 文件，按 key 判断重复，流式写临时文件后原子替换
+    :param file_path: 输入的 jsonl 文件路径
     :param key: 判断重复的字段，默认是 'line_raw'
+    :param out_path: 输出路径，默认覆盖输入文件
+    :param near: >0 时做近重复去重，值为 Jaccard 相似度阈值（如 0.8）
+    :param near_key: 近重复比较的字段，默认同 key（ctx_with_speaker.jsonl 可用 doc：上下文窗口重叠的变体）
+    :param num_perm / shingle: MinHash 签名长度 / 字符 n-gram 长度
+    :param hash_db: 已见哈希落盘到该 SQLite 文件（超大语料用；不会自动删除）；
+                    该 hash_db 处理过的内容（含本工具写出的结果）再次传入时跳过，不改写文件
+    :return: 统计 {total, kept, exact_dups, near_dups, bad_lines}
     """
-    seen = set()
-    unique_lines = []
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            if not line.strip():
-                continue
-            try:
-                obj = json.loads(line)
-            except json.JSONDecodeError:
-                continue  # 避免坏行
-
-            # 用 key 去重
-            if key in obj:
-                val = obj[key].strip()
-                if val not in seen:
-                    seen.add(val)
-                    unique_lines.append(obj)
-            else:
-                # 如果没有 key，就直接保留
-                unique_lines.append(obj)
-
-    # 写回新文件
-    with open(file_path, "w", encoding="utf-8") as f:
-        for obj in unique_lines:
-            f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-    print(f"✅ 去重完成，输入 {file_path} 共 {len(seen)} 条唯一记录，输出到 {file_path}")
+    file_path = Path(file_path)
+    out_path = Path(out_path) if out_path else file_path
+    seen = _DiskHashSet(hash_db) if hash_db else _MemoryHashSet()
+    lsh = MinHashLSH(near, num_perm=num_perm, shingle=shingle) if near > 0 else None
+    near_key = near_key or key
+    stats = {"total": 0, "kept": 0, "exact_dups": 0, "near_dups": 0, "bad_lines": 0}
+    src_sha = _file_sha256(file_path) if hash_db else None
+    if src_sha and seen.has_file(src_sha):
+        seen.close()
+        print(f"⚠️ {file_path} 的内容已用 {hash_db} 去重过，跳过（再跑一遍会把每行都判为重复）")
+        return stats
+
+    fd, tmp = tempfile.mkstemp(prefix=out_path.name + ".", suffix=".tmp", dir=str(out_path.parent))
+    try:
+        with open(file_path, "r", encoding="utf-8") as fin, os.fdopen(fd, "w", encoding="utf-8") as fout:
+            for line in fin:
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    stats["bad_lines"] += 1
+                    continue  # 避免坏行
+                stats["total"] += 1
+
+                # 用 key 去重；没有 key 就直接保留
+                if key in obj:
+                    val = obj[key].strip()
+                    if not seen.add(_digest(val)):
+                        stats["exact_dups"] += 1
+                        continue
+                    if lsh is not None and lsh.is_duplicate(val if near_key == key else (obj.get(near_key) or "").strip()):
+                        stats["near_dups"] += 1
+                        continue
+                fout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+                stats["kept"] += 1
+        _copy_mode(out_path if out_path.exists() else None, tmp)
+        out_sha = _file_sha256(tmp) if src_sha else None
+        os.replace(tmp, out_path)
+        if src_sha:
+            seen.mark_file(src_sha, file_path)
+            seen.mark_file(out_sha, out_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        seen.close()
+
+    print(f"✅ 去重完成，输入 {file_path} 共 {stats['total']} 条，保留 {stats['kept']} 条"
+          f"（精确重复 {stats['exact_dups']}，近重复 {stats['near_dups']}，坏行 {stats['bad_lines']}），输出到 {out_path}")
+    return stats
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("path", help="输入 jsonl，如 data/roles_corpus/num1_cxs/相柳/lines.jsonl")
+    ap.add_argument("--key", default="line_raw", help="判断重复的字段（ctx_with_speaker.jsonl 用 anchor）")
+    ap.add_argument("--out", default=None, help="输出路径，默认覆盖输入")
+    ap.add_argument("--near", type=float, default=0.0, help="近重复阈值（Jaccard，如 0.8）；0 = 只做精确去重")
+    ap.add_argument("--near_key", default=None, help="近重复比较的字段，默认同 --key")
+    ap.add_argument("--num_perm", type=int, default=64, help="MinHash 签名长度")
+    ap.add_argument("--shingle", type=int, default=3, help="字符 n-gram 长度")
+    ap.add_argument("--hash_db", default=None, help="已见哈希落盘到该 SQLite 文件")
+    args = ap.parse_args()
+    deduplicate_jsonl(args.path, key=args.key, out_path=args.out, near=args.near,
+                      near_key=args.near_key, num_perm=args.num_perm, shingle=args.shingle, hash_db=args.hash_db)
 
 if __name__ == "__main__":
-    deduplicate_jsonl(r"D:\python_work\PaperSoul\data\roles_corpus\num1_cxs\相柳\lines.jsonl")
+    main()
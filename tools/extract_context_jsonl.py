@@ -1,52 +1,92 @@
 # 对提取文本进行二次处理
 # 从旧版 lines.jsonl（无 speaker）生成 ctx 拼接后的 jsonl，并补充 speaker 标注
-import json, re, argparse
+# [CHANGED] 规则按 (role, aliases, others, mode) 只编译一次（SpeakerAttributor）；边读边写，--workers 分批并行；
+#           extract_role_lines --speaker 可直接复用，省掉对语料的第二遍扫描
+import json, re, os, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 SAY = r"(说|道|问|答|应道|回道|解释道|提醒道|低声道|沉声道|淡淡道|冷冷道|笑道|轻声道|冷笑道|叹道|喝道|斥道|说道|说完)"
 ACT = r"(看|望|瞥|盯|凝视|负手|垂眸|皱眉|抿唇|点头|摇头|叹气|沉默|抽手|牵起|拥|抱|握|抓|抬头|闭眼|转身|停顿|顿了顿|轻笑|冷笑|飞射|乘风破浪|沉入|跃入)"
 CN_QUOTES = r"[“”\"『』「」]"
 
+_QUOTED = re.compile(rf"{CN_QUOTES}.+?{CN_QUOTES}")
+
 def _union(names):
     names = [re.escape(x) for x in names if x]
     return "(?:" + "|".join(names) + ")" if names else r"(?!x)x"
 
-def guess_speaker(text, action, role, aliases, others, mode="strict"):
-    """返回 (speaker, conf, rule) —— 保守：强证据才判定为 role，其它给 '未知' 或 '其他'。"""
-    RU = _union([role] + aliases)
-    OU = _union(others)
-
-    rules = []
-    def hit(name, score): rules.append((name, score))
-
-    # 强证据：相柳作为说话/动作主体
-    if re.search(rf"^{RU}.{{0,12}}{SAY}", text or ""):       hit("xl_front_say", 1.0)
-    if re.search(rf"{RU}.{{0,12}}{SAY}\s*$", text or ""):    hit("xl_tail_say", 0.9)
-    if re.search(rf"^{RU}.{{0,16}}{ACT}", action or ""):     hit("xl_act_subject", 0.9)
-
-    # 反证据：他人作为主体
-    if re.search(rf"^{OU}.{{0,12}}{SAY}", text or ""):       hit("other_front_say", -1.0)
-    if re.search(rf"{OU}.{{0,12}}{SAY}\s*$", text or ""):    hit("other_tail_say", -0.9)
-    if re.search(rf"^{OU}.{{0,16}}{ACT}", action or ""):     hit("other_act_subject", -0.8)
-
-    # 纯引号弱归属（仅 balanced/lenient）
-    if mode in ("balanced","lenient") and re.search(rf"{CN_QUOTES}.+?{CN_QUOTES}", text or ""):
-        if re.search(rf"{RU}.{{0,12}}{SAY}", text or "") or re.search(rf"{RU}", text or ""):
-            hit("weak_quote_ctx_xl", 0.4 if mode=="balanced" else 0.5)
+class SpeakerAttributor:
+    """
+    说话人判定规则集：构造时编译一次，attribute() 逐条判定。
+    判定结果与旧版 guess_speaker 逐条一致。
+    """
+    def __init__(self, role: str, aliases=(), others=(), mode="strict"):
+        self.role = role
+        self.mode = mode
+        RU = _union([role] + list(aliases))
+        OU = _union(list(others))
+        # (规则名, 分值, 作用于 text/action, 正则)
+        self.rules = [
+            # 强证据：相柳作为说话/动作主体
+            ("xl_front_say",      1.0,  "text",   re.compile(rf"^{RU}.{{0,12}}{SAY}")),
+            ("xl_tail_say",       0.9,  "text",   re.compile(rf"{RU}.{{0,12}}{SAY}\s*$")),
+            ("xl_act_subject",    0.9,  "action", re.compile(rf"^{RU}.{{0,16}}{ACT}")),
+            # 反证据：他人作为主体
+            ("other_front_say",   -1.0, "text",   re.compile(rf"^{OU}.{{0,12}}{SAY}")),
+            ("other_tail_say",    -0.9, "text",   re.compile(rf"{OU}.{{0,12}}{SAY}\s*$")),
+            ("other_act_subject", -0.8, "action", re.compile(rf"^{OU}.{{0,16}}{ACT}")),
+        ]
+        # 纯引号弱归属（仅 balanced/lenient）：引号内外出现主角名即可（“名…说”必然也含名）
+        self.weak = re.compile(RU) if mode in ("balanced", "lenient") else None
+        self.weak_score = 0.4 if mode == "balanced" else 0.5
+        self.scale = {"strict": 1.2, "lenient": 0.9}.get(mode, 1.0)
+
+    def attribute(self, text, action):
+        """返回 (speaker, conf, rule) —— 保守：强证据才判定为 role，其它给 '未知' 或 '其他'。"""
+        fields = {"text": text or "", "action": action or ""}
+        rules = [(name, score) for name, score, field, rx in self.rules if rx.search(fields[field])]
+        if self.weak is not None and _QUOTED.search(fields["text"]) and self.weak.search(fields["text"]):
+            rules.append(("weak_quote_ctx_xl", self.weak_score))
+
+        score = sum(s for _, s in rules) * self.scale
+        conf = max(0.0, min(1.0, 0.5 + 0.4 * score))
+        if conf >= 0.7:
+            speaker = self.role
+        elif conf <= 0.3:
+            speaker = "其他"
+        else:
+            speaker = "未知"
+
+        return speaker, round(conf, 3), "+".join(n for n,_ in rules) or "none"
+
+    def to_ctx_row(self, r):
+        """lines.jsonl 的一条 → ctx_with_speaker.jsonl 的一条。"""
+        text = r.get("text","")
+        spk, conf, rule = self.attribute(text, r.get("action",""))
+        return {
+            "doc": join_ctx(r),                  # 用于向量库
+            "anchor": r.get("line_raw") or text, # 显示给用户看的核心句
+            "type": r.get("type","speech"),
+            "speaker": spk,
+            "speaker_conf": conf,
+            "rule": rule,
+            "source_idx": r.get("source_idx"),
+        }
 
-    score = sum(s for _, s in rules)
-    if mode == "strict":  score *= 1.2
-    if mode == "lenient": score *= 0.9
+@lru_cache(maxsize=32)
+def _cached_attributor(role, aliases, others, mode):
+    return SpeakerAttributor(role, aliases, others, mode)
 
-    conf = max(0.0, min(1.0, 0.5 + 0.4 * score))
-    if conf >= 0.7:
-        speaker = role
-    elif conf <= 0.3:
-        speaker = "其他"
-    else:
-        speaker = "未知"
+def get_attributor(role, aliases=(), others=(), mode="strict") -> SpeakerAttributor:
+    """同一组 (role, aliases, others, mode) 复用同一个已编译的规则集。"""
+    return _cached_attributor(role, tuple(aliases), tuple(others), mode)
 
-    return speaker, round(conf, 3), "+".join(n for n,_ in rules) or "none"
+def guess_speaker(text, action, role, aliases, others, mode="strict"):
+    """返回 (speaker, conf, rule) —— 保守：强证据才判定为 role，其它给 '未知' 或 '其他'。"""
+    return get_attributor(role, aliases, others, mode).attribute(text, action)
 
 def join_ctx(item):
     """把 ctx_prev + line_raw + ctx_next 拼成一条 doc（不截断）"""
@@ -58,6 +98,84 @@ def join_ctx(item):
     parts = [*(p for p in prev if p), raw, *(n for n in nxt if n)]
     return " ".join(x.strip() for x in parts if x and x.strip())
 
+# —— 分批并行 —— #
+_worker_attributor = None
+
+def _init_worker(role, aliases, others, mode):
+    global _worker_attributor
+    _worker_attributor = get_attributor(role, aliases, others, mode)
+
+def _attribute_batch(raw_lines):
+    """一批 lines.jsonl 原始行 → 一批输出行（已序列化，反序列化/序列化也在子进程里做）。"""
+    out = []
+    for line in raw_lines:
+        line = line.strip()
+        if not line: continue
+        out.append(json.dumps(_worker_attributor.to_ctx_row(json.loads(line)), ensure_ascii=False) + "\n")
+    return out
+
+def _iter_batches(f, batch_size):
+    batch = []
+    for line in f:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def attribute_file(in_path: Path, out_path: Path, role, aliases=(), others=(), mode="strict",
+                   workers=None, batch_size=2000, on_row=None):
+    """
+    流式处理 in_path → out_path，按输入顺序输出；返回条数。
+    workers：进程数（默认 CPU 数，<=1 为单进程）；on_row(line)：每写一行回调（预览用）。
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    args = (role, tuple(aliases), tuple(others), mode)
+    n = 0
+    with open(in_path, "r", encoding="utf-8") as fin, open(out_path, "w", encoding="utf-8") as fout:
+        def emit(rows):
+            nonlocal n
+            for row in rows:
+                fout.write(row)
+                if on_row: on_row(row)
+            n += len(rows)
+
+        if workers <= 1:
+            _init_worker(*args)
+            for batch in _iter_batches(fin, batch_size):
+                emit(_attribute_batch(batch))
+            return n
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args) as ex:
+            pending = deque()
+            for batch in _iter_batches(fin, batch_size):
+                pending.append(ex.submit(_attribute_batch, batch))
+                while len(pending) > workers * 2:
+                    emit(pending.popleft().result())
+            while pending:
+                emit(pending.popleft().result())
+    return n
+
+class _Preview:
+    """前 limit 条写成 TSV，防止超大文件卡编辑器。"""
+    def __init__(self, path: Path, limit=1000):
+        self.path = path
+        self.limit = limit
+        self.n = 0
+        self._f = open(path, "w", encoding="utf-8")
+        self._f.write("speaker\tspeaker_conf\ttype\tanchor\tdoc\n")
+
+    def __call__(self, row):
+        if self.n >= self.limit: return
+        self.n += 1
+        it = json.loads(row)
+        self._f.write(f"{it['speaker']}\t{it['speaker_conf']}\t{it['type']}\t{it['anchor']}\t{it['doc']}\n")
+
+    def close(self):
+        self._f.close()
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--book", required=True, help="book_id，如 num1_csx")
@@ -68,6 +186,8 @@ def main():
     ap.add_argument("--src", default="lines.jsonl", help="输入文件名（默认 roles_corpus/.../lines.jsonl）")
     ap.add_argument("--dst", default="ctx_with_speaker.jsonl", help="输出文件名")
     ap.add_argument("--preview_tsv", action="store_true", help="额外输出一个预览 TSV，便于人工快速审查")
+    ap.add_argument("--workers", type=int, default=None, help="进程数，默认 CPU 数；1 = 单进程")
+    ap.add_argument("--batch_size", type=int, default=2000, help="每批交给子进程的行数")
     args = ap.parse_args()
 
     base = Path(__file__).resolve().parents[1]
@@ -78,42 +198,16 @@ def main():
     aliases = [x.strip() for x in args.aliases.split(",") if x.strip()]
     others  = [x.strip() for x in args.others.split(",")  if x.strip()]
 
-    rows, out_rows = [], []
-    with open(in_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line: continue
-            rows.append(json.loads(line))
-
-    for r in rows:
-        text   = r.get("text","")
-        action = r.get("action","")
-        doc    = join_ctx(r)
-        spk, conf, rule = guess_speaker(text, action, args.role, aliases, others, mode=args.mode)
-
-        out_rows.append({
-            "doc": doc,                          # 用于向量库
-            "anchor": r.get("line_raw") or text, # 显示给用户看的核心句
-            "type": r.get("type","speech"),
-            "speaker": spk,
-            "speaker_conf": conf,
-            "rule": rule,
-            "source_idx": r.get("source_idx"),
-        })
-
-    with open(out_path, "w", encoding="utf-8") as f:
-        for it in out_rows:
-            f.write(json.dumps(it, ensure_ascii=False) + "\n")
-
-    print(f"✅ wrote {len(out_rows)} items → {out_path}")
+    preview = _Preview(out_path.with_suffix(".tsv")) if args.preview_tsv else None
+    try:
+        n = attribute_file(in_path, out_path, args.role, aliases, others, mode=args.mode,
+                           workers=args.workers, batch_size=args.batch_size, on_row=preview)
+    finally:
+        if preview: preview.close()
 
-    if args.preview_tsv:
-        tsv_path = out_path.with_suffix(".tsv")
-        with open(tsv_path, "w", encoding="utf-8") as f:
-            f.write("speaker\tspeaker_conf\ttype\tanchor\tdoc\n")
-            for it in out_rows[:1000]:  # 防止超大文件卡编辑器
-                f.write(f"{it['speaker']}\t{it['speaker_conf']}\t{it['type']}\t{it['anchor']}\t{it['doc']}\n")
-        print(f"👀 preview: {tsv_path}")
+    print(f"✅ wrote {n} items → {out_path}")
+    if preview:
+        print(f"👀 preview: {preview.path}")
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 # 提取指定角色（如“相柳”）的台词 + 动作/心理
 # 新增：--recall high 开高召回；输出上下文；可关闭去重
-import argparse, json, re
+# [CHANGED] 正则按角色只编译一次，无角色名且无引号的句子预筛跳过；--roles 多角色一次遍历
+# [CHANGED] 按章并行切句 + 分块抽取（--workers），结果按原顺序边抽边写，内存不随全书大小增长
+# [ADDED] --speaker：抽取时顺带做说话人标注，直接写 ctx_with_speaker.jsonl（不必再跑 extract_context_jsonl.py）
+import argparse, json, os, re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    from .extract_context_jsonl import get_attributor
+except ImportError:  # 直接运行脚本（python tools/extract_role_lines.py）时没有包上下文，脚本目录就在 sys.path 上
+    from extract_context_jsonl import get_attributor
+
 BASE = Path(__file__).resolve().parents[1]
 NOVELS_DIR = BASE / "data" / "novels"
 OUT_DIR   = BASE / "data" / "roles_corpus"
@@ -91,30 +101,39 @@ def build_patterns(role, aliases, recall="default"):
     # 保持索引兼容：0=p1,1=p1b,2=p2,3=p3,4=p5,5=p6,6=p7,7=p4a,8=p4b,9=p4(弱)
     return [p1, p1b, p2, p3, p5, p6, p7, p4a, p4b, p4]
 
+_WS_RUN = re.compile(r"\s+")
+_CIRCLED = re.compile(r"[①②③④⑤⑥⑦⑧⑨⑩]")
+_LONG_SPACE = re.compile(r"\s{2,}")
+_QUOTE_RE = re.compile(CN_QUOTES)
+# split_lines 只关心这些字符：开引号切换“引号内”状态，句末符号在引号外时断句
+_SPLIT_EVENT = re.compile(r"[“『「\"。！？…？」』\n]")
+_QUOTE_TOGGLES = "“『「\""
+
 def clean_text(s: str) -> str:
     s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RUN.sub(" ", s)
     s = s.strip("“”\"『』「」")
     s = s.strip("（）()")
-    s = re.sub(r"[①②③④⑤⑥⑦⑧⑨⑩]", "", s)
+    s = _CIRCLED.sub("", s)
     return s.strip()
 
 def split_lines(blob: str):
-    lines, buf, in_quote = [], [], False
-    for ch in blob:
-        if ch in "“『「\"":
+    # [CHANGED] 只在事件字符处切片，不再逐字符拼 buffer（结果与逐字符扫描一致）
+    lines, start, in_quote = [], 0, False
+    for m in _SPLIT_EVENT.finditer(blob):
+        ch = m.group()
+        if ch in _QUOTE_TOGGLES:
             in_quote = not in_quote
-        buf.append(ch)
-        if not in_quote and ch in "。！？…？」』」\n":
-            seg = "".join(buf).strip()
+        elif not in_quote:
+            seg = blob[start:m.end()].strip()
             if seg: lines.append(seg)
-            buf = []
-    tail = "".join(buf).strip()
+            start = m.end()
+    tail = blob[start:].strip()
     if tail: lines.append(tail)
     # 再做一次温和分割（长空白）
     out = []
     for ln in lines:
-        parts = re.split(r"\s{2,}", ln.strip())
+        parts = _LONG_SPACE.split(ln.strip())
         for p in parts:
             if p: out.append(p)
     return out
@@ -133,114 +152,415 @@ def keep_range(s: str, min_len: int, max_len: int) -> bool:
     if s2.endswith(("：", ":")): return False
     return (min_len <= len(s2) <= max_len)
 
-def extract_role_lines(role: str, aliases, lines, min_len=4, max_len=140, with_context=2,
-                       recall="default", include_neighbors=1, keep_duplicates=False,
-                       include_loose_actions=False):
+
+class RoleExtractor:
     """
-    recall: default / high
-    include_neighbors: 对命中句附带前/后邻居句，便于人工修订（0/1/2）
-    keep_duplicates: 是否保留重复文本（高召回时建议 True，便于后期人工挑）
-    include_loose_actions: 高召回时，收“句内出现角色名+动作词”的动作（不要求主语在句首）
+    [NEW] 一个角色的全部正则只编译一次；extract_line 逐句判断，规则与顺序同旧版逐句循环：
+    动作+台词(p5,p6,p7) -> 强匹配(p1,p1b,p2,p2b,p3,p4a) -> 弱匹配引号(p4b,p4) -> 动作句。
+    句中既无角色名也无引号时直接跳过；有名无引号时只可能命中 p2/p2b 与动作句。
     """
-    patterns = build_patterns(role, aliases, recall=recall)
-    out = []
-    N = len(lines)
-
-    act_kw = re.compile("|".join(map(re.escape, ACTION_VERBS + MENTAL_VERBS)))
 
-    def add_item(text, idx, kind="speech", action=None):
+    def __init__(self, role: str, aliases, min_len=4, max_len=140, with_context=2, recall="default",
+                 include_neighbors=1, keep_duplicates=False, include_loose_actions=False):
+        self.role = role
+        self.aliases = list(aliases or [])
+        self.min_len, self.max_len = min_len, max_len
+        self.with_context = with_context
+        self.recall = recall
+        self.include_neighbors = include_neighbors
+        self.keep_duplicates = keep_duplicates
+        self.include_loose_actions = include_loose_actions
+
+        names = [x for x in [role] + self.aliases if x]
+        self.names = names
+        RU = build_role_union(role, self.aliases)
+        self.name_re = re.compile(RU)
+        p = build_patterns(role, self.aliases, recall=recall)
+        self.mixed = (p[4], p[5], p[6])
+        say_any = "|".join(map(re.escape, SAY_VERBS + SAY_NO_TAIL))
+        p2b_inline = re.compile(rf"{RU}(?:[\s\S]{{0,50}})?(?:{say_any})[ \t\u3000]*[:：][ \t\u3000]*(.+)$")
+        self.strong = (p[0], p[1], p[2], p2b_inline, p[3], p[7])   # p1,p1b,p2,p2b,p3,p4a
+        self.strong_unquoted = (p[2], p2b_inline)                  # 其余几条都要求引号
+        self.weak = (p[8], p[9])                                   # p4b, p4(弱)
+        self.say_ctx = re.compile(rf"{RU}(?:[\s\S]{{0,50}})?(?:{say_any})")
+        self.act_kw = re.compile("|".join(map(re.escape, ACTION_VERBS + MENTAL_VERBS)))
+        self.lead_act = re.compile(rf"^\s*{RU}.{{0,16}}(?:{self.act_kw.pattern})")
+        # 上下文窗口里是否出现角色名：名字不含空白时可按句预计算（窗口以空格拼接，名字不会跨句命中）
+        self._names_per_line = not any(re.search(r"\s", n) for n in names)
+
+    def begin(self, lines, base: int = 0):
+        """绑定句子列表（base 为 lines[0] 的全局编号，分块抽取时用），返回本角色的输出列表。"""
+        self.lines = lines
+        self.base = base
+        self.out = []
+        self._has_name = None
+        return self.out
+
+    def _window_has_name(self, i: int) -> bool:
+        lines, N, C = self.lines, len(self.lines), self.with_context
+        lo, hi = max(0, i - C), min(N, i + C + 1)
+        if self._names_per_line:
+            if self._has_name is None:
+                self._has_name = {}
+            cache = self._has_name
+            for j in range(lo, hi):
+                hit = cache.get(j)
+                if hit is None:
+                    hit = cache[j] = self.name_re.search(lines[j]) is not None
+                if hit:
+                    return True
+            return False
+        return self.name_re.search(" ".join(lines[lo:hi])) is not None
+
+    def _add(self, text, idx, kind="speech", action=None):
+        lines = self.lines
         item = {
             "type": kind,
             "text": clean_text(text),
-            "source_idx": idx,
+            "source_idx": idx + self.base,
             "line_raw": lines[idx]
         }
         if action:
             item["action"] = clean_text(action)
         # 附上下文辅助人工改
-        if include_neighbors:
-            L = include_neighbors
+        if self.include_neighbors:
+            L, N = self.include_neighbors, len(lines)
             item["ctx_prev"] = [lines[j] for j in range(max(0, idx-L), idx)]
             item["ctx_next"] = [lines[j] for j in range(idx+1, min(N, idx+1+L))]
-        out.append(item)
-
-    for i, raw in enumerate(lines):
-        line = raw
-
-        # 1) 先抓“动作+台词”组合
-        mixed_hit = False
-        for pat in (patterns[4], patterns[5], patterns[6]):
-            m = pat.search(line)
-            if m:
-                sp = m.groupdict().get("sp"); act = m.groupdict().get("act")
-                if sp and keep_range(sp, min_len, max_len):
-                    add_item(sp, i, kind="mixed", action=act or "")
-                    mixed_hit = True; break
-        if mixed_hit: continue
-
-        # 2) 经典强匹配台词
+        self.out.append(item)
+
+    def extract_line(self, i: int, has_name: bool, has_quote: bool):
+        line = self.lines[i]
+        min_len, max_len = self.min_len, self.max_len
         got = None
-        for pat in (patterns[0], patterns[1], patterns[2], re.compile(
-                rf"{build_role_union(role, aliases)}(?:[\s\S]{{0,50}})?"
-                rf"(?:{'|'.join(map(re.escape, SAY_VERBS + SAY_NO_TAIL))})[ \t\u3000]*[:：][ \t\u3000]*(.+)$"
-                # [ADDED] p2b 作为内联强匹配
-        ), patterns[3], patterns[7]):  # p1,p1b,p2,p2b,p3,p4a
-            m = pat.search(line)
-            if m:
-                got = m.group(1) if m.groups() else line
-                break
+        if has_name:
+            # 1) 先抓“动作+台词”组合（三条都要求引号）
+            if has_quote:
+                for pat in self.mixed:
+                    m = pat.search(line)
+                    if m:
+                        sp = m.groupdict().get("sp"); act = m.groupdict().get("act")
+                        if sp and keep_range(sp, min_len, max_len):
+                            self._add(sp, i, kind="mixed", action=act or "")
+                            return
+            # 2) 经典强匹配台词
+            for pat in (self.strong if has_quote else self.strong_unquoted):
+                m = pat.search(line)
+                if m:
+                    got = m.group(1) if m.groups() else line
+                    break
 
         # 3) 弱匹配引号：依据 recall 策略放宽
-        if not got:
-            for pat in (patterns[8], patterns[9]):  # p4b, p4(弱)
+        if not got and has_quote:
+            for pat in self.weak:
                 m = pat.search(line)
                 if not m:
                     continue
                 candidate = m.group(1)
-                if recall == "high":
+                if self.recall == "high":
+                    got = candidate
+                    break
+                # 窗口里没有角色名时 has_say 也不可能成立
+                if not self._window_has_name(i):
+                    continue
+                if len(candidate) <= 50:
+                    got = candidate
+                    break
+                C, N = self.with_context, len(self.lines)
+                ctx = " ".join(self.lines[max(0, i - C): min(N, i + C + 1)])
+                if self.say_ctx.search(ctx):
                     got = candidate
                     break
-                else:
-                    ctx = " ".join(lines[max(0, i - with_context): min(N, i + with_context + 1)])
-                    RU = build_role_union(role, aliases)
-                    has_role = re.search(rf"{RU}", ctx)
-                    has_say = re.search(
-                        rf"{RU}(?:[\s\S]{{0,50}})?(?:{'|'.join(map(re.escape, SAY_VERBS + SAY_NO_TAIL))})",
-                        ctx
-                    )
-                    if has_say or (has_role and len(candidate) <= 50):
-                        got = candidate
-                        break
 
         if got and keep_range(got, min_len, max_len):
-            add_item(got, i, kind="speech")
+            self._add(got, i, kind="speech")
 
         # 4) 动作句
+        if not has_name or has_quote:
+            return
         # 默认：主语更像角色（句首附近含 角色名 + 动作词）
-        lead_act = re.search(rf"^\s*{build_role_union(role,aliases)}.{{0,16}}(?:{act_kw.pattern})", line)
-        if lead_act and not re.search(CN_QUOTES, line) and keep_range(line, 4, 90) and "：" not in line and ":" not in line:
-            add_item(line, i, kind="action")
+        if self.lead_act.search(line) and keep_range(line, 4, 90) and "：" not in line and ":" not in line:
+            self._add(line, i, kind="action")
         # 高召回可选：句中任何位置出现 角色名 + 动作词 也收（可能混入“他人对角色的动作描写”——你后续人工筛）
-        elif recall == "high" and include_loose_actions and act_kw.search(line) and re.search(build_role_union(role,aliases), line) and not re.search(CN_QUOTES, line):
+        elif self.recall == "high" and self.include_loose_actions and self.act_kw.search(line):
             if keep_range(line, 4, 120):
-                add_item(line, i, kind="action")
+                self._add(line, i, kind="action")
+
+    def finish(self, dedup: bool = True):
+        # 5) 去重（可关闭）
+        out = self.out
+        if dedup and not self.keep_duplicates:
+            uniq = {}
+            for it in out:
+                key = (it["type"], it["text"], it.get("action",""))
+                if key not in uniq:
+                    uniq[key] = it
+            out = list(uniq.values())
+        self.lines = self.out = self._has_name = None
+        return out
+
+
+def extract_roles(roles, lines, **options):
+    """
+    [NEW] 多角色一次遍历：roles 为 {角色名: [别名...]}，options 同 extract_role_lines；返回 {角色名: 样本列表}。
+    所有角色名合成一个交替正则做预筛，没有任何角色名且没有引号的句子直接跳过。
+    """
+    extractors = [RoleExtractor(role, aliases, **options) for role, aliases in roles.items()]
+    for ex in extractors:
+        ex.begin(lines)
+    all_names = sorted({n for ex in extractors for n in ex.names}, key=len, reverse=True)
+    any_name = re.compile("|".join(map(re.escape, all_names))) if all_names else None
+    single = extractors[0] if len(extractors) == 1 else None
+    for i, line in enumerate(lines):
+        has_quote = _QUOTE_RE.search(line) is not None
+        named = any_name is not None and any_name.search(line) is not None
+        if not named and not has_quote:
+            continue
+        for ex in extractors:
+            has_name = named and (ex is single or ex.name_re.search(line) is not None)
+            ex.extract_line(i, has_name, has_quote)
+    return {ex.role: ex.finish() for ex in extractors}
 
-    # 5) 去重（可关闭）
-    if not keep_duplicates:
-        uniq = {}
-        for it in out:
-            key = (it["type"], it["text"], it.get("action",""))
-            if key not in uniq:
-                uniq[key] = it
-        out = list(uniq.values())
 
+def extract_role_lines(role: str, aliases, lines, min_len=4, max_len=140, with_context=2,
+                       recall="default", include_neighbors=1, keep_duplicates=False,
+                       include_loose_actions=False):
+    """
+    recall: default / high
+    include_neighbors: 对命中句附带前/后邻居句，便于人工修订（0/1/2）
+    keep_duplicates: 是否保留重复文本（高召回时建议 True，便于后期人工挑）
+    include_loose_actions: 高召回时，收“句内出现角色名+动作词”的动作（不要求主语在句首）
+    """
+    return extract_roles({role: list(aliases or [])}, lines, min_len=min_len, max_len=max_len,
+                         with_context=with_context, recall=recall, include_neighbors=include_neighbors,
+                         keep_duplicates=keep_duplicates, include_loose_actions=include_loose_actions)[role]
+
+# —— [NEW] 流式并行：按章切句 + 分块抽取（进程池），按原顺序合并写出 —— #
+# 与一次性读全书的结果逐字节一致：
+# - 切句：“是否在引号内”只由开引号字符的个数决定，每章起始状态可由前面各章的计数推出，各章独立切分；
+#   跨章未断开的句子由主进程拼接；
+# - 抽取：每块带前后 halo 句（不少于 with_context / include_neighbors），只输出本块句子，source_idx 用全局编号；
+# - 去重：主进程按输出顺序保留首次出现，与整体去重相同。
+
+def _read_chapter(p: Path) -> str:
+    try:
+        return p.read_text(encoding="utf-8")
+    except UnicodeDecodeError:
+        return p.read_text(encoding="gbk", errors="ignore")
+
+def _quote_parity(text: str) -> bool:
+    return sum(text.count(c) for c in _QUOTE_TOGGLES) % 2 == 1
+
+def _resplit(seg: str):
+    seg = seg.strip()
+    return [p for p in _LONG_SPACE.split(seg) if p] if seg else []
+
+def _split_piece(piece: str, in_quote: bool):
+    """返回 (首个断点前的片段, 是否有断点, 中间完整句子, 最后断点后的片段)。"""
+    head_end, start, lines = None, 0, []
+    for m in _SPLIT_EVENT.finditer(piece):
+        ch = m.group()
+        if ch in _QUOTE_TOGGLES:
+            in_quote = not in_quote
+        elif not in_quote:
+            if head_end is None:
+                head_end = m.end()
+            else:
+                lines.extend(_resplit(piece[start:m.end()]))
+            start = m.end()
+    if head_end is None:
+        return piece, False, [], ""
+    return piece[:head_end], True, lines, piece[start:]
+
+_worker_extractors = None
+
+def _init_worker(roles, options):
+    # 每个工作进程只编译一次
+    global _worker_extractors
+    _worker_extractors = [RoleExtractor(role, aliases, **options) for role, aliases in roles.items()]
+
+def _extract_block(prev, lines, nxt, offset):
+    """抽取 lines（全局编号从 offset 起）；prev / nxt 只作上下文。返回 {角色: 未去重样本}。"""
+    local = prev + lines + nxt
+    lo, hi = len(prev), len(prev) + len(lines)
+    for ex in _worker_extractors:
+        ex.begin(local, base=offset - lo)
+    all_names = sorted({n for ex in _worker_extractors for n in ex.names}, key=len, reverse=True)
+    any_name = re.compile("|".join(map(re.escape, all_names))) if all_names else None
+    for i in range(lo, hi):
+        line = local[i]
+        has_quote = _QUOTE_RE.search(line) is not None
+        named = any_name is not None and any_name.search(line) is not None
+        if not named and not has_quote:
+            continue
+        for ex in _worker_extractors:
+            ex.extract_line(i, named and ex.name_re.search(line) is not None, has_quote)
+    return {ex.role: ex.finish(dedup=False) for ex in _worker_extractors}
+
+class _InlineExecutor:
+    """workers<=1 时在本进程内同步执行，走同一条流水线。"""
+    def __init__(self, initializer=None, initargs=()):
+        if initializer:
+            initializer(*initargs)
+    def submit(self, fn, *args):
+        f = Future()
+        f.set_result(fn(*args))
+        return f
+    def shutdown(self, wait=True):
+        pass
+
+def iter_book_blocks(book_dir: Path, executor, max_inflight: int = 8):
+    """按章产出句子块（list[str]），跨章句子拼接后归入断开它的那一章；切分在 executor 里并行。"""
+    paths = sorted(book_dir.glob("*.txt"))
+    pending_futs = deque()
+    carry = ""
+    in_quote = False
+
+    def take():
+        nonlocal carry
+        head, cut, lines, tail = pending_futs.popleft().result()
+        if not cut:
+            carry += head
+            return []
+        block = _resplit(carry + head) + lines
+        carry = tail
+        return block
+
+    for k, p in enumerate(paths):
+        # 与 "\n".join(章节) 等价：除最后一章外每章末尾补一个换行
+        piece = _read_chapter(p) + ("\n" if k < len(paths) - 1 else "")
+        pending_futs.append(executor.submit(_split_piece, piece, in_quote))
+        in_quote ^= _quote_parity(piece)
+        del piece
+        if len(pending_futs) >= max_inflight:
+            yield take()
+    while pending_futs:
+        yield take()
+    if carry.strip():
+        yield _resplit(carry)
+
+def extract_book_streaming(book_dir: Path, roles, sinks, workers=None, **options):
+    """
+    roles：{角色名: [别名...]}；sinks：{角色名: callable(item)}，按全局顺序逐条回调（已去重）。
+    workers：进程数（默认 CPU 数，<=1 为单进程）；返回 {角色名: 条数}。
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    halo = max(options.get("with_context", 2), options.get("include_neighbors", 1), 0)
+    keep_dup = options.get("keep_duplicates", False)
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(roles, options))
+    else:
+        executor = _InlineExecutor(initializer=_init_worker, initargs=(roles, options))
+    max_inflight = max(2, workers * 2)
+    seen = {role: set() for role in roles}
+    counts = {role: 0 for role in roles}
+    results = deque()
+
+    def drain(limit):
+        while len(results) > limit:
+            for role, items in results.popleft().result().items():
+                for it in items:
+                    if not keep_dup:
+                        key = (it["type"], it["text"], it.get("action",""))
+                        if key in seen[role]:
+                            continue
+                        seen[role].add(key)
+                    sinks[role](it)
+                    counts[role] += 1
+
+    try:
+        prev = deque(maxlen=halo)      # 已派发句子的最后 halo 句
+        queue = deque()                # 等待后文 halo 的块：(offset, lines)
+        queued = 0                     # queue 中的句子总数
+        offset = 0
+
+        def dispatch(final=False):
+            nonlocal queued
+            while queue and (final or queued - len(queue[0][1]) >= halo):
+                off, lines = queue.popleft()
+                queued -= len(lines)
+                nxt = []
+                for _, later in queue:
+                    nxt.extend(later[:halo - len(nxt)])
+                    if len(nxt) >= halo:
+                        break
+                results.append(executor.submit(_extract_block, list(prev), lines, nxt, off))
+                prev.extend(lines)
+                drain(max_inflight)
+
+        for block in iter_book_blocks(book_dir, executor, max_inflight):
+            if not block:
+                continue
+            queue.append((offset, block))
+            queued += len(block)
+            offset += len(block)
+            dispatch()
+        dispatch(final=True)
+        drain(0)
+    finally:
+        executor.shutdown(wait=True)
+    return counts
+
+def parse_roles(role: str, aliases: str, roles: str):
+    """--role/--aliases 为单角色；--roles "相柳:防风邶,九命;小夭:小六,玟小六" 为多角色一次抽取。"""
+    out = {}
+    if role:
+        out[role] = [x.strip() for x in aliases.split(",") if x.strip()]
+    for spec in (roles or "").split(";"):
+        name, _, al = spec.partition(":")
+        if name.strip():
+            out[name.strip()] = [x.strip() for x in al.split(",") if x.strip()]
+    return out
+
+def _txt_line(it) -> str:
+    tag = it["type"]
+    if tag == "mixed":
+        return f"[mixed] 动作：{it.get('action','')} ｜ 台词：{it['text']}\n"
+    elif tag == "action":
+        return f"[action] {it['text']}\n"
+    return f"[speech] {it['text']}\n"
+
+class RoleWriter:
+    """lines.jsonl + lines.txt 边抽边写；给了 attributor 时另写 ctx_with_speaker.jsonl。"""
+    def __init__(self, book: str, role: str, attributor=None):
+        out_dir = OUT_DIR / book / role
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.jsonl_path = out_dir / "lines.jsonl"
+        self.txt_path   = out_dir / "lines.txt"
+        self.ctx_path   = out_dir / "ctx_with_speaker.jsonl" if attributor else None
+        self.attributor = attributor
+        self._jsonl = open(self.jsonl_path, "w", encoding="utf-8")
+        self._txt = open(self.txt_path, "w", encoding="utf-8")
+        self._ctx = open(self.ctx_path, "w", encoding="utf-8") if attributor else None
+
+    def __call__(self, it):
+        self._jsonl.write(json.dumps(it, ensure_ascii=False) + "\n")
+        self._txt.write(_txt_line(it))
+        if self._ctx:
+            self._ctx.write(json.dumps(self.attributor.to_ctx_row(it), ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._jsonl.close()
+        self._txt.close()
+        if self._ctx:
+            self._ctx.close()
+
+def role_attributors(roles, others, mode):
+    """每个角色一个规则集；他者 = --others + 其余角色及别名，去掉自己的名字。"""
+    out = {}
+    for role, aliases in roles.items():
+        own = {role, *aliases}
+        names = list(others) + [n for r, a in roles.items() if r != role for n in (r, *a)]
+        out[role] = get_attributor(role, aliases, [n for n in dict.fromkeys(names) if n not in own], mode)
     return out
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--book", required=True, help="book_id, e.g. num1_csx")
-    ap.add_argument("--role", required=True, help="角色名，如：相柳")
+    ap.add_argument("--role", default="", help="角色名，如：相柳")
     ap.add_argument("--aliases", default="", help="角色别名，逗号分隔")
+    ap.add_argument("--roles", default="", help='多角色一次抽取："相柳:防风邶,九命;小夭:小六"')
     ap.add_argument("--min_len", type=int, default=4)
     ap.add_argument("--max_len", type=int, default=140)
     ap.add_argument("--with_context", type=int, default=2)
@@ -248,51 +568,47 @@ def main():
     ap.add_argument("--include_neighbors", type=int, default=1, help="每条样本附带的上下文窗口（前后各N句）")
     ap.add_argument("--keep_duplicates", action="store_true", help="保留重复样本")
     ap.add_argument("--include_loose_actions", action="store_true", help="高召回时，收句中任意位置的 角色名+动作词")
+    ap.add_argument("--workers", type=int, default=None, help="进程数，默认 CPU 数；1 = 单进程")
+    ap.add_argument("--speaker", action="store_true", help="同时输出 ctx_with_speaker.jsonl（说话人标注）")
+    ap.add_argument("--others", default="小六,小夭,涂山璟,轩,颛顼", help="说话人标注用的他者名字，逗号分隔")
+    ap.add_argument("--mode", choices=["strict","balanced","lenient"], default="strict", help="说话人判定严格度")
     args = ap.parse_args()
 
     book_dir = NOVELS_DIR / args.book
     assert book_dir.exists(), f"not found: {book_dir}"
 
-    aliases = [x.strip() for x in args.aliases.split(",") if x.strip()]
-
-    lines = load_book_lines(book_dir)
-    samples = extract_role_lines(
-        role=args.role,
-        aliases=aliases,
-        lines=lines,
-        min_len=args.min_len,
-        max_len=args.max_len,
-        with_context=args.with_context,
-        recall=args.recall,
-        include_neighbors=args.include_neighbors,
-        keep_duplicates=args.keep_duplicates,
-        include_loose_actions=args.include_loose_actions
-    )
-
-    out_dir = OUT_DIR / args.book / args.role
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    jsonl_path = out_dir / "lines.jsonl"
-    txt_path   = out_dir / "lines.txt"
-
-    with open(jsonl_path, "w", encoding="utf-8") as f:
-        for it in samples:
-            f.write(json.dumps(it, ensure_ascii=False) + "\n")
-
-    with open(txt_path, "w", encoding="utf-8") as f:
-        for it in samples:
-            tag = it["type"]
-            if tag == "mixed":
-                f.write(f"[mixed] 动作：{it.get('action','')} ｜ 台词：{it['text']}\n")
-            elif tag == "action":
-                f.write(f"[action] {it['text']}\n")
-            else:
-                f.write(f"[speech] {it['text']}\n")
-
-    print(f"✅ 抽取完成：{len(samples)} 条")
-    print(f"JSONL: {jsonl_path}")
-    print(f"TXT  : {txt_path}")
+    roles = parse_roles(args.role, args.aliases, args.roles)
+    if not roles:
+        ap.error("需要 --role 或 --roles")
+
+    attributors = {}
+    if args.speaker:
+        others = [x.strip() for x in args.others.split(",") if x.strip()]
+        attributors = role_attributors(roles, others, args.mode)
+    writers = {role: RoleWriter(args.book, role, attributors.get(role)) for role in roles}
+    try:
+        counts = extract_book_streaming(
+            book_dir,
+            roles,
+            writers,
+            workers=args.workers,
+            min_len=args.min_len,
+            max_len=args.max_len,
+            with_context=args.with_context,
+            recall=args.recall,
+            include_neighbors=args.include_neighbors,
+            keep_duplicates=args.keep_duplicates,
+            include_loose_actions=args.include_loose_actions
+        )
+    finally:
+        for w in writers.values():
+            w.close()
+    for role, w in writers.items():
+        print(f"✅ {role} 抽取完成：{counts.get(role, 0)} 条")
+        print(f"JSONL: {w.jsonl_path}")
+        print(f"TXT  : {w.txt_path}")
+        if w.ctx_path:
+            print(f"CTX  : {w.ctx_path}")
 
 if __name__ == "__main__":
     main()
-